@@ -256,6 +256,8 @@ class UserBalanceAdmin(ModelView, model=UserBalance):
         UserBalance.ton_active_balance: "Активный баланс (нано-TON)",
         UserBalance.ton_escrow_balance: "В эскроу (нано-TON)"
     }
+    # Балансы меняются только с записью в журнал (пополнение - на странице балансов админки)
+    form_excluded_columns = [UserBalance.ton_active_balance, UserBalance.ton_escrow_balance]
 
 class UserTaskAdmin(ModelView, model=UserTask):
     column_list = [UserTask.id, UserTask.user_id, UserTask.task_id, UserTask.status, UserTask.reward_ton]
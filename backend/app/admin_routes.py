@@ -18,6 +18,7 @@ from sqlalchemy import func, and_, or_
 from app.database import SessionLocal
 from datetime import datetime, timedelta
 from app.ton_service import get_ton_service
+from app.balance_ledger import apply_balance_delta
 from decimal import Decimal
 import os
 
@@ -589,9 +590,11 @@ async def check_deposit_manually(request: Request):
                             telegram_id = match_id.group(1)
                     
                     # Создаем депозит
+                    from app.ton_address import canonical_address
                     deposit = Deposit(
                         tx_hash=tx_hash,
                         from_address=source,
+                        from_address_canonical=canonical_address(source),
                         amount_nano=value,
                         telegram_id_from_comment=telegram_id,
                         status="pending"
@@ -619,13 +622,12 @@ async def check_deposit_manually(request: Request):
                                 if not balance:
                                     balance = UserBalance(
                                         user_id=user.id,
-                                        ton_active_balance=value,
+                                        ton_active_balance=0,
                                         last_fiat_rate=Decimal("250"),
                                         fiat_currency="RUB"
                                     )
                                     db.add(balance)
-                                else:
-                                    balance.ton_active_balance += value
+                                apply_balance_delta(db, balance, value, reason="deposit", ref_id=tx_hash)
                                 
                                 deposit.user_id = user.id
                                 deposit.status = "processed"
@@ -1713,13 +1715,12 @@ async def get_user_balance_html(request: Request):
                                 if not balance:
                                     balance = UserBalance(
                                         user_id=user.id,
-                                        ton_active_balance=amount_nano,
+                                        ton_active_balance=0,
                                         last_fiat_rate=Decimal("250"),
                                         fiat_currency="RUB"
                                     )
                                     db.add(balance)
-                                else:
-                                    balance.ton_active_balance += amount_nano
+                                apply_balance_delta(db, balance, amount_nano, reason="admin_topup")
                                 
                                 db.commit()
                                 success_msg = f"Баланс пользователя @{user.username or 'user'} ({telegram_id}) пополнен на {amount_ton} TON"
@@ -1763,7 +1764,7 @@ async def get_user_balance_html(request: Request):
                                     total_refunded = Decimal(0)
                                     
                                     for tx in failed_transactions:
-                                        balance.ton_active_balance += tx.amount_nano
+                                        apply_balance_delta(db, balance, tx.amount_nano, reason="withdrawal_failed_refund", ref_id=tx.id)
                                         total_refunded += tx.amount_nano
                                         tx.status = "failed"
                                         tx.error_message = "Transaction failed: funds returned to balance via admin panel"
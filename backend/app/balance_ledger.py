@@ -0,0 +1,255 @@
+"""
+Журнал балансов (append-only) и инкрементальная сверка.
+
+Каждое изменение ton_active_balance / ton_escrow_balance проходит через
+apply_balance_delta(): в той же транзакции в balance_journal пишется дельта.
+BalanceSnapshot хранит сумму журнала до watermark (last_journal_id), поэтому
+сверка при чтении баланса читает только новые записи журнала, а не все
+депозиты, выводы и задания пользователя.
+
+BalanceChangeSet собирает изменения балансов нескольких пользователей за одно
+действие (награда, комиссия реферера, перевод в эскроу) и применяет их в одной
+транзакции: строки балансов блокируются одним SELECT ... FOR UPDATE в порядке
+user_id, поэтому встречные операции не взаимоблокируются.
+"""
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models
+
+# Тип баланса -> колонка UserBalance / BalanceSnapshot
+BALANCE_COLUMNS = {
+    "active": "ton_active_balance",
+    "escrow": "ton_escrow_balance",
+}
+
+
+def apply_balance_delta(
+    db,
+    balance: models.UserBalance,
+    amount: Decimal,
+    balance_type: str = "active",
+    reason: str = "adjustment",
+    ref_id: Optional[object] = None,
+) -> Optional[models.BalanceJournal]:
+    """
+    Изменяет баланс и записывает дельту в журнал. Commit не делает -
+    изменение попадает в транзакцию вызывающего кода.
+    Работает и с синхронной сессией (админка, скрипты), и с асинхронной.
+
+    Args:
+        db: Сессия SQLAlchemy (Session или AsyncSession)
+        balance: Баланс пользователя
+        amount: Сумма в нано-TON (может быть отрицательной)
+        balance_type: active или escrow
+        reason: Причина изменения (deposit, withdrawal, task_budget, ...)
+        ref_id: ID задания / транзакции / хэш депозита
+
+    Returns:
+        Запись журнала или None, если сумма нулевая
+    """
+    column = BALANCE_COLUMNS[balance_type]
+    amount = Decimal(amount)
+    if amount == 0:
+        return None
+
+    setattr(balance, column, Decimal(getattr(balance, column) or 0) + amount)
+
+    entry = models.BalanceJournal(
+        balance=balance,
+        balance_type=balance_type,
+        delta_nano=amount,
+        reason=reason,
+        ref_id=str(ref_id) if ref_id is not None else None,
+    )
+    db.add(entry)
+    return entry
+
+
+async def lock_balances(db: AsyncSession, user_ids: Iterable[int]) -> Dict[int, models.UserBalance]:
+    """
+    Блокирует строки балансов пользователей (SELECT FOR UPDATE) в порядке user_id.
+    Несохраненные изменения сессии предварительно сбрасываются в БД, чтобы
+    перечитанные под блокировкой объекты их не потеряли.
+    """
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return {}
+    await db.flush()
+    balances = (await db.scalars(
+        select(models.UserBalance)
+        .where(models.UserBalance.user_id.in_(user_ids))
+        .order_by(models.UserBalance.user_id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )).all()
+    return {balance.user_id: balance for balance in balances}
+
+
+class BalanceChangeSet:
+    """
+    Изменения балансов, применяемые в одной транзакции вызывающего кода.
+
+        changes = BalanceChangeSet()
+        changes.add(executor_id, -reward, "escrow", reason="escrow_release", ref_id=user_task.id)
+        changes.add(executor_id, reward_after_fee, reason="task_reward", ref_id=user_task.id)
+        await changes.apply(db)
+        await db.commit()
+    """
+
+    def __init__(self):
+        self.changes: List[Tuple[int, Decimal, str, str, Optional[object]]] = []
+
+    def add(
+        self,
+        user_id: int,
+        amount: Decimal,
+        balance_type: str = "active",  # active, escrow, referral
+        reason: str = "adjustment",
+        ref_id: Optional[object] = None,
+    ) -> "BalanceChangeSet":
+        self.changes.append((user_id, Decimal(amount), balance_type, reason, ref_id))
+        return self
+
+    @property
+    def user_ids(self) -> List[int]:
+        return sorted({change[0] for change in self.changes})
+
+    async def apply(
+        self,
+        db: AsyncSession,
+        balances: Optional[Dict[int, models.UserBalance]] = None,
+    ) -> Dict[int, models.UserBalance]:
+        """
+        Блокирует балансы затронутых пользователей и применяет изменения.
+        Commit не делает. Если балансы уже заблокированы через lock_balances(),
+        их можно передать в balances.
+
+        Returns:
+            Заблокированные балансы по user_id (пользователи без баланса пропускаются)
+        """
+        if balances is None:
+            balances = await lock_balances(db, self.user_ids)
+        for user_id, amount, balance_type, reason, ref_id in self.changes:
+            balance = balances.get(user_id)
+            if balance is None:
+                print(f"⚠️ Balance not found for user_id {user_id}, skipping {reason} {amount}", flush=True)
+                continue
+            if balance_type == "referral":
+                # Статистика реферальных начислений, в журнал не пишется
+                balance.ton_referral_earnings = Decimal(balance.ton_referral_earnings or 0) + amount
+            else:
+                apply_balance_delta(db, balance, amount, balance_type, reason=reason, ref_id=ref_id)
+        self.changes = []
+        return balances
+
+
+async def _open_snapshot(db: AsyncSession, balance: models.UserBalance) -> models.BalanceSnapshot:
+    """
+    Создает снапшот для баланса, который еще ни разу не сверялся.
+    Баланс, накопленный до появления журнала, записывается одной записью "opening".
+    """
+    journal_totals = dict(
+        (await db.execute(
+            select(models.BalanceJournal.balance_type, func.sum(models.BalanceJournal.delta_nano))
+            .where(models.BalanceJournal.user_id == balance.user_id)
+            .group_by(models.BalanceJournal.balance_type)
+        )).all()
+    )
+
+    for balance_type, column in BALANCE_COLUMNS.items():
+        opening = Decimal(getattr(balance, column) or 0) - Decimal(journal_totals.get(balance_type) or 0)
+        if opening != 0:
+            db.add(models.BalanceJournal(
+                balance=balance,
+                balance_type=balance_type,
+                delta_nano=opening,
+                reason="opening",
+            ))
+    await db.flush()
+
+    last_journal_id = await db.scalar(
+        select(func.max(models.BalanceJournal.id))
+        .where(models.BalanceJournal.user_id == balance.user_id)
+    )
+    snapshot = models.BalanceSnapshot(
+        user_id=balance.user_id,
+        ton_active_balance=Decimal(balance.ton_active_balance or 0),
+        ton_escrow_balance=Decimal(balance.ton_escrow_balance or 0),
+        last_journal_id=last_journal_id or 0,
+    )
+    db.add(snapshot)
+    return snapshot
+
+
+async def reconcile_balance(db: AsyncSession, balance: models.UserBalance) -> bool:
+    """
+    Инкрементальная сверка баланса с журналом.
+
+    Если после watermark нет новых записей и снапшот совпадает с балансом -
+    это один запрос по индексу (user_id, id). Иначе под блокировкой строки
+    баланса новые записи сворачиваются в снапшот, watermark сдвигается,
+    а расхождение исправляется в пользу журнала. Commit не делает.
+
+    Returns:
+        True если баланс был скорректирован
+    """
+    snapshot = await db.get(models.BalanceSnapshot, balance.user_id)
+    if snapshot is not None:
+        has_new_entries = await db.scalar(
+            select(models.BalanceJournal.id)
+            .where(
+                models.BalanceJournal.user_id == balance.user_id,
+                models.BalanceJournal.id > snapshot.last_journal_id
+            )
+            .limit(1)
+        )
+        if has_new_entries is None and all(
+            Decimal(getattr(balance, column) or 0) == Decimal(getattr(snapshot, column) or 0)
+            for column in BALANCE_COLUMNS.values()
+        ):
+            return False
+
+    # Блокируем строку баланса: все записи журнала по этому пользователю пишутся
+    # вместе с UPDATE этой строки, так что незакоммиченных записей ниже watermark не будет
+    balance = await db.scalar(
+        select(models.UserBalance)
+        .where(models.UserBalance.user_id == balance.user_id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    snapshot = await db.get(models.BalanceSnapshot, balance.user_id, populate_existing=True)
+    if snapshot is None:
+        await _open_snapshot(db, balance)
+        return False
+
+    new_entries = (await db.execute(
+        select(
+            models.BalanceJournal.balance_type,
+            func.sum(models.BalanceJournal.delta_nano),
+            func.max(models.BalanceJournal.id),
+        )
+        .where(
+            models.BalanceJournal.user_id == balance.user_id,
+            models.BalanceJournal.id > snapshot.last_journal_id
+        )
+        .group_by(models.BalanceJournal.balance_type)
+    )).all()
+
+    for balance_type, delta_sum, max_id in new_entries:
+        column = BALANCE_COLUMNS[balance_type]
+        setattr(snapshot, column, Decimal(getattr(snapshot, column) or 0) + Decimal(delta_sum))
+        snapshot.last_journal_id = max(snapshot.last_journal_id or 0, max_id)
+
+    corrected = False
+    for balance_type, column in BALANCE_COLUMNS.items():
+        current = Decimal(getattr(balance, column) or 0)
+        expected = Decimal(getattr(snapshot, column) or 0)
+        if current != expected:
+            difference = expected - current
+            print(f"⚠️ Balance mismatch for user_id {balance.user_id} ({balance_type}): current={current/10**9:.4f} TON, journal={expected/10**9:.4f} TON, difference={difference/10**9:.4f} TON", flush=True)
+            setattr(balance, column, expected)
+            corrected = True
+
+    return corrected
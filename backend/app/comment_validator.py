@@ -4,24 +4,40 @@
 import os
 import asyncio
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import Bot
-from telegram.error import TelegramError
-from app.database import SessionLocal
+from app.telegram_clients import get_admin_bot
+from telegram.error import NetworkError, RetryAfter, TelegramError, TimedOut
+from app.database import AsyncSessionLocal
 from app import models
+from app.task_index import task_index
+from app.slot_reservations import complete_reservation, revoke_completed_slot
+from app.balance_ledger import BalanceChangeSet, lock_balances
+from app.telegram_updates import find_comment, find_comment_message, message_still_exists
+from app.telegram_rate_limit import telegram_limiter
+from app.recheck_scheduler import recheck_scheduler, schedule_first_check
+from typing import Dict, List, Optional
 from decimal import Decimal
 
 TELEGRAM_ADMIN_BOT_TOKEN = os.getenv("TELEGRAM_ADMIN_BOT_TOKEN")
 
-async def check_comment_exists(bot: Bot, post_link: str, user_telegram_id: int) -> bool:
+# Сколько проверок подписки выполняется одновременно (частоту ограничивает telegram_limiter)
+SUBSCRIPTION_CHECK_CONCURRENCY = int(os.getenv("SUBSCRIPTION_CHECK_CONCURRENCY", "20"))
+
+# Сколько событий выхода из каналов обрабатывать за один проход
+LEAVE_EVENTS_BATCH_SIZE = 500
+
+async def check_comment_exists(db: AsyncSession, post_link: str, user_telegram_id: int) -> bool:
     """
     Проверяет, существует ли комментарий пользователя под постом.
     
-    Бот @BlackMirrowAdminBot должен быть администратором канала для проверки комментариев.
-    Использует Telegram Bot API для проверки комментариев к посту через getUpdates.
+    Бот @BlackMirrowAdminBot должен быть администратором канала и группы обсуждения:
+    его обновления собирает общий цикл ингестии (app.telegram_updates), а здесь
+    выполняется только поиск по сохраненным сообщениям.
     
     Args:
-        bot: Экземпляр Telegram Bot (@BlackMirrowAdminBot)
+        db: Сессия базы данных
         post_link: Ссылка на пост (например, https://t.me/channel/123)
         user_telegram_id: Telegram ID пользователя
     
@@ -29,101 +45,16 @@ async def check_comment_exists(bot: Bot, post_link: str, user_telegram_id: int)
         True если комментарий найден, False если нет
     """
     try:
-        # Парсим ссылку на пост
-        message_id = None
-        chat_id = None
-        
-        if '/c/' in post_link:
-            # Приватный канал: https://t.me/c/3503023298/3
-            parts = post_link.replace('https://t.me/c/', '').split('/')
-            if len(parts) >= 2:
-                # Для приватных каналов используем chat_id напрямую
-                chat_id = int(parts[0])
-                message_id = int(parts[1])
-        else:
-            # Публичный канал: https://t.me/channel/123
-            parts = post_link.replace('https://t.me/', '').split('/')
-            if len(parts) >= 2:
-                channel_username = parts[0]
-                message_id = int(parts[1])
-                # Для публичных каналов используем @username
-                chat_id = f"@{channel_username}"
-        
-        if not message_id or not chat_id:
-            print(f"[COMMENT VALIDATOR] Could not parse post_link: {post_link}")
-            return False
-        
-        # Получаем обновления через getUpdates
-        # Бот должен получать обновления о комментариях в канале
-        # ВАЖНО: getUpdates возвращает только новые обновления, которые бот еще не обработал
-        # Для проверки старых комментариев нужно использовать webhook или другой подход
-        try:
-            # Получаем последние обновления (без offset для получения всех новых)
-            # Если нужно проверить старые комментарии, нужно использовать webhook
-            updates = await bot.get_updates(
-                timeout=15,
-                allowed_updates=['message']
-            )
-            
-            # Если обновлений нет, пробуем получить с небольшим offset назад
-            # Но это не гарантирует получение старых комментариев
-            if not updates:
-                # Пытаемся получить обновления с последним известным offset
-                # В реальности нужно хранить последний offset в БД
-                try:
-                    updates = await bot.get_updates(
-                        offset=0,  # Начинаем с начала (но это вернет только новые)
-                        timeout=5,
-                        allowed_updates=['message']
-                    )
-                except:
-                    pass
-            
-            # Ищем комментарии к нужному сообщению
-            for update in updates:
-                if update.message:
-                    # Проверяем, что сообщение из нужного чата
-                    msg_chat_id = update.message.chat.id if hasattr(update.message.chat, 'id') else None
-                    msg_chat_username = update.message.chat.username if hasattr(update.message.chat, 'username') else None
-                    
-                    # Проверяем соответствие чата
-                    chat_matches = False
-                    if isinstance(chat_id, int):
-                        chat_matches = (msg_chat_id == chat_id)
-                    elif isinstance(chat_id, str) and chat_id.startswith('@'):
-                        chat_matches = (msg_chat_username == chat_id[1:])
-                    
-                    if not chat_matches:
-                        continue
-                    
-                    # Проверяем, является ли это комментарием к нужному посту
-                    if update.message.reply_to_message:
-                        reply_msg = update.message.reply_to_message
-                        # Проверяем, что это ответ на нужное сообщение
-                        if reply_msg.message_id == message_id:
-                            # Проверяем, что комментарий от нужного пользователя
-                            if update.message.from_user and update.message.from_user.id == user_telegram_id:
-                                print(f"[COMMENT VALIDATOR] Comment found for user {user_telegram_id} on post {message_id} in chat {chat_id}")
-                                return True
-                    
-                    # Также проверяем, если сообщение содержит ссылку на пост
-                    if update.message.text and post_link in update.message.text:
-                        if update.message.from_user and update.message.from_user.id == user_telegram_id:
-                            print(f"[COMMENT VALIDATOR] Comment with post link found for user {user_telegram_id}")
-                            return True
-            
-            print(f"[COMMENT VALIDATOR] Comment not found in recent updates for user {user_telegram_id} on post {message_id} in chat {chat_id}")
-            return False
-            
-        except Exception as e:
-            print(f"[COMMENT VALIDATOR] Error checking comment via Bot API: {e}")
-            return False
-        
+        if await find_comment(db, post_link, user_telegram_id):
+            print(f"[COMMENT VALIDATOR] Comment found for user {user_telegram_id} on post {post_link}")
+            return True
+        print(f"[COMMENT VALIDATOR] Comment not found for user {user_telegram_id} on post {post_link}")
+        return False
     except Exception as e:
         print(f"[COMMENT VALIDATOR] Error checking comment: {e}")
         return False
 
-async def check_subscription_exists(bot: Bot, channel_username: str, user_telegram_id: int) -> bool:
+async def check_subscription_exists(bot: Bot, channel_username: str, user_telegram_id: int) -> Optional[bool]:
     """
     Проверяет, подписан ли пользователь на канал.
     
@@ -136,7 +67,8 @@ async def check_subscription_exists(bot: Bot, channel_username: str, user_telegr
         user_telegram_id: Telegram ID пользователя
     
     Returns:
-        True если пользователь подписан, False если нет
+        True если пользователь подписан, False если нет,
+        None если проверить не удалось (лимит запросов, сеть) - результат неизвестен
     """
     try:
         # Определяем chat_id
@@ -151,7 +83,9 @@ async def check_subscription_exists(bot: Bot, channel_username: str, user_telegr
         
         # Получаем информацию о члене чата
         try:
-            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_telegram_id)
+            member = await telegram_limiter.call(
+                chat_id, lambda: bot.get_chat_member(chat_id=chat_id, user_id=user_telegram_id)
+            )
             
             # Проверяем статус подписки
             # Статусы: member, administrator, creator, left, kicked, restricted
@@ -162,6 +96,10 @@ async def check_subscription_exists(bot: Bot, channel_username: str, user_telegr
                 print(f"[COMMENT VALIDATOR] User {user_telegram_id} is not subscribed to {chat_id} (status: {member.status})")
                 return False
                 
+        except (RetryAfter, TimedOut, NetworkError) as e:
+            # Временная ошибка - не считаем пользователя отписавшимся
+            print(f"[COMMENT VALIDATOR] Could not check chat member {user_telegram_id} in {chat_id}: {e}")
+            return None
         except Exception as e:
             print(f"[COMMENT VALIDATOR] Error getting chat member: {e}")
             # Если бот не админ или нет доступа, возвращаем False
@@ -171,7 +109,7 @@ async def check_subscription_exists(bot: Bot, channel_username: str, user_telegr
         print(f"[COMMENT VALIDATOR] Error checking subscription: {e}")
         return False
 
-async def validate_comment_task(user_task_id: int, db: Session):
+async def validate_comment_task(user_task_id: int, db: AsyncSession):
     """
     Валидирует комментарий для задания и переводит средства из эскроу на баланс.
     
@@ -179,15 +117,22 @@ async def validate_comment_task(user_task_id: int, db: Session):
         user_task_id: ID записи UserTask
         db: Сессия базы данных
     """
-    user_task = db.query(models.UserTask).filter(models.UserTask.id == user_task_id).first()
+    # Блокируем заявку: одновременная ручная проверка дождется commit и увидит COMPLETED
+    user_task = await db.scalar(
+        select(models.UserTask)
+        .where(models.UserTask.id == user_task_id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
     if not user_task or user_task.status != models.UserTaskStatus.IN_PROGRESS:
+        await db.rollback()
         return
     
-    task = db.query(models.Task).filter(models.Task.id == user_task.task_id).first()
+    task = await db.scalar(select(models.Task).where(models.Task.id == user_task.task_id))
     if not task or task.task_type != models.TaskType.COMMENT:
         return
     
-    user = db.query(models.User).filter(models.User.id == user_task.user_id).first()
+    user = await db.scalar(select(models.User).where(models.User.id == user_task.user_id))
     if not user:
         return
     
@@ -195,18 +140,16 @@ async def validate_comment_task(user_task_id: int, db: Session):
         print(f"[COMMENT VALIDATOR] TELEGRAM_ADMIN_BOT_TOKEN not set, skipping validation")
         return
     
-    bot = Bot(token=TELEGRAM_ADMIN_BOT_TOKEN)
     post_link = task.telegram_channel_id  # Для комментариев ссылка хранится здесь
     
     # Проверяем наличие комментария
-    comment_exists = await check_comment_exists(bot, post_link, user.telegram_id)
+    comment_exists = await check_comment_exists(db, post_link, user.telegram_id)
     
     if comment_exists:
         # Комментарий найден - переводим средства из эскроу на баланс
-        from app.database_optimizations import update_balance_safely
         
         # Вычитаем 10% комиссию приложения
-        def deduct_app_commission(user_id: int, reward_ton: Decimal, db: Session) -> Decimal:
+        def deduct_app_commission(user_id: int, reward_ton: Decimal, db: AsyncSession) -> Decimal:
             app_commission = reward_ton * Decimal("0.10")
             user_reward = reward_ton - app_commission
             
@@ -216,9 +159,10 @@ async def validate_comment_task(user_task_id: int, db: Session):
         
         user_reward = deduct_app_commission(user.id, user_task.reward_ton, db)
         
-        # Переводим средства из эскроу в активный баланс
-        update_balance_safely(db, user.id, -user_task.reward_ton, "escrow")
-        update_balance_safely(db, user.id, user_reward, "active")
+        # Переводим средства из эскроу в активный баланс (вместе с комиссией реферера - одной транзакцией)
+        changes = BalanceChangeSet()
+        changes.add(user.id, -user_task.reward_ton, "escrow", reason="escrow_release", ref_id=user_task.id)
+        changes.add(user.id, user_reward, reason="task_reward", ref_id=user_task.id)
         
         # Обновляем статус задания
         user_task.status = models.UserTaskStatus.COMPLETED
@@ -227,86 +171,113 @@ async def validate_comment_task(user_task_id: int, db: Session):
         
         # Начисляем 5% рефереру
         from app.routers.tasks import add_referral_commission
-        add_referral_commission(user.id, user_task.reward_ton, db)
+        await add_referral_commission(user.id, user_task.reward_ton, db, changes)
+        await changes.apply(db)
         
-        # Обновляем счетчик выполненных слотов
-        task.completed_slots += 1
+        # Резерв слота переходит в выполненные
+        await complete_reservation(db, task)
         
-        db.commit()
+        # Перепроверки в течение окна ведет планировщик (next_check_at)
+        schedule_first_check(user_task, task.task_type)
+        
+        await db.commit()
+        task_index.upsert(task)
+        recheck_scheduler.push(user_task.id, user_task.next_check_at)
         print(f"[COMMENT VALIDATOR] Comment validated for user_task {user_task_id}, funds transferred")
     else:
         print(f"[COMMENT VALIDATOR] Comment not found for user_task {user_task_id}")
 
-async def check_comment_periodically(user_task_id: int, db: Session):
+async def check_comment_periodically(user_task_id: int, db: AsyncSession):
     """
-    Периодически проверяет комментарий (каждые 5 минут в течение часа).
+    Перепроверка комментария (в течение часа с удваивающимся интервалом, вызывается планировщиком).
     Если комментарий удален - банит пользователя и списывает средства.
     
+    Удаление не приходит в обновлениях бота, поэтому сохраненное сообщение
+    проверяется вживую (telegram_updates.message_still_exists); если проверить
+    не удалось, комментарий считается существующим.
+    
     Args:
         user_task_id: ID записи UserTask
         db: Сессия базы данных
     """
-    user_task = db.query(models.UserTask).filter(models.UserTask.id == user_task_id).first()
-    if not user_task:
+    user_task = await db.scalar(
+        select(models.UserTask)
+        .where(models.UserTask.id == user_task_id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    if not user_task or user_task.status != models.UserTaskStatus.COMPLETED:
+        await db.rollback()
         return
     
     # Проверяем, прошло ли меньше часа с момента валидации
     if not user_task.validated_at:
         return
     
-    time_since_validation = datetime.utcnow() - user_task.validated_at.replace(tzinfo=None) if user_task.validated_at.tzinfo else user_task.validated_at
+    time_since_validation = datetime.utcnow() - (user_task.validated_at.replace(tzinfo=None) if user_task.validated_at.tzinfo else user_task.validated_at)
     
     if time_since_validation > timedelta(hours=1):
         # Прошло больше часа - прекращаем проверку
         return
     
-    task = db.query(models.Task).filter(models.Task.id == user_task.task_id).first()
+    task = await db.scalar(select(models.Task).where(models.Task.id == user_task.task_id))
     if not task or task.task_type != models.TaskType.COMMENT:
         return
     
-    user = db.query(models.User).filter(models.User.id == user_task.user_id).first()
+    user = await db.scalar(select(models.User).where(models.User.id == user_task.user_id))
     if not user:
         return
     
     if not TELEGRAM_ADMIN_BOT_TOKEN:
         return
     
-    bot = Bot(token=TELEGRAM_ADMIN_BOT_TOKEN)
     post_link = task.telegram_channel_id
     
-    # Проверяем наличие комментария
-    comment_exists = await check_comment_exists(bot, post_link, user.telegram_id)
+    # Проверяем, не удален ли засчитанный комментарий
+    message = await find_comment_message(db, post_link, user.telegram_id)
+    if message is None:
+        print(f"[COMMENT VALIDATOR] Stored comment for user_task {user_task_id} not found, skipping recheck")
+        await db.rollback()
+        return
+    bot = await get_admin_bot()
+    comment_exists = await telegram_limiter.call(
+        message.source_chat_id, lambda: message_still_exists(bot, message.source_chat_id, message.message_id)
+    )
     
-    if not comment_exists:
+    if comment_exists is False:
         # Комментарий удален - баним пользователя и списываем средства
-        from app.database_optimizations import update_balance_safely
+        await db.delete(message)
         
         # Списываем средства с баланса пользователя на счет приложения
         # ВАЖНО: Средства списываются с активного баланса, но нужно убедиться, что баланс достаточен
-        balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+        balances = await lock_balances(db, [user.id])
+        balance = balances.get(user.id)
         if balance:
+            changes = BalanceChangeSet()
             # Списываем средства (если баланс достаточен)
             if balance.ton_active_balance >= user_task.reward_ton:
-                update_balance_safely(db, user.id, -user_task.reward_ton, "active")
+                changes.add(user.id, -user_task.reward_ton, reason="comment_deleted_penalty", ref_id=user_task.id)
                 # Средства списываются с баланса пользователя (не начисляются на счет приложения явно)
                 # Можно добавить логику начисления на сервисный кошелек, если нужно
             else:
                 # Если баланс недостаточен, списываем все что есть
-                update_balance_safely(db, user.id, -balance.ton_active_balance, "active")
+                changes.add(user.id, -balance.ton_active_balance, reason="comment_deleted_penalty", ref_id=user_task.id)
+            await changes.apply(db, balances)
         
         # Баним пользователя на 7 дней
         user.is_banned = True
         user.ban_until = datetime.utcnow() + timedelta(days=7)
         user.ban_reason = "Удален комментарий после валидации"
         
-        # Обновляем статус задания
+        # Обновляем статус задания и снимаем его с перепроверки
         user_task.status = models.UserTaskStatus.FAILED
         user_task.validation_result = False
+        user_task.next_check_at = None
         
-        db.commit()
+        await db.commit()
         print(f"[COMMENT VALIDATOR] Comment deleted for user_task {user_task_id}, user {user.telegram_id} banned for 7 days")
 
-async def validate_subscription_task(user_task_id: int, db: Session):
+async def validate_subscription_task(user_task_id: int, db: AsyncSession):
     """
     Валидирует подписку для задания и переводит средства из эскроу на баланс.
     
@@ -314,15 +285,22 @@ async def validate_subscription_task(user_task_id: int, db: Session):
         user_task_id: ID записи UserTask
         db: Сессия базы данных
     """
-    user_task = db.query(models.UserTask).filter(models.UserTask.id == user_task_id).first()
+    # Блокируем заявку: одновременная ручная проверка дождется commit и увидит COMPLETED
+    user_task = await db.scalar(
+        select(models.UserTask)
+        .where(models.UserTask.id == user_task_id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
     if not user_task or user_task.status != models.UserTaskStatus.IN_PROGRESS:
+        await db.rollback()
         return
     
-    task = db.query(models.Task).filter(models.Task.id == user_task.task_id).first()
+    task = await db.scalar(select(models.Task).where(models.Task.id == user_task.task_id))
     if not task or task.task_type != models.TaskType.SUBSCRIPTION:
         return
     
-    user = db.query(models.User).filter(models.User.id == user_task.user_id).first()
+    user = await db.scalar(select(models.User).where(models.User.id == user_task.user_id))
     if not user:
         return
     
@@ -330,7 +308,7 @@ async def validate_subscription_task(user_task_id: int, db: Session):
         print(f"[COMMENT VALIDATOR] TELEGRAM_ADMIN_BOT_TOKEN not set, skipping validation")
         return
     
-    bot = Bot(token=TELEGRAM_ADMIN_BOT_TOKEN)
+    bot = await get_admin_bot()
     channel_id = task.telegram_channel_id  # Для подписок здесь хранится channel_id или @username
     
     # Проверяем наличие подписки
@@ -338,19 +316,19 @@ async def validate_subscription_task(user_task_id: int, db: Session):
     
     if subscription_exists:
         # Подписка найдена - переводим средства из эскроу на баланс
-        from app.database_optimizations import update_balance_safely
         
         # Вычитаем 10% комиссию приложения
-        def deduct_app_commission(user_id: int, reward_ton: Decimal, db: Session) -> Decimal:
+        def deduct_app_commission(user_id: int, reward_ton: Decimal, db: AsyncSession) -> Decimal:
             app_commission = reward_ton * Decimal("0.10")
             user_reward = reward_ton - app_commission
             return user_reward
         
         user_reward = deduct_app_commission(user.id, user_task.reward_ton, db)
         
-        # Переводим средства из эскроу в активный баланс
-        update_balance_safely(db, user.id, -user_task.reward_ton, "escrow")
-        update_balance_safely(db, user.id, user_reward, "active")
+        # Переводим средства из эскроу в активный баланс (вместе с комиссией реферера - одной транзакцией)
+        changes = BalanceChangeSet()
+        changes.add(user.id, -user_task.reward_ton, "escrow", reason="escrow_release", ref_id=user_task.id)
+        changes.add(user.id, user_reward, reason="task_reward", ref_id=user_task.id)
         
         # Обновляем статус задания
         user_task.status = models.UserTaskStatus.COMPLETED
@@ -359,186 +337,226 @@ async def validate_subscription_task(user_task_id: int, db: Session):
         
         # Начисляем 5% рефереру
         from app.routers.tasks import add_referral_commission
-        add_referral_commission(user.id, user_task.reward_ton, db)
+        await add_referral_commission(user.id, user_task.reward_ton, db, changes)
+        await changes.apply(db)
+        
+        # Резерв слота переходит в выполненные
+        await complete_reservation(db, task)
         
-        # Обновляем счетчик выполненных слотов
-        task.completed_slots += 1
+        # Перепроверки в течение окна ведет планировщик (next_check_at)
+        schedule_first_check(user_task, task.task_type)
         
-        db.commit()
+        await db.commit()
+        task_index.upsert(task)
+        recheck_scheduler.push(user_task.id, user_task.next_check_at)
         print(f"[COMMENT VALIDATOR] Subscription validated for user_task {user_task_id}, funds transferred")
     else:
         print(f"[COMMENT VALIDATOR] Subscription not found for user_task {user_task_id}")
 
-async def check_subscription_periodically(user_task_id: int, db: Session):
+async def check_subscription_periodically(user_task_id: int, db: AsyncSession, subscription_exists: Optional[bool] = None):
     """
-    Периодически проверяет подписку (раз в день в течение 7 дней).
+    Перепроверка подписки (раз в день в течение 7 дней, вызывается планировщиком).
     Если подписка отменена - возвращает средства из эскроу в задание или заказчику.
     
     Args:
         user_task_id: ID записи UserTask
         db: Сессия базы данных
+        subscription_exists: Результат уже выполненной проверки (recheck_subscriptions);
+            None - проверить здесь
     """
-    user_task = db.query(models.UserTask).filter(models.UserTask.id == user_task_id).first()
-    if not user_task:
+    user_task = await db.scalar(
+        select(models.UserTask)
+        .where(models.UserTask.id == user_task_id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    if not user_task or user_task.status != models.UserTaskStatus.COMPLETED:
+        await db.rollback()
         return
     
     # Проверяем, прошло ли меньше 7 дней с момента валидации
     if not user_task.validated_at:
         return
     
-    time_since_validation = datetime.utcnow() - user_task.validated_at.replace(tzinfo=None) if user_task.validated_at.tzinfo else user_task.validated_at
+    time_since_validation = datetime.utcnow() - (user_task.validated_at.replace(tzinfo=None) if user_task.validated_at.tzinfo else user_task.validated_at)
     
     if time_since_validation > timedelta(days=7):
         # Прошло больше 7 дней - прекращаем проверку
         return
     
-    task = db.query(models.Task).filter(models.Task.id == user_task.task_id).first()
+    task = await db.scalar(select(models.Task).where(models.Task.id == user_task.task_id))
     if not task or task.task_type != models.TaskType.SUBSCRIPTION:
         return
     
-    user = db.query(models.User).filter(models.User.id == user_task.user_id).first()
+    user = await db.scalar(select(models.User).where(models.User.id == user_task.user_id))
     if not user:
         return
     
-    if not TELEGRAM_ADMIN_BOT_TOKEN:
-        return
-    
-    bot = Bot(token=TELEGRAM_ADMIN_BOT_TOKEN)
-    channel_id = task.telegram_channel_id
-    
-    # Проверяем наличие подписки
-    subscription_exists = await check_subscription_exists(bot, channel_id, user.telegram_id)
+    if subscription_exists is None:
+        if not TELEGRAM_ADMIN_BOT_TOKEN:
+            return
+        
+        bot = await get_admin_bot()
+        channel_id = task.telegram_channel_id
+        
+        # Проверяем наличие подписки
+        subscription_exists = await check_subscription_exists(bot, channel_id, user.telegram_id)
+        if subscription_exists is None:
+            # Проверка не удалась - повторим в следующий раз
+            return
     
     if not subscription_exists:
         # Подписка отменена - возвращаем средства из эскроу
-        from app.database_optimizations import update_balance_safely
-        from decimal import Decimal
+        
+        # Блокируем балансы исполнителя и заказчика сразу (в порядке user_id)
+        balances = await lock_balances(db, [user.id, task.creator_id])
+        changes = BalanceChangeSet()
         
         # Списываем средства из эскроу пользователя
-        user_balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+        user_balance = balances.get(user.id)
         if user_balance and user_balance.ton_escrow_balance >= user_task.reward_ton:
             # Списываем из эскроу пользователя
-            update_balance_safely(db, user.id, -user_task.reward_ton, "escrow")
+            changes.add(user.id, -user_task.reward_ton, "escrow", reason="subscription_cancelled", ref_id=user_task.id)
             
             # Получаем заказчика задания
-            creator = db.query(models.User).filter(models.User.id == task.creator_id).first()
+            creator = await db.scalar(select(models.User).where(models.User.id == task.creator_id))
             if creator:
-                creator_balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == creator.id).first()
+                creator_balance = balances.get(creator.id)
                 
                 if task.status == models.TaskStatus.ACTIVE:
                     # Задание еще активно - возвращаем средства в задание (увеличиваем completed_slots обратно)
                     # Но на самом деле нужно вернуть средства заказчику, так как слот уже был засчитан
                     # Возвращаем средства заказчику на активный баланс
                     if creator_balance:
-                        update_balance_safely(db, creator.id, user_task.reward_ton, "active")
+                        changes.add(creator.id, user_task.reward_ton, reason="subscription_cancelled_refund", ref_id=user_task.id)
                         print(f"[COMMENT VALIDATOR] Subscription cancelled for user_task {user_task_id}, funds returned to creator (task active)")
                 else:
                     # Задание завершено - возвращаем средства заказчику
                     if creator_balance:
-                        update_balance_safely(db, creator.id, user_task.reward_ton, "active")
+                        changes.add(creator.id, user_task.reward_ton, reason="subscription_cancelled_refund", ref_id=user_task.id)
                         print(f"[COMMENT VALIDATOR] Subscription cancelled for user_task {user_task_id}, funds returned to creator (task completed)")
                 
                 # Уменьшаем счетчик выполненных слотов (возвращаем слот обратно)
-                if task.completed_slots > 0:
-                    task.completed_slots -= 1
+                await revoke_completed_slot(db, task)
         
-        # Обновляем статус задания пользователя
+        await changes.apply(db, balances)
+        
+        # Обновляем статус задания пользователя и снимаем его с перепроверки
         user_task.status = models.UserTaskStatus.FAILED
         user_task.validation_result = False
+        user_task.next_check_at = None
         
-        db.commit()
+        await db.commit()
+        # Слот вернулся - задание снова может появиться в ленте
+        task_index.upsert(task)
         print(f"[COMMENT VALIDATOR] Subscription cancelled for user_task {user_task_id}, funds returned to creator")
 
-async def check_all_comment_tasks():
+async def recheck_subscriptions(db: AsyncSession, user_task_ids: List[int]) -> Dict[int, Optional[bool]]:
     """
-    Проверяет все задания с комментариями и подписками, которые находятся в статусе IN_PROGRESS или COMPLETED.
+    Перепроверяет подписки заданий, срок проверки которых наступил (вызывается планировщиком).
+    
+    Запросы get_chat_member идут параллельно (не больше SUBSCRIPTION_CHECK_CONCURRENCY
+    одновременно, частота ограничена telegram_limiter глобально и по каналу),
+    а изменения в БД по отписавшимся применяются последовательно в сессии db.
+    
+    Returns:
+        {user_task_id: подписка есть / нет / None - проверить не удалось}
     """
-    db = SessionLocal()
-    try:
-        # Находим все задания с комментариями в статусе IN_PROGRESS
-        in_progress_comment_tasks = db.query(models.UserTask).join(models.Task).filter(
-            and_(
-                models.Task.task_type == models.TaskType.COMMENT,
-                models.UserTask.status == models.UserTaskStatus.IN_PROGRESS
-            )
-        ).all()
-        
-        for user_task in in_progress_comment_tasks:
-            await validate_comment_task(user_task.id, db)
-        
-        # Находим все задания с подписками в статусе IN_PROGRESS
-        in_progress_subscription_tasks = db.query(models.UserTask).join(models.Task).filter(
-            and_(
-                models.Task.task_type == models.TaskType.SUBSCRIPTION,
-                models.UserTask.status == models.UserTaskStatus.IN_PROGRESS
-            )
-        ).all()
-        
-        for user_task in in_progress_subscription_tasks:
-            await validate_subscription_task(user_task.id, db)
-        
-        # Находим все задания с комментариями в статусе COMPLETED (для периодической проверки - каждые 5 минут в течение часа)
-        completed_comment_tasks = db.query(models.UserTask).join(models.Task).filter(
-            and_(
-                models.Task.task_type == models.TaskType.COMMENT,
-                models.UserTask.status == models.UserTaskStatus.COMPLETED,
-                models.UserTask.validated_at.isnot(None)
-            )
-        ).all()
-        
-        for user_task in completed_comment_tasks:
-            await check_comment_periodically(user_task.id, db)
-        
-        # Находим все задания с подписками в статусе COMPLETED (для периодической проверки - раз в день в течение 7 дней)
-        completed_subscription_tasks = db.query(models.UserTask).join(models.Task).filter(
-            and_(
-                models.Task.task_type == models.TaskType.SUBSCRIPTION,
-                models.UserTask.status == models.UserTaskStatus.COMPLETED,
-                models.UserTask.validated_at.isnot(None)
-            )
-        ).all()
-        
-        for user_task in completed_subscription_tasks:
-            await check_subscription_periodically(user_task.id, db)
-            
-    finally:
-        db.close()
+    if not TELEGRAM_ADMIN_BOT_TOKEN or not user_task_ids:
+        return {}
+    
+    rows = (await db.execute(
+        select(models.UserTask.id, models.Task.telegram_channel_id, models.User.telegram_id)
+        .join(models.Task, models.Task.id == models.UserTask.task_id)
+        .join(models.User, models.User.id == models.UserTask.user_id)
+        .where(
+            models.UserTask.id.in_(user_task_ids),
+            models.Task.task_type == models.TaskType.SUBSCRIPTION,
+            models.UserTask.status == models.UserTaskStatus.COMPLETED,
+            models.Task.telegram_channel_id.isnot(None)
+        )
+    )).all()
+    if not rows:
+        return {}
+    
+    bot = await get_admin_bot()
+    semaphore = asyncio.Semaphore(SUBSCRIPTION_CHECK_CONCURRENCY)
+    
+    async def check(user_task_id: int, channel_id: str, telegram_id: int):
+        async with semaphore:
+            return user_task_id, await check_subscription_exists(bot, channel_id, telegram_id)
+    
+    results: Dict[int, Optional[bool]] = dict(await asyncio.gather(*(check(*row) for row in rows)))
+    
+    unsubscribed: List[int] = [user_task_id for user_task_id, exists in results.items() if exists is False]
+    for user_task_id in unsubscribed:
+        await check_subscription_periodically(user_task_id, db, subscription_exists=False)
+    
+    unknown = sum(1 for exists in results.values() if exists is None)
+    print(f"[COMMENT VALIDATOR] Rechecked {len(results)} subscriptions: {len(unsubscribed)} cancelled, {unknown} not checked")
+    return results
 
-async def run_comment_checker_periodically():
-    """
-    Запускает периодическую проверку комментариев (каждые 5 минут).
-    """
-    while True:
-        try:
-            await asyncio.sleep(300)  # 5 минут
-            await check_all_comment_tasks()
-        except Exception as e:
-            print(f"[COMMENT VALIDATOR] Error in periodic check: {e}")
-            await asyncio.sleep(60)  # При ошибке ждем минуту
+def channel_keys(chat_id: int, chat_username: Optional[str]) -> List[str]:
+    """Варианты записи канала в Task.telegram_channel_id (в нижнем регистре): id, @username, username."""
+    keys = [str(chat_id)]
+    if chat_username:
+        keys += [f"@{chat_username}", chat_username]
+    return keys
 
-async def run_subscription_checker_daily():
+async def process_leave_events(db: AsyncSession) -> int:
     """
-    Запускает ежедневную проверку подписок (раз в день).
+    Возвращает эскроу по событиям выхода из каналов (chat_member обновления).
+    
+    Для каждого необработанного события находит подписки пользователя на этот канал,
+    подтвержденные до выхода и еще находящиеся в окне перепроверки (next_check_at не NULL),
+    и применяет к ним check_subscription_periodically(subscription_exists=False).
+    Повторная обработка события безопасна: подписка уже в статусе FAILED.
+    
+    Returns:
+        Количество отмененных подписок
     """
-    while True:
-        try:
-            await asyncio.sleep(86400)  # 24 часа (1 день)
-            db = SessionLocal()
-            try:
-                # Находим все задания с подписками в статусе COMPLETED
-                completed_subscription_tasks = db.query(models.UserTask).join(models.Task).filter(
-                    and_(
-                        models.Task.task_type == models.TaskType.SUBSCRIPTION,
-                        models.UserTask.status == models.UserTaskStatus.COMPLETED,
-                        models.UserTask.validated_at.isnot(None)
-                    )
-                ).all()
-                
-                for user_task in completed_subscription_tasks:
-                    await check_subscription_periodically(user_task.id, db)
-            finally:
-                db.close()
-        except Exception as e:
-            print(f"[COMMENT VALIDATOR] Error in daily subscription check: {e}")
-            await asyncio.sleep(3600)  # При ошибке ждем час
-
+    # Колонками, а не ORM-объектами: commit и rollback внутри цикла
+    # (check_subscription_periodically) сбрасывают состояние объектов сессии
+    events = (await db.execute(
+        select(
+            models.ChannelMemberEvent.id,
+            models.ChannelMemberEvent.user_telegram_id,
+            models.ChannelMemberEvent.chat_id,
+            models.ChannelMemberEvent.chat_username,
+            models.ChannelMemberEvent.event_at,
+        )
+        .where(models.ChannelMemberEvent.processed_at.is_(None))
+        .order_by(models.ChannelMemberEvent.id)
+        .limit(LEAVE_EVENTS_BATCH_SIZE)
+    )).all()
+    
+    cancelled = 0
+    for event_id, user_telegram_id, chat_id, chat_username, event_at in events:
+        user_task_ids = (await db.scalars(
+            select(models.UserTask.id)
+            .join(models.Task, models.Task.id == models.UserTask.task_id)
+            .join(models.User, models.User.id == models.UserTask.user_id)
+            .where(
+                models.User.telegram_id == user_telegram_id,
+                models.Task.task_type == models.TaskType.SUBSCRIPTION,
+                func.lower(models.Task.telegram_channel_id).in_(channel_keys(chat_id, chat_username)),
+                models.UserTask.status == models.UserTaskStatus.COMPLETED,
+                models.UserTask.next_check_at.isnot(None),
+                models.UserTask.validated_at <= event_at
+            )
+        )).all()
+        
+        for user_task_id in user_task_ids:
+            await check_subscription_periodically(user_task_id, db, subscription_exists=False)
+            cancelled += 1
+        
+        await db.execute(
+            update(models.ChannelMemberEvent)
+            .where(models.ChannelMemberEvent.id == event_id)
+            .values(processed_at=datetime.utcnow())
+        )
+        await db.commit()
+    
+    if cancelled:
+        print(f"[COMMENT VALIDATOR] Leave events: {cancelled} subscriptions cancelled from {len(events)} events")
+    return cancelled
@@ -1,6 +1,8 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from typing import Awaitable, Callable, List
 import os
 from dotenv import load_dotenv
 
@@ -10,23 +12,67 @@ load_dotenv()
 # Если переменной нет, используем локальную SQLite по умолчанию
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./blackmirrowmarket.db")
 
+# Railway/Heroku отдают postgres://, SQLAlchemy понимает только postgresql://
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+
+
+def to_async_url(url: str) -> str:
+    """Подставляет асинхронный драйвер в URL базы данных (asyncpg / aiosqlite)."""
+    if url.startswith("sqlite+aiosqlite") or url.startswith("postgresql+asyncpg"):
+        return url
+    if url.startswith("sqlite"):
+        return "sqlite+aiosqlite" + url[len("sqlite"):]
+    if url.startswith("postgresql"):
+        # postgresql:// и postgresql+psycopg2:// -> postgresql+asyncpg://
+        return "postgresql+asyncpg" + url[url.index("://"):]
+    return url
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+
 # Проверяем, какая база используется
 if DATABASE_URL.startswith("sqlite"):
     # Настройки для SQLite
     engine = create_engine(
         DATABASE_URL, connect_args={"check_same_thread": False}
     )
+    async_engine = create_async_engine(ASYNC_DATABASE_URL)
 else:
     # Настройки для PostgreSQL (нужны для production)
     engine = create_engine(DATABASE_URL)
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_pre_ping=True,
+    )
 
+# Синхронная сессия - для админки (sqladmin) и служебных скриптов
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронные действия после commit (например, инвалидация кэша баланса в Redis).
+# В отличие от синхронного события after_commit, они ожидаются внутри
+# AsyncSession.commit(): код после commit видит их результат
+async_after_commit_hooks: List[Callable[["AppAsyncSession"], Awaitable[None]]] = []
+
+
+class AppAsyncSession(AsyncSession):
+    async def commit(self):
+        await super().commit()
+        for hook in async_after_commit_hooks:
+            await hook(self)
+
+
+# Асинхронная сессия - для API роутеров и фоновых задач, не блокирует event loop.
+# expire_on_commit=False: после commit объекты остаются читаемыми без lazy-load
+# (в асинхронном режиме неявная подгрузка атрибутов невозможна)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, class_=AppAsyncSession, autoflush=False, expire_on_commit=False
+)
+
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -2,127 +2,331 @@
 Оптимизации для работы с базой данных
 Включает безопасное обновление балансов и кэширование
 """
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import event, select
 from sqlalchemy.orm import Session
-from sqlalchemy import select
 from app import models
+from app.balance_ledger import BalanceChangeSet
+from app.database import async_after_commit_hooks
+from collections import OrderedDict
 from decimal import Decimal
-from typing import Optional
+from typing import Any, Dict, Iterable, Optional, Tuple
+import asyncio
 import redis
+import redis.asyncio as aioredis
 import os
 import json
+import time
 
 # Инициализация Redis (опционально, если установлен)
 try:
     REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-    redis_client = redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+    # Короткие таймауты: недоступный Redis не должен тормозить чтение баланса
+    _redis_options = dict(decode_responses=True, socket_connect_timeout=0.5, socket_timeout=0.5)
+    # Асинхронный клиент - для запросов API и фоновых задач (не блокирует event loop)
+    redis_client = aioredis.from_url(REDIS_URL, **_redis_options) if REDIS_URL else None
+    # Синхронный - только для commit в потоках без event loop (админка на SessionLocal)
+    redis_sync_client = redis.from_url(REDIS_URL, **_redis_options) if REDIS_URL else None
 except:
     redis_client = None
+    redis_sync_client = None
 
+# TTL записи баланса в Redis и в локальном кэше процесса.
+# Локальный кэш не видит инвалидаций из других процессов, поэтому его TTL короткий
+BALANCE_CACHE_TTL = int(os.getenv("BALANCE_CACHE_TTL", "300"))
+BALANCE_LOCAL_CACHE_TTL = int(os.getenv("BALANCE_LOCAL_CACHE_TTL", "10"))
+BALANCE_LOCAL_CACHE_SIZE = int(os.getenv("BALANCE_LOCAL_CACHE_SIZE", "10000"))
 
-def get_balance_cached(db: Session, user_id: int) -> Optional[models.UserBalance]:
+# После ошибки Redis не читаем из него столько секунд (работаем через локальный кэш).
+# Инвалидация (увеличение версии) пробует Redis всегда: пропущенная инвалидация
+# оставила бы устаревший баланс в кэше других процессов на BALANCE_CACHE_TTL
+REDIS_RETRY_SECONDS = 30
+
+# Версия формата DTO в кэше: при изменении полей старые записи игнорируются
+BALANCE_DTO_FORMAT = 1
+
+# Поля UserBalance, которые отдаются клиенту
+BALANCE_DTO_FIELDS = (
+    "ton_active_balance",
+    "ton_escrow_balance",
+    "ton_referral_earnings",
+    "last_fiat_rate",
+    "fiat_currency",
+    "subscription_limit_24h",
+    "subscriptions_used_24h",
+)
+
+
+class LocalTTLCache:
+    """LRU-кэш процесса с TTL (запасной вариант, когда Redis недоступен)."""
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+
+class BalanceCache:
     """
-    Получение баланса с кэшированием в Redis.
-    Если Redis недоступен, работает напрямую с PostgreSQL.
+    Кэш баланса для отображения в Mini App.
+
+    Запись в Redis - DTO с номером версии. Версия пользователя
+    (balance:ver:{user_id}) увеличивается после каждого commit, изменившего
+    его UserBalance, поэтому DTO, прочитанный из БД до изменения и записанный
+    в кэш после него, при следующем чтении не совпадет по версии и будет
+    проигнорирован. Чтение - один MGET (DTO + версия).
     """
-    cache_key = f"balance:user:{user_id}"
-    
-    # Пытаемся получить из кэша
-    if redis_client:
-        try:
-            cached = redis_client.get(cache_key)
-            if cached:
-                data = json.loads(cached)
-                # Создаем объект баланса из кэша (упрощенная версия)
-                balance = db.query(models.UserBalance).filter(
-                    models.UserBalance.user_id == user_id
-                ).first()
-                if balance:
-                    return balance
-        except Exception as e:
-            print(f"Redis cache error: {e}")
-    
-    # Получаем из БД
-    balance = db.query(models.UserBalance).filter(
-        models.UserBalance.user_id == user_id
-    ).first()
-    
-    # Сохраняем в кэш (TTL 5 минут)
-    if balance and redis_client:
-        try:
-            cache_data = {
-                "ton_active_balance": str(balance.ton_active_balance),
-                "ton_escrow_balance": str(balance.ton_escrow_balance),
-                "ton_referral_earnings": str(balance.ton_referral_earnings),
-            }
-            redis_client.setex(cache_key, 300, json.dumps(cache_data))
-        except Exception as e:
-            print(f"Redis cache set error: {e}")
-    
-    return balance
-
-
-def update_balance_safely(
-    db: Session,
+
+    def __init__(self, client, sync_client=None):
+        self.client = client
+        self.sync_client = sync_client
+        self.local = LocalTTLCache(BALANCE_LOCAL_CACHE_SIZE, BALANCE_LOCAL_CACHE_TTL)
+        self._redis_down_until = 0.0
+
+    @staticmethod
+    def _dto_key(user_id: int) -> str:
+        return f"balance:user:{user_id}"
+
+    @staticmethod
+    def _version_key(user_id: int) -> str:
+        return f"balance:ver:{user_id}"
+
+    @staticmethod
+    def _user_key(telegram_id: int) -> str:
+        return f"balance:tg:{telegram_id}"
+
+    def _redis(self):
+        if self.client is None or time.monotonic() < self._redis_down_until:
+            return None
+        return self.client
+
+    def _redis_failed(self, e: Exception):
+        print(f"Redis cache error: {e}, using in-process cache for {REDIS_RETRY_SECONDS}s")
+        self._redis_down_until = time.monotonic() + REDIS_RETRY_SECONDS
+
+    # --- telegram_id -> user_id (не меняется, кэшируется надолго) -------------
+
+    async def get_user_id(self, telegram_id: int) -> Optional[int]:
+        user_id = self.local.get(("tg", telegram_id))
+        if user_id is not None:
+            return user_id
+        client = self._redis()
+        if client:
+            try:
+                value = await client.get(self._user_key(telegram_id))
+                if value is not None:
+                    self.local.set(("tg", telegram_id), int(value))
+                    return int(value)
+            except Exception as e:
+                self._redis_failed(e)
+        return None
+
+    async def set_user_id(self, telegram_id: int, user_id: int):
+        self.local.set(("tg", telegram_id), user_id)
+        client = self._redis()
+        if client:
+            try:
+                await client.setex(self._user_key(telegram_id), 86400, user_id)
+            except Exception as e:
+                self._redis_failed(e)
+
+    # --- DTO баланса -------------------------------------------------------
+
+    async def current_version(self, user_id: int) -> int:
+        """Версия, которую нужно прочитать ДО чтения баланса из БД и передать в set()."""
+        client = self._redis()
+        if client:
+            try:
+                return int(await client.get(self._version_key(user_id)) or 0)
+            except Exception as e:
+                self._redis_failed(e)
+        return 0
+
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        client = self._redis()
+        if client:
+            try:
+                raw, version = await client.mget(self._dto_key(user_id), self._version_key(user_id))
+                if raw:
+                    dto = json.loads(raw)
+                    if dto.get("format") == BALANCE_DTO_FORMAT and dto.get("version") == int(version or 0):
+                        return dto
+                return None
+            except Exception as e:
+                self._redis_failed(e)
+        return self.local.get(("balance", user_id))
+
+    async def set(self, user_id: int, balance: models.UserBalance, version: int) -> Dict[str, Any]:
+        dto = {field: getattr(balance, field) for field in BALANCE_DTO_FIELDS}
+        dto = {key: str(value) if isinstance(value, Decimal) else value for key, value in dto.items()}
+        dto["format"] = BALANCE_DTO_FORMAT
+        dto["version"] = version
+        self.local.set(("balance", user_id), dto)
+        client = self._redis()
+        if client:
+            try:
+                await client.setex(self._dto_key(user_id), BALANCE_CACHE_TTL, json.dumps(dto))
+            except Exception as e:
+                self._redis_failed(e)
+        return dto
+
+    def _queue_invalidation(self, pipe, user_ids: Iterable[int]):
+        for user_id in user_ids:
+            pipe.incr(self._version_key(user_id))
+            pipe.expire(self._version_key(user_id), 7 * 86400)
+            pipe.delete(self._dto_key(user_id))
+
+    def invalidate_local(self, user_ids: Iterable[int]):
+        for user_id in user_ids:
+            self.local.delete(("balance", user_id))
+
+    async def invalidate(self, user_ids: Iterable[int]):
+        user_ids = list(user_ids)
+        self.invalidate_local(user_ids)
+        client = self.client
+        if client:
+            try:
+                async with client.pipeline() as pipe:
+                    self._queue_invalidation(pipe, user_ids)
+                    await pipe.execute()
+            except Exception as e:
+                self._redis_failed(e)
+
+    def invalidate_sync(self, user_ids: Iterable[int]):
+        """То же для кода без event loop (синхронные сессии в потоках)."""
+        user_ids = list(user_ids)
+        self.invalidate_local(user_ids)
+        client = self.sync_client
+        if client:
+            try:
+                pipe = client.pipeline()
+                self._queue_invalidation(pipe, user_ids)
+                pipe.execute()
+            except Exception as e:
+                self._redis_failed(e)
+
+
+balance_cache = BalanceCache(redis_client, redis_sync_client)
+
+# Инвалидация после commit: любая сессия (API, фоновые задачи, админка), изменившая
+# UserBalance, сбрасывает кэш этих пользователей. Изменения собираются при flush,
+# а применяются только после успешного commit. Синхронная сессия увеличивает версии
+# в Redis прямо в after_commit; асинхронная - в AppAsyncSession.commit(), который
+# дожидается этого до возврата, поэтому ответ API не уходит раньше инвалидации.
+@event.listens_for(Session, "after_flush")
+def _collect_changed_balances(session, flush_context):
+    changed = session.info.setdefault("changed_balance_user_ids", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, models.UserBalance) and obj.user_id is not None:
+            changed.add(obj.user_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_balances(session):
+    user_ids = session.info.pop("changed_balance_user_ids", None)
+    if not user_ids:
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # Синхронная сессия в потоке: блокирующий вызов не задерживает event loop
+        balance_cache.invalidate_sync(user_ids)
+        return
+    balance_cache.invalidate_local(user_ids)
+    session.info.setdefault("committed_balance_user_ids", set()).update(user_ids)
+
+
+async def _bump_balance_versions(session):
+    user_ids = session.info.pop("committed_balance_user_ids", None)
+    if user_ids:
+        await balance_cache.invalidate(user_ids)
+
+
+async_after_commit_hooks.append(_bump_balance_versions)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_balances(session):
+    session.info.pop("changed_balance_user_ids", None)
+
+
+async def get_balance_cached(db: AsyncSession, user_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Баланс пользователя для отображения: DTO из кэша (Redis или локальный),
+    при промахе - из БД с записью в кэш.
+    """
+    dto = await balance_cache.get(user_id)
+    if dto is not None:
+        return dto
+
+    version = await balance_cache.current_version(user_id)
+    balance = await db.scalar(
+        select(models.UserBalance).where(models.UserBalance.user_id == user_id)
+    )
+    if balance is None:
+        return None
+    return await balance_cache.set(user_id, balance, version)
+
+
+async def update_balance_safely(
+    db: AsyncSession,
     user_id: int,
     amount: Decimal,
-    balance_type: str = "active"  # active, escrow, referral
+    balance_type: str = "active",  # active, escrow, referral
+    reason: str = "adjustment",
+    ref_id: Optional[object] = None
 ) -> bool:
     """
-    Безопасное обновление баланса с защитой от race conditions.
-    Использует SELECT FOR UPDATE для блокировки строки.
-    
+    Одиночное изменение баланса отдельной транзакцией (SELECT FOR UPDATE + commit).
+    Если за одно действие меняется несколько балансов, используйте
+    BalanceChangeSet и один commit в вызывающем коде.
+
     Args:
-        db: SQLAlchemy session
+        db: SQLAlchemy AsyncSession
         user_id: ID пользователя
         amount: Сумма для изменения (может быть отрицательной)
         balance_type: Тип баланса (active, escrow, referral)
-    
+        reason: Причина изменения для журнала балансов
+        ref_id: ID задания / транзакции для журнала балансов
+
     Returns:
         True если успешно, False если ошибка
     """
     try:
-        # Блокируем строку для обновления (SELECT FOR UPDATE)
-        # Это предотвращает race conditions при одновременных обновлениях
-        balance = db.execute(
-            select(models.UserBalance)
-            .where(models.UserBalance.user_id == user_id)
-            .with_for_update()
-        ).scalar_one_or_none()
-        
-        if not balance:
+        changes = BalanceChangeSet().add(user_id, amount, balance_type, reason=reason, ref_id=ref_id)
+        balances = await changes.apply(db)
+        if user_id not in balances:
             return False
-        
-        # Обновляем соответствующий баланс
-        if balance_type == "active":
-            balance.ton_active_balance += amount
-        elif balance_type == "escrow":
-            balance.ton_escrow_balance += amount
-        elif balance_type == "referral":
-            balance.ton_referral_earnings += amount
-        
-        db.commit()
-        
-        # Инвалидируем кэш
-        if redis_client:
-            cache_key = f"balance:user:{user_id}"
-            try:
-                redis_client.delete(cache_key)
-            except:
-                pass
-        
+
+        # Кэш сбрасывается автоматически после commit (_invalidate_changed_balances)
+        await db.commit()
         return True
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Error updating balance: {e}")
         return False
 
 
-def invalidate_balance_cache(user_id: int):
-    """Инвалидация кэша баланса пользователя"""
-    if redis_client:
-        cache_key = f"balance:user:{user_id}"
-        try:
-            redis_client.delete(cache_key)
-        except:
-            pass
-
+async def invalidate_balance_cache(user_id: int):
+    """Инвалидация кэша баланса пользователя (для изменений в обход ORM)"""
+    await balance_cache.invalidate([user_id])
@@ -2,7 +2,7 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from app.database import engine, Base
-from app.routers import users, tasks, balance, admin, ton
+from app.routers import users, tasks, balance, admin, ton, telegram
 from sqladmin import Admin
 from app.admin import UserAdmin, UserBalanceAdmin, UserTaskAdmin, TaskAdminView, DashboardView, ProfitView, ComplaintsView, BanUserView
 from app.auth_admin import authentication_backend
@@ -118,6 +118,13 @@ admin_panel.add_view(TaskAdminView)
 admin_panel.add_view(UserTaskAdmin)
 
 
+# Бюджет SQL-запросов на эндпоинт (см. app/query_budget.py)
+from app.database import async_engine
+from app import query_budget
+query_budget.install(async_engine, engine)
+app.add_middleware(BaseHTTPMiddleware, dispatch=query_budget.query_budget_middleware)
+
+
 # CORS для Telegram Mini App
 # CORS: разрешаем все источники, чтобы не ломались preflight-запросы в WebApp
 cors_origins = os.getenv("CORS_ORIGINS", "https://t.me,https://web.telegram.org").split(",")
@@ -131,6 +138,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],  # пагинация ленты заданий
     max_age=3600,
 )
 
@@ -140,6 +148,7 @@ app.include_router(tasks.router, prefix="/api/tasks", tags=["tasks"])
 app.include_router(balance.router, prefix="/api/balance", tags=["balance"])
 app.include_router(admin.router, prefix="/api/admin", tags=["admin"])
 app.include_router(ton.router, prefix="/api/ton", tags=["ton"])
+app.include_router(telegram.router, prefix="/api/telegram", tags=["telegram"])
 
 @app.get("/")
 async def root():
@@ -152,8 +161,9 @@ async def health():
 
 # Фоновая задача для обновления статусов TON транзакций
 import asyncio
+import sys
 from app.ton_service import get_ton_service
-from app.database import SessionLocal
+from app.database import AsyncSessionLocal
 
 async def update_ton_transactions_periodically():
     """Периодически обновляет статусы pending транзакций и обрабатывает pending withdrawals."""
@@ -165,14 +175,14 @@ async def update_ton_transactions_periodically():
                 # TON сервис не настроен, пропускаем
                 await asyncio.sleep(300)  # Проверяем реже, если не настроено
                 continue
-            db = SessionLocal()
+            db = AsyncSessionLocal()
             try:
                 # Сначала обрабатываем pending withdrawals (попытки отправить)
                 await service.process_pending_withdrawals(db)
                 # Затем обновляем статусы уже отправленных транзакций
                 await service.update_pending_transactions(db)
             finally:
-                db.close()
+                await db.close()
         except Exception as e:
             import traceback
             print(f"Error in update_ton_transactions_periodically: {e}", file=sys.stderr, flush=True)
@@ -202,7 +212,7 @@ async def check_deposits_periodically():
                 continue
             
             print("🔍 Проверка входящих депозитов...", file=sys.stderr, flush=True)
-            db = SessionLocal()
+            db = AsyncSessionLocal()
             try:
                 await service.check_incoming_deposits(db)
                 print("✅ Проверка депозитов завершена", file=sys.stderr, flush=True)
@@ -211,7 +221,7 @@ async def check_deposits_periodically():
                 print(f"❌ Ошибка при проверке депозитов: {deposit_error}", file=sys.stderr, flush=True)
                 traceback.print_exc()
             finally:
-                db.close()
+                await db.close()
         except Exception as e:
             # Не спамим логи обычными ошибками
             import sys, traceback
@@ -222,6 +232,9 @@ async def check_deposits_periodically():
             await asyncio.sleep(120)  # При ошибке ждем дольше
 
 
+# Фоновые задачи приложения (отменяются при остановке)
+background_tasks = []
+
 @app.on_event("startup")
 async def startup_event():
     """Запускаем фоновые задачи при старте приложения."""
@@ -229,19 +242,20 @@ async def startup_event():
     print("🚀 Запуск приложения...")
     
     # Удаляем тестовые задания и примеры при старте
-    from app.database import SessionLocal
+    from app.database import AsyncSessionLocal
+    from sqlalchemy import select, delete
     from app.models import Task, User, UserTask, TonTransaction, UserBalance
     from datetime import datetime, timedelta
     from decimal import Decimal
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Помечаем старые pending транзакции без tx_hash как failed
         # Средства НЕ списывались, так что возвращать нечего
         print("🔄 Checking for old pending transactions without tx_hash...", file=sys.stderr, flush=True)
-        old_pending_txs = db.query(TonTransaction).filter(
+        old_pending_txs = (await db.scalars(select(TonTransaction).where(
             TonTransaction.status == "pending",
             TonTransaction.tx_hash.is_(None)
-        ).all()
+        ))).all()
         
         failed_count = 0
         for tx in old_pending_txs:
@@ -255,59 +269,91 @@ async def startup_event():
                 tx.error_message = f"Transaction failed on startup: could not send after {time_since_creation}. Funds were never deducted."
                 failed_count += 1
                 if tx.user_id:
-                    user = db.query(User).filter(User.id == tx.user_id).first()
+                    user = await db.scalar(select(User).where(User.id == tx.user_id))
                     if user:
                         print(f"⚠️ Startup: Marked transaction {tx.id} as failed for user {user.telegram_id} (funds were never deducted)", file=sys.stderr, flush=True)
         
         if failed_count > 0:
-            db.commit()
+            await db.commit()
             print(f"✅ Startup: Marked {failed_count} old pending transactions as failed (funds were never deducted)", file=sys.stderr, flush=True)
         
         # Удаляем тестовые задания (is_test=True)
-        test_tasks = db.query(Task).filter(Task.is_test == True).all()
+        test_tasks = (await db.scalars(select(Task).where(Task.is_test == True))).all()
         test_count = len(test_tasks)
         for task in test_tasks:
             # Удаляем связанные UserTask записи
-            db.query(UserTask).filter(UserTask.task_id == task.id).delete()
-            db.delete(task)
+            await db.execute(delete(UserTask).where(UserTask.task_id == task.id))
+            await db.delete(task)
         
         # Удаляем примеры заданий (созданные тестовыми пользователями - telegram_id <= 0)
-        test_users = db.query(User).filter(User.telegram_id <= 0).all()
+        test_users = (await db.scalars(select(User).where(User.telegram_id <= 0))).all()
         example_count = 0
         if test_users:
             test_user_ids = [u.id for u in test_users]
-            example_tasks = db.query(Task).filter(
+            example_tasks = (await db.scalars(select(Task).where(
                 Task.creator_id.in_(test_user_ids)
-            ).all()
+            ))).all()
             example_count = len(example_tasks)
             for task in example_tasks:
                 # Удаляем связанные UserTask записи
-                db.query(UserTask).filter(UserTask.task_id == task.id).delete()
-                db.delete(task)
+                await db.execute(delete(UserTask).where(UserTask.task_id == task.id))
+                await db.delete(task)
             if example_count > 0:
                 print(f"🗑️ Удалено {example_count} примеров заданий")
         
-        db.commit()
+        await db.commit()
         if test_count > 0:
             print(f"🗑️ Удалено {test_count} тестовых заданий")
         # Убрано сообщение о том, что тестовые задания не найдены - это нормально
     except Exception as e:
         print(f"⚠️ Ошибка при удалении тестовых заданий: {e}")
-        db.rollback()
+        await db.rollback()
     finally:
-        db.close()
+        await db.close()
     
     print("🔄 Запуск фоновых задач...")
-    asyncio.create_task(update_ton_transactions_periodically())
-    asyncio.create_task(check_deposits_periodically())
+    background_tasks.append(asyncio.create_task(update_ton_transactions_periodically()))
+    background_tasks.append(asyncio.create_task(check_deposits_periodically()))
+    
+    # Ингестия обновлений админ-бота: комментарии из групп обсуждений сохраняются в БД
+    # В режиме webhook обновления приходят в /api/telegram/webhook/*, getUpdates не используется
+    from app.telegram_webhook import telegram_webhook, webhook_enabled
+    if webhook_enabled():
+        try:
+            await telegram_webhook.start()
+        except Exception as e:
+            print(f"❌ Error starting Telegram webhook: {e}", file=sys.stderr, flush=True)
+    else:
+        from app.telegram_updates import run_update_ingestion
+        background_tasks.append(asyncio.create_task(run_update_ingestion()))
     
-    # Запускаем проверку комментариев (каждые 5 минут)
-    from app.comment_validator import run_comment_checker_periodically, run_subscription_checker_daily
-    asyncio.create_task(run_comment_checker_periodically())
+    # Воркер очереди валидации комментариев и подписок (задания разбираются между процессами через аренду)
+    from app.validation_jobs import run_validation_worker
+    background_tasks.append(asyncio.create_task(run_validation_worker()))
     
-    # Запускаем ежедневную проверку подписок (раз в день)
-    asyncio.create_task(run_subscription_checker_daily())
+    # Перепроверки выполненных заданий (комментарии - час, подписки - 7 дней) по next_check_at
+    from app.recheck_scheduler import recheck_scheduler
+    background_tasks.append(asyncio.create_task(recheck_scheduler.run()))
     
     print("✅ Фоновые задачи запущены")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Останавливаем фоновые задачи и закрываем соединения с Telegram Bot API."""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    
+    from app.telegram_webhook import telegram_webhook
+    await telegram_webhook.stop()
+    
+    from app.telegram_clients import shutdown_bots
+    await shutdown_bots()
+    
+    from app import ton_service
+    if ton_service.ton_service_singleton is not None:
+        await ton_service.ton_service_singleton.close()
+
+
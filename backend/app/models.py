@@ -1,9 +1,15 @@
-from sqlalchemy import Column, Integer, String, BigInteger, Boolean, DateTime, ForeignKey, Numeric, Text, Enum as SQLEnum
+from sqlalchemy import Column, Integer, String, BigInteger, Boolean, DateTime, ForeignKey, Numeric, Text, Index, Enum as SQLEnum, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
 import enum
 
+
+def partial_index(name: str, *columns: str, where: str) -> Index:
+    """Частичный индекс - тот же, что в database_indexes.sql (Postgres и SQLite)."""
+    return Index(name, *columns, postgresql_where=text(where), sqlite_where=text(where))
+
+
 class TaskType(str, enum.Enum):
     SUBSCRIPTION = "subscription"
     COMMENT = "comment"
@@ -84,6 +90,36 @@ class UserBalance(Base):
     
     user = relationship("User", back_populates="balance")
 
+class BalanceJournal(Base):
+    """Журнал изменений баланса (append-only). Каждое изменение баланса пишет сюда дельту."""
+    __tablename__ = "balance_journal"
+    __table_args__ = (
+        # Инкрементальная сверка читает записи пользователя после watermark
+        Index("ix_balance_journal_user_id_id", "user_id", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)  # Монотонный, используется как watermark
+    user_id = Column(Integer, ForeignKey("user_balances.user_id"), nullable=False)
+    balance_type = Column(String(20), nullable=False)  # active, escrow
+    delta_nano = Column(Numeric(20, 0), nullable=False)  # Может быть отрицательной
+    reason = Column(String(50), nullable=False)  # deposit, withdrawal, task_budget, task_reward, ...
+    ref_id = Column(String(255), nullable=True)  # ID задания / транзакции / хэш депозита
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Связь нужна и для порядка flush: UPDATE user_balances (блокировка строки)
+    # выполняется раньше INSERT в журнал
+    balance = relationship("UserBalance")
+
+class BalanceSnapshot(Base):
+    """Снапшот журнала: сумма всех записей пользователя до last_journal_id (watermark)"""
+    __tablename__ = "balance_snapshots"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    ton_active_balance = Column(Numeric(20, 0), default=0)
+    ton_escrow_balance = Column(Numeric(20, 0), default=0)
+    last_journal_id = Column(Integer, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
 class Task(Base):
     __tablename__ = "tasks"
     
@@ -104,6 +140,7 @@ class Task(Base):
     price_per_slot_ton = Column(Numeric(20, 0), nullable=False)  # В нано-TON
     total_slots = Column(Integer, nullable=False)
     completed_slots = Column(Integer, default=0)
+    reserved_slots = Column(Integer, default=0, server_default="0", nullable=False)  # Занято исполнителями в статусе IN_PROGRESS
     
     # Информация о задании
     telegram_channel_id = Column(String, nullable=True)  # Для подписки/комментария
@@ -121,6 +158,12 @@ class Task(Base):
 
 class UserTask(Base):
     __tablename__ = "user_tasks"
+    __table_args__ = (
+        # Лента исключает задания, которые пользователь уже брал (index-only scan по user_id)
+        Index("ix_user_tasks_user_id_task_id", "user_id", "task_id"),
+        # Планировщик перепроверок читает только строки, срок которых наступил
+        partial_index("ix_user_tasks_next_check_at", "next_check_at", where="next_check_at IS NOT NULL"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -136,6 +179,8 @@ class UserTask(Base):
     # Валидация
     validated_at = Column(DateTime(timezone=True), nullable=True)
     validation_result = Column(Boolean, nullable=True)
+    # Следующая перепроверка выполненного задания (NULL - окно перепроверки закончилось)
+    next_check_at = Column(DateTime(timezone=True), nullable=True)
     
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
@@ -143,6 +188,27 @@ class UserTask(Base):
     user = relationship("User", back_populates="user_tasks")
     task = relationship("Task", back_populates="user_tasks")
 
+class ValidationJob(Base):
+    """
+    Задание на валидацию заявки IN_PROGRESS (комментарий/подписка).
+    Воркеры забирают строки через SELECT ... FOR UPDATE SKIP LOCKED и держат
+    аренду (locked_until), продлевая ее heartbeat'ом, пока идет проверка.
+    """
+    __tablename__ = "validation_jobs"
+    __table_args__ = (
+        Index("ix_validation_jobs_run_at", "run_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_task_id = Column(Integer, ForeignKey("user_tasks.id"), nullable=False, unique=True)
+    run_at = Column(DateTime(timezone=True), nullable=False)  # Когда проверять следующий раз
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    locked_by = Column(String(100), nullable=True)  # Воркер, взявший задание
+    locked_until = Column(DateTime(timezone=True), nullable=True)  # Конец аренды
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class Referral(Base):
     __tablename__ = "referrals"
     
@@ -203,16 +269,33 @@ class ProfitWithdrawal(Base):
 
 class TonTransaction(Base):
     __tablename__ = "ton_transactions"
+    __table_args__ = (
+        # Опрос подтверждений и повторная отправка читают только pending строки
+        partial_index("ix_ton_transactions_next_poll_at", "next_poll_at", where="status = 'pending'"),
+        partial_index("ix_ton_transactions_next_attempt_at", "next_attempt_at", where="status = 'pending' AND tx_hash IS NULL"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # Опционально для админских выводов
     to_address = Column(String(255), nullable=False)
+    # Адрес в канонической форме "workchain:hex" (app/ton_address.py); NULL - адрес не разбирается
+    to_address_canonical = Column(String(80), nullable=True, index=True)
     amount_nano = Column(Numeric(20, 0), nullable=False)
-    status = Column(String(50), default="pending")  # pending, completed, failed
-    tx_hash = Column(String(255), nullable=True, index=True)
+    status = Column(String(50), default="pending")  # pending, sent_unrecorded (отправлен, средства еще не списаны), completed, failed
+    tx_hash = Column(String(255), nullable=True, index=True)  # У выводов одного пакета общий
     idempotency_key = Column(String(255), unique=True, nullable=False)
     error_message = Column(Text, nullable=True)
     notes = Column(Text, nullable=True)  # Заметки администратора
+    # Пакетная отправка: несколько выводов в одном внешнем сообщении (NULL - отправлен отдельно)
+    batch_id = Column(String(32), nullable=True, index=True)
+    message_index = Column(Integer, nullable=True)  # Номер перевода во внешнем сообщении пакета
+    # Опрос подтверждения отправленного вывода: когда проверять и сколько раз уже проверяли
+    next_poll_at = Column(DateTime(timezone=True), nullable=True)  # NULL - проверить при ближайшем проходе
+    poll_attempts = Column(Integer, default=0, server_default="0", nullable=False)
+    # Повторная отправка неотправленного вывода: сколько попыток было, когда следующая, класс последней ошибки
+    send_attempts = Column(Integer, default=0, server_default="0", nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)  # NULL - отправить при ближайшем проходе
+    last_error_class = Column(String(100), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -226,6 +309,7 @@ class Deposit(Base):
     id = Column(Integer, primary_key=True, index=True)
     tx_hash = Column(String(255), unique=True, nullable=False, index=True)
     from_address = Column(String(255), nullable=False)
+    from_address_canonical = Column(String(80), nullable=True, index=True)  # "workchain:hex", см. app/ton_address.py
     amount_nano = Column(Numeric(20, 0), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # Определяется по комментарию
     telegram_id_from_comment = Column(String(50), nullable=True)  # Telegram ID из комментария транзакции
@@ -234,3 +318,83 @@ class Deposit(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     user = relationship("User", backref="deposits")
+
+
+class DiscussionMessage(Base):
+    """Сообщения из групп обсуждений каналов (комментарии к постам), сохраняются ингестией обновлений бота"""
+    __tablename__ = "discussion_messages"
+    __table_args__ = (
+        # Проверка комментария - один поиск по индексу
+        Index("ix_discussion_messages_chat_reply_user", "chat_id", "reply_to_message_id", "from_user_id"),
+        Index("ix_discussion_messages_username_reply_user", "chat_username", "reply_to_message_id", "from_user_id"),
+        # Защита от повторной записи одного сообщения
+        Index("ix_discussion_messages_source", "source_chat_id", "message_id", unique=True),
+        Index("ix_discussion_messages_created_at", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    # Чат, где написано сообщение (группа обсуждения)
+    source_chat_id = Column(BigInteger, nullable=False)
+    message_id = Column(Integer, nullable=False)
+    # Канал и пост, к которым относится комментарий (для обычных сообщений - сам чат и ответ)
+    chat_id = Column(BigInteger, nullable=False)
+    chat_username = Column(String(255), nullable=True)  # В нижнем регистре, без @
+    reply_to_message_id = Column(Integer, nullable=True)
+    from_user_id = Column(BigInteger, nullable=True)
+    text = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ChannelMemberEvent(Base):
+    """Выходы пользователей из каналов (chat_member обновления админ-бота)"""
+    __tablename__ = "channel_member_events"
+    __table_args__ = (
+        Index("ix_channel_member_events_chat_user", "chat_id", "user_telegram_id"),
+        # Необработанные события
+        partial_index("ix_channel_member_events_processed_at", "processed_at", where="processed_at IS NULL"),
+        Index("ix_channel_member_events_created_at", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(BigInteger, nullable=False)
+    chat_username = Column(String(255), nullable=True)  # В нижнем регистре, без @
+    user_telegram_id = Column(BigInteger, nullable=False)
+    old_status = Column(String(20), nullable=False)
+    new_status = Column(String(20), nullable=False)
+    event_at = Column(DateTime(timezone=True), nullable=False)  # Время события по данным Telegram
+    processed_at = Column(DateTime(timezone=True), nullable=True)  # Когда по событию вернули эскроу
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ChainCursor(Base):
+    """Курсор сканирования транзакций кошелька: все транзакции с lt <= last_lt уже обработаны"""
+    __tablename__ = "chain_cursors"
+
+    name = Column(String(150), primary_key=True)  # deposits:<адрес кошелька>
+    last_lt = Column(BigInteger, nullable=False, default=0)
+    last_hash = Column(String(255), nullable=True)  # Hash транзакции last_lt (hex)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class WalletSeqno(Base):
+    """Локальный счетчик seqno сервисного кошелька (см. app/wallet_seqno.py)"""
+    __tablename__ = "wallet_seqnos"
+
+    wallet_address = Column(String(255), primary_key=True)
+    seqno = Column(Integer, nullable=False, default=0)  # Seqno для следующей отправки
+    # Отправка не удалась или сообщение не исполнилось - следующая отправка перечитает seqno из сети
+    resync_required = Column(Boolean, nullable=False, default=False)
+    synced_at = Column(DateTime(timezone=True), nullable=True)  # Когда seqno последний раз читался из сети
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class TelegramUpdateOffset(Base):
+    """Последний обработанный update_id бота (getUpdates продолжается с него после рестарта)"""
+    __tablename__ = "telegram_update_offsets"
+
+    bot_name = Column(String(50), primary_key=True)
+    last_update_id = Column(BigInteger, nullable=False, default=0)
+    # Аренда опроса getUpdates: Telegram допускает одного потребителя на токен
+    lease_owner = Column(String(32), nullable=True)
+    lease_until = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -0,0 +1,117 @@
+"""
+Бюджет SQL-запросов на HTTP-запрос.
+
+Хук SQLAlchemy (before_cursor_execute) считает выполненные statements в рамках
+текущего HTTP-запроса. Эндпоинт объявляет свой бюджет декоратором @query_budget(N),
+middleware после ответа сравнивает счетчик с бюджетом:
+- QUERY_BUDGET_MODE=warn (по умолчанию) - предупреждение в лог со списком запросов;
+- QUERY_BUDGET_MODE=strict - исключение QueryBudgetExceeded (для тестов и staging);
+- QUERY_BUDGET_MODE=off - проверка отключена.
+
+Диагностика, которая нужна только при отладке (лишние COUNT и т.п.), запускается
+через debug_sampled() - с вероятностью QUERY_DEBUG_SAMPLE_RATE (по умолчанию 0) -
+и в бюджет не засчитывается (блок with unmetered()).
+"""
+import contextvars
+import os
+import random
+import sys
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from sqlalchemy import event
+
+QUERY_BUDGET_MODE = os.getenv("QUERY_BUDGET_MODE", "warn").lower()
+QUERY_DEBUG_SAMPLE_RATE = float(os.getenv("QUERY_DEBUG_SAMPLE_RATE", "0"))
+
+# Сколько SQL показывать в предупреждении о превышении бюджета
+MAX_LOGGED_STATEMENTS = 20
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+@dataclass
+class QueryCounter:
+    count: int = 0
+    statements: List[str] = field(default_factory=list)
+    paused: int = 0
+
+
+_current_counter: contextvars.ContextVar[Optional[QueryCounter]] = contextvars.ContextVar(
+    "query_budget_counter", default=None
+)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    counter = _current_counter.get()
+    if counter is None or counter.paused:
+        return
+    counter.count += 1
+    if len(counter.statements) < MAX_LOGGED_STATEMENTS:
+        counter.statements.append(" ".join(statement.split())[:200])
+
+
+def install(*engines):
+    """Подключает счетчик к движкам (для AsyncEngine - к его sync_engine)."""
+    for engine in engines:
+        target = getattr(engine, "sync_engine", engine)
+        if not event.contains(target, "before_cursor_execute", _before_cursor_execute):
+            event.listen(target, "before_cursor_execute", _before_cursor_execute)
+
+
+def query_budget(max_queries: int):
+    """
+    Декоратор эндпоинта: объявляет максимальное число SQL-запросов на один вызов.
+    Ставится под @router.get/post, функция возвращается без изменений.
+    """
+    def decorator(func):
+        func.__query_budget__ = max_queries
+        return func
+    return decorator
+
+
+@contextmanager
+def unmetered():
+    """Запросы внутри блока не засчитываются в бюджет (отладочная диагностика)."""
+    counter = _current_counter.get()
+    if counter is not None:
+        counter.paused += 1
+    try:
+        yield
+    finally:
+        if counter is not None:
+            counter.paused -= 1
+
+
+def debug_sampled() -> bool:
+    """Включать ли отладочную диагностику для текущего запроса."""
+    return QUERY_DEBUG_SAMPLE_RATE > 0 and random.random() < QUERY_DEBUG_SAMPLE_RATE
+
+
+async def query_budget_middleware(request, call_next):
+    """HTTP middleware: считает запросы к БД и проверяет бюджет эндпоинта."""
+    if QUERY_BUDGET_MODE == "off":
+        return await call_next(request)
+
+    counter = QueryCounter()
+    token = _current_counter.set(counter)
+    try:
+        response = await call_next(request)
+    finally:
+        _current_counter.reset(token)
+
+    # endpoint появляется в scope после роутинга
+    endpoint = request.scope.get("endpoint")
+    budget = getattr(endpoint, "__query_budget__", None)
+    if budget is not None and counter.count > budget:
+        route = getattr(request.scope.get("route"), "path", request.url.path)
+        message = f"{request.method} {route}: {counter.count} SQL queries, budget {budget}"
+        if QUERY_BUDGET_MODE == "strict":
+            raise QueryBudgetExceeded(message + "\n" + "\n".join(counter.statements))
+        print(f"⚠️ [QUERY BUDGET] {message}", file=sys.stderr, flush=True)
+        for statement in counter.statements:
+            print(f"    {statement}", file=sys.stderr, flush=True)
+    return response
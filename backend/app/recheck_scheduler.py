@@ -0,0 +1,283 @@
+"""
+Планировщик повторных проверок выполненных заданий.
+
+После валидации задание перепроверяется в течение окна: комментарий - в течение
+часа со все большими интервалами (через 5, 10, 20 и 40 минут после валидации),
+подписка - раз в день в течение 7 дней. Время следующей
+проверки хранится в user_tasks.next_check_at (частичный индекс по NOT NULL),
+по окончании окна или при переходе задания в FAILED поле обнуляется и строка
+больше не читается.
+
+Воркер держит в памяти кучу (next_check_at, user_task_id) только для строк,
+срок которых наступает в ближайшие RECHECK_HORIZON_SECONDS, и спит до срока
+ближайшей. Куча пополняется диапазонным чтением по индексу, поэтому за проход
+читаются только строки, которые пора проверять, а не все выполненные задания.
+Задания, подтвержденные в этом процессе, попадают в кучу сразу (push после
+commit), назначенные другими процессами - при следующем чтении горизонта.
+
+Удаление комментария видно только через живую проверку сообщения в служебном
+чате (telegram_updates.message_still_exists) - два запроса к Bot API и копия
+чужого сообщения, поэтому проверок мало и они идут все реже. Если TELEGRAM_COMMENT_PROBE_CHAT_ID
+не задан, комментарии не перепроверяются: уже назначенные проверки снимаются.
+
+Отписки обнаруживаются по событиям chat_member (comment_validator.process_leave_events),
+поэтому get_chat_member при плановой проверке подписки вызывается только для
+случайной выборки SUBSCRIPTION_AUDIT_SAMPLE_RATE - как аудит на случай
+пропущенных событий. Остальные подписки просто переносятся на следующий день.
+
+Планировщик работает в каждом процессе API. Строку проверяет тот процесс,
+который первым сдвинул ее next_check_at на RECHECK_LEASE_SECONDS вперед
+(условный UPDATE ... WHERE next_check_at <= now RETURNING id) - это аренда:
+если процесс упал, строка снова станет due по окончании аренды.
+"""
+import asyncio
+import heapq
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+from app.database import AsyncSessionLocal
+from app.telegram_updates import comment_probe_enabled
+
+# Интервал и окно перепроверки по типу задания
+COMMENT_RECHECK_INTERVAL = timedelta(minutes=5)
+COMMENT_RECHECK_WINDOW = timedelta(hours=1)
+SUBSCRIPTION_RECHECK_INTERVAL = timedelta(days=1)
+SUBSCRIPTION_RECHECK_WINDOW = timedelta(days=7)
+
+# Если Bot API не ответил, подписка перепроверяется раньше суточного интервала
+SUBSCRIPTION_RETRY_INTERVAL = timedelta(minutes=15)
+
+# Доля плановых проверок подписок, которые действительно идут в Bot API (аудит)
+SUBSCRIPTION_AUDIT_SAMPLE_RATE = float(os.getenv("SUBSCRIPTION_AUDIT_SAMPLE_RATE", "0.05"))
+
+# На сколько вперед загружать строки в кучу и сколько строк за одно чтение
+RECHECK_HORIZON_SECONDS = int(os.getenv("RECHECK_HORIZON_SECONDS", "600"))
+RECHECK_BATCH_SIZE = int(os.getenv("RECHECK_BATCH_SIZE", "500"))
+RECHECK_LEASE_SECONDS = int(os.getenv("RECHECK_LEASE_SECONDS", "600"))
+
+RECHECK_SCHEDULE = {
+    models.TaskType.SUBSCRIPTION: (SUBSCRIPTION_RECHECK_INTERVAL, SUBSCRIPTION_RECHECK_WINDOW),
+}
+if comment_probe_enabled():
+    RECHECK_SCHEDULE[models.TaskType.COMMENT] = (COMMENT_RECHECK_INTERVAL, COMMENT_RECHECK_WINDOW)
+
+# Интервал до следующей проверки равен времени, прошедшему с валидации (но не меньше
+# базового интервала), т.е. удваивается: 5, 10, 20, 40 минут - 4 проверки за окно вместо 12
+RECHECK_BACKOFF_TYPES = {models.TaskType.COMMENT}
+
+
+def _naive(value: datetime) -> datetime:
+    return value.replace(tzinfo=None) if value.tzinfo else value
+
+
+def next_check_time(
+    task_type: models.TaskType,
+    validated_at: Optional[datetime],
+    now: Optional[datetime] = None,
+    interval: Optional[timedelta] = None
+) -> Optional[datetime]:
+    """
+    Время следующей проверки или None, если окно перепроверки закончилось
+    (или для этого типа задания перепроверка не нужна).
+    """
+    schedule = RECHECK_SCHEDULE.get(task_type)
+    if not schedule or not validated_at:
+        return None
+    default_interval, window = schedule
+    now = now or datetime.utcnow()
+    if interval is None:
+        interval = default_interval
+        if task_type in RECHECK_BACKOFF_TYPES:
+            interval = max(interval, now - _naive(validated_at))
+    due_at = now + interval
+    if due_at - _naive(validated_at) > window:
+        return None
+    return due_at
+
+
+def schedule_first_check(user_task: models.UserTask, task_type: models.TaskType):
+    """Назначает первую перепроверку только что подтвержденному заданию (commit не делает)."""
+    user_task.next_check_at = next_check_time(task_type, user_task.validated_at, user_task.validated_at)
+
+
+class RecheckScheduler:
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int]] = []
+        self._queued: Set[int] = set()
+        self._loaded_until: Optional[datetime] = None
+        self._wakeup = asyncio.Event()
+
+    def push(self, user_task_id: int, due_at: Optional[datetime]):
+        """
+        Сообщает воркеру о новой дате проверки (после commit).
+        Строки за горизонтом в кучу не попадают - их подхватит следующее чтение.
+        """
+        if due_at is None or user_task_id in self._queued:
+            return
+        if self._loaded_until is None or _naive(due_at) > self._loaded_until:
+            return
+        heapq.heappush(self._heap, (_naive(due_at), user_task_id))
+        self._queued.add(user_task_id)
+        self._wakeup.set()
+
+    async def _load(self, db: AsyncSession, now: datetime):
+        """Догружает в кучу строки со сроком до now + горизонт (диапазон по индексу next_check_at)."""
+        horizon = now + timedelta(seconds=RECHECK_HORIZON_SECONDS)
+        rows = (await db.execute(
+            select(models.UserTask.id, models.UserTask.next_check_at)
+            .where(models.UserTask.next_check_at.isnot(None), models.UserTask.next_check_at <= horizon)
+            .order_by(models.UserTask.next_check_at)
+            .limit(RECHECK_BATCH_SIZE)
+        )).all()
+        for user_task_id, due_at in rows:
+            if user_task_id not in self._queued:
+                heapq.heappush(self._heap, (_naive(due_at), user_task_id))
+                self._queued.add(user_task_id)
+        # Если чтение уперлось в лимит, горизонт - срок последней прочитанной строки
+        self._loaded_until = _naive(rows[-1][1]) if len(rows) == RECHECK_BATCH_SIZE else horizon
+        await db.rollback()
+
+    def _pop_due(self, now: datetime) -> List[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < RECHECK_BATCH_SIZE:
+            _, user_task_id = heapq.heappop(self._heap)
+            self._queued.discard(user_task_id)
+            due.append(user_task_id)
+        return due
+
+    async def run_once(self, db: AsyncSession) -> int:
+        """Проверяет все строки, срок которых наступил. Returns: количество проверенных строк."""
+        now = datetime.utcnow()
+        if self._loaded_until is None or now >= self._loaded_until:
+            await self._load(db, now)
+
+        due_ids = self._pop_due(now)
+        if not due_ids:
+            return 0
+
+        # Аренда: забираем только строки, срок которых не сдвинул другой процесс
+        claimed_ids = (await db.scalars(
+            update(models.UserTask)
+            .where(
+                models.UserTask.id.in_(due_ids),
+                models.UserTask.next_check_at.isnot(None),
+                models.UserTask.next_check_at <= now
+            )
+            .values(next_check_at=now + timedelta(seconds=RECHECK_LEASE_SECONDS))
+            .returning(models.UserTask.id)
+            .execution_options(synchronize_session=False)
+        )).all()
+        await db.commit()
+        if not claimed_ids:
+            return 0
+
+        rows = (await db.execute(
+            select(models.UserTask.id, models.UserTask.status, models.UserTask.validated_at, models.Task.task_type)
+            .join(models.Task, models.Task.id == models.UserTask.task_id)
+            .where(models.UserTask.id.in_(claimed_ids))
+        )).all()
+        await db.rollback()
+
+        by_type: Dict[models.TaskType, List[int]] = {}
+        retired: List[int] = []
+        for row in rows:
+            if row.status != models.UserTaskStatus.COMPLETED or next_check_time(row.task_type, row.validated_at, now, timedelta(0)) is None:
+                retired.append(row.id)
+            else:
+                by_type.setdefault(row.task_type, []).append(row.id)
+
+        from app.comment_validator import check_comment_periodically, recheck_subscriptions
+
+        retry: List[int] = []
+        for user_task_id in by_type.get(models.TaskType.COMMENT, []):
+            await check_comment_periodically(user_task_id, db)
+        subscription_ids = [
+            user_task_id for user_task_id in by_type.get(models.TaskType.SUBSCRIPTION, [])
+            if random.random() < SUBSCRIPTION_AUDIT_SAMPLE_RATE
+        ]
+        if subscription_ids:
+            results = await recheck_subscriptions(db, subscription_ids)
+            retry = [user_task_id for user_task_id, exists in results.items() if exists is None]
+
+        checked = [user_task_id for ids in by_type.values() for user_task_id in ids]
+        await self._reschedule(db, checked, set(retry), retired, now)
+        return len(checked)
+
+    async def _reschedule(self, db: AsyncSession, checked: List[int], retry: Set[int], retired: List[int], now: datetime):
+        """Сдвигает next_check_at проверенных строк; вышедшие из окна и FAILED снимает с расписания."""
+        if retired:
+            await db.execute(
+                update(models.UserTask)
+                .where(models.UserTask.id.in_(retired))
+                .values(next_check_at=None)
+                .execution_options(synchronize_session=False)
+            )
+        rows = (await db.execute(
+            select(models.UserTask.id, models.UserTask.status, models.UserTask.validated_at, models.Task.task_type)
+            .join(models.Task, models.Task.id == models.UserTask.task_id)
+            .where(models.UserTask.id.in_(checked))
+        )).all() if checked else []
+
+        next_times: Dict[int, Optional[datetime]] = {}
+        for row in rows:
+            if row.status != models.UserTaskStatus.COMPLETED:
+                next_times[row.id] = None
+            elif row.id in retry:
+                next_times[row.id] = next_check_time(row.task_type, row.validated_at, now, SUBSCRIPTION_RETRY_INTERVAL)
+            else:
+                next_times[row.id] = next_check_time(row.task_type, row.validated_at, now)
+        # Сроки считаются от одного now, поэтому строк с разными значениями немного - UPDATE на группу
+        groups: Dict[Optional[datetime], List[int]] = {}
+        for user_task_id, due_at in next_times.items():
+            groups.setdefault(due_at, []).append(user_task_id)
+        for due_at, ids in groups.items():
+            await db.execute(
+                update(models.UserTask)
+                .where(models.UserTask.id.in_(ids))
+                .values(next_check_at=due_at)
+                .execution_options(synchronize_session=False)
+            )
+        await db.commit()
+
+        for user_task_id, due_at in next_times.items():
+            self.push(user_task_id, due_at)
+        if retired or next_times:
+            finished = len(retired) + sum(1 for due_at in next_times.values() if due_at is None)
+            print(f"[RECHECK SCHEDULER] Checked {len(next_times)} tasks, {finished} retired from schedule")
+
+    def _sleep_seconds(self) -> float:
+        now = datetime.utcnow()
+        wake_at = self._loaded_until or now
+        if self._heap:
+            wake_at = min(wake_at, self._heap[0][0])
+        return max((wake_at - now).total_seconds(), 1.0)
+
+    async def run(self):
+        """Фоновый цикл: спит до срока ближайшей проверки или до конца загруженного горизонта."""
+        while True:
+            try:
+                async with AsyncSessionLocal() as db:
+                    await self.run_once(db)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._sleep_seconds())
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[RECHECK SCHEDULER] Error in scheduler loop: {e}")
+                # Состояние кучи могло разойтись с БД - перечитываем
+                self._heap.clear()
+                self._queued.clear()
+                self._loaded_until = None
+                await asyncio.sleep(60)
+
+
+recheck_scheduler = RecheckScheduler()
@@ -1,16 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, select, delete
 from app.database import get_db
 from app import models
+from app.balance_ledger import apply_balance_delta
+from app.task_index import task_index
 
 router = APIRouter()
 
 @router.post("/init-test-tasks")
-async def init_test_tasks(db: Session = Depends(get_db)):
+async def init_test_tasks(db: AsyncSession = Depends(get_db)):
     """Инициализация тестовых заданий (для разработки)"""
     # Создаем тестового пользователя-создателя, если его нет
-    test_creator = db.query(models.User).filter(models.User.telegram_id == 0).first()
+    test_creator = await db.scalar(select(models.User).where(models.User.telegram_id == 0))
     if not test_creator:
         test_creator = models.User(
             telegram_id=0,
@@ -19,8 +21,8 @@ async def init_test_tasks(db: Session = Depends(get_db)):
             role=models.UserRole.OWNER
         )
         db.add(test_creator)
-        db.commit()
-        db.refresh(test_creator)
+        await db.commit()
+        await db.refresh(test_creator)
     
     # Список тестовых заданий
     test_tasks = [
@@ -229,12 +231,12 @@ async def init_test_tasks(db: Session = Depends(get_db)):
     created_count = 0
     for task_data in test_tasks:
         # Проверяем, существует ли уже такое задание
-        existing = db.query(models.Task).filter(
+        existing = await db.scalar(select(models.Task).where(
             and_(
                 models.Task.title == task_data["title"],
                 models.Task.is_test == True
             )
-        ).first()
+        ))
         
         if not existing:
             task = models.Task(
@@ -244,57 +246,60 @@ async def init_test_tasks(db: Session = Depends(get_db)):
             db.add(task)
             created_count += 1
     
-    db.commit()
+    await db.commit()
+    task_index.invalidate()
     return {"message": f"Created {created_count} test tasks", "total": len(test_tasks)}
 
 @router.delete("/delete-test-tasks")
-async def delete_test_tasks(db: Session = Depends(get_db)):
+async def delete_test_tasks(db: AsyncSession = Depends(get_db)):
     """Удаление всех тестовых заданий (is_test=True)"""
-    deleted_tasks = db.query(models.Task).filter(models.Task.is_test == True).all()
+    deleted_tasks = (await db.scalars(select(models.Task).where(models.Task.is_test == True))).all()
     deleted_count = len(deleted_tasks)
     
     for task in deleted_tasks:
         # Удаляем связанные UserTask записи
-        db.query(models.UserTask).filter(models.UserTask.task_id == task.id).delete()
+        await db.execute(delete(models.UserTask).where(models.UserTask.task_id == task.id))
         # Удаляем само задание
-        db.delete(task)
+        await db.delete(task)
     
-    db.commit()
+    await db.commit()
+    task_index.invalidate()
     return {"message": f"Deleted {deleted_count} test tasks"}
 
 @router.delete("/delete-example-tasks")
-async def delete_example_tasks(db: Session = Depends(get_db)):
+async def delete_example_tasks(db: AsyncSession = Depends(get_db)):
     """Удаление всех примеров заданий (созданных для демонстрации на странице 'Создать')"""
     # Ищем все тестовые пользователи (telegram_id <= 0)
-    test_users = db.query(models.User).filter(models.User.telegram_id <= 0).all()
+    test_users = (await db.scalars(select(models.User).where(models.User.telegram_id <= 0))).all()
     if not test_users:
         return {"message": "No test users found", "deleted": 0}
     
     test_user_ids = [u.id for u in test_users]
     
     # Удаляем все задания, созданные тестовыми пользователями
-    example_tasks = db.query(models.Task).filter(
+    example_tasks = (await db.scalars(select(models.Task).where(
         models.Task.creator_id.in_(test_user_ids)
-    ).all()
+    ))).all()
     
     deleted_count = len(example_tasks)
     
     for task in example_tasks:
         # Удаляем связанные UserTask записи
-        db.query(models.UserTask).filter(models.UserTask.task_id == task.id).delete()
+        await db.execute(delete(models.UserTask).where(models.UserTask.task_id == task.id))
         # Удаляем само задание
-        db.delete(task)
+        await db.delete(task)
     
-    db.commit()
+    await db.commit()
+    task_index.invalidate()
     return {"message": f"Deleted {deleted_count} example tasks"}
 
 @router.get("/list-all-tasks")
-async def list_all_tasks(db: Session = Depends(get_db)):
+async def list_all_tasks(db: AsyncSession = Depends(get_db)):
     """Показывает все задания для диагностики"""
-    tasks = db.query(models.Task).all()
+    tasks = (await db.scalars(select(models.Task))).all()
     result = []
     for task in tasks:
-        creator = db.query(models.User).filter(models.User.id == task.creator_id).first()
+        creator = await db.scalar(select(models.User).where(models.User.id == task.creator_id))
         result.append({
             "id": task.id,
             "title": task.title,
@@ -307,27 +312,28 @@ async def list_all_tasks(db: Session = Depends(get_db)):
     return {"total": len(result), "tasks": result}
 
 @router.post("/delete-all-tasks-except-real")
-async def delete_all_tasks_except_real(db: Session = Depends(get_db)):
+async def delete_all_tasks_except_real(db: AsyncSession = Depends(get_db)):
     """Удаляет все задания, кроме созданных реальными пользователями (telegram_id > 0)"""
     # Находим всех реальных пользователей
-    real_users = db.query(models.User).filter(models.User.telegram_id > 0).all()
+    real_users = (await db.scalars(select(models.User).where(models.User.telegram_id > 0))).all()
     real_user_ids = [u.id for u in real_users]
     
     if not real_user_ids:
         return {"message": "No real users found", "deleted": 0}
     
     # Удаляем все задания, созданные не реальными пользователями
-    tasks_to_delete = db.query(models.Task).filter(
+    tasks_to_delete = (await db.scalars(select(models.Task).where(
         ~models.Task.creator_id.in_(real_user_ids)
-    ).all()
+    ))).all()
     
     deleted_count = 0
     for task in tasks_to_delete:
-        db.query(models.UserTask).filter(models.UserTask.task_id == task.id).delete()
-        db.delete(task)
+        await db.execute(delete(models.UserTask).where(models.UserTask.task_id == task.id))
+        await db.delete(task)
         deleted_count += 1
     
-    db.commit()
+    await db.commit()
+    task_index.invalidate()
     return {
         "message": "Deleted all tasks except those created by real users",
         "deleted": deleted_count,
@@ -335,29 +341,29 @@ async def delete_all_tasks_except_real(db: Session = Depends(get_db)):
     }
 
 @router.post("/cleanup-test-tasks")
-async def cleanup_test_tasks(db: Session = Depends(get_db)):
+async def cleanup_test_tasks(db: AsyncSession = Depends(get_db)):
     """Комплексная очистка: удаляет все тестовые задания и примеры"""
     deleted_test = 0
     deleted_examples = 0
     deleted_by_title = 0
     
     # Удаляем тестовые задания (is_test=True)
-    test_tasks = db.query(models.Task).filter(models.Task.is_test == True).all()
+    test_tasks = (await db.scalars(select(models.Task).where(models.Task.is_test == True))).all()
     for task in test_tasks:
-        db.query(models.UserTask).filter(models.UserTask.task_id == task.id).delete()
-        db.delete(task)
+        await db.execute(delete(models.UserTask).where(models.UserTask.task_id == task.id))
+        await db.delete(task)
         deleted_test += 1
     
     # Удаляем примеры заданий (созданные тестовыми пользователями)
-    test_users = db.query(models.User).filter(models.User.telegram_id <= 0).all()
+    test_users = (await db.scalars(select(models.User).where(models.User.telegram_id <= 0))).all()
     if test_users:
         test_user_ids = [u.id for u in test_users]
-        example_tasks = db.query(models.Task).filter(
+        example_tasks = (await db.scalars(select(models.Task).where(
             models.Task.creator_id.in_(test_user_ids)
-        ).all()
+        ))).all()
         for task in example_tasks:
-            db.query(models.UserTask).filter(models.UserTask.task_id == task.id).delete()
-            db.delete(task)
+            await db.execute(delete(models.UserTask).where(models.UserTask.task_id == task.id))
+            await db.delete(task)
             deleted_examples += 1
     
     # Удаляем задания по характерным названиям (тестовые задания из admin.py)
@@ -383,17 +389,18 @@ async def cleanup_test_tasks(db: Session = Depends(get_db)):
         conditions.append(models.Task.title.like(f"{pattern}%"))
     
     if conditions:
-        tasks_by_title = db.query(models.Task).filter(
+        tasks_by_title = (await db.scalars(select(models.Task).where(
             or_(*conditions)
-        ).all()
+        ))).all()
         
         for task in tasks_by_title:
             # Удаляем все задания с тестовыми названиями
-            db.query(models.UserTask).filter(models.UserTask.task_id == task.id).delete()
-            db.delete(task)
+            await db.execute(delete(models.UserTask).where(models.UserTask.task_id == task.id))
+            await db.delete(task)
             deleted_by_title += 1
     
-    db.commit()
+    await db.commit()
+    task_index.invalidate()
     return {
         "message": "Cleanup completed",
         "deleted_test_tasks": deleted_test,
@@ -403,7 +410,7 @@ async def cleanup_test_tasks(db: Session = Depends(get_db)):
     }
 
 @router.post("/fix-failed-withdrawal/{telegram_id}")
-async def fix_failed_withdrawal(telegram_id: int, db: Session = Depends(get_db)):
+async def fix_failed_withdrawal(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """
     Исправляет проблему с выводом средств: возвращает средства на баланс,
     если транзакция не была отправлена (нет tx_hash или tx_hash не подтвержден).
@@ -412,16 +419,16 @@ async def fix_failed_withdrawal(telegram_id: int, db: Session = Depends(get_db))
     from sqlalchemy import or_
     
     # Находим пользователя
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Находим ВСЕ pending транзакции для этого пользователя
     # Включая те, у которых нет tx_hash или tx_hash не подтвержден
-    all_pending = db.query(models.TonTransaction).filter(
+    all_pending = (await db.scalars(select(models.TonTransaction).where(
         models.TonTransaction.user_id == user.id,
         models.TonTransaction.status == "pending"
-    ).all()
+    ))).all()
     
     # Фильтруем: берем только те, которые точно не были отправлены
     # (нет tx_hash или tx_hash = "unknown")
@@ -453,9 +460,9 @@ async def fix_failed_withdrawal(telegram_id: int, db: Session = Depends(get_db))
         }
     
     # Возвращаем средства на баланс
-    balance = db.query(models.UserBalance).filter(
+    balance = await db.scalar(select(models.UserBalance).where(
         models.UserBalance.user_id == user.id
-    ).first()
+    ))
     
     if not balance:
         raise HTTPException(status_code=404, detail="Balance not found")
@@ -468,7 +475,7 @@ async def fix_failed_withdrawal(telegram_id: int, db: Session = Depends(get_db))
     
     for tx in failed_transactions:
         # Возвращаем средства
-        balance.ton_active_balance += tx.amount_nano
+        apply_balance_delta(db, balance, tx.amount_nano, reason="withdrawal_failed_refund", ref_id=tx.id)
         total_refunded += tx.amount_nano
         
         # Помечаем транзакцию как failed
@@ -479,10 +486,10 @@ async def fix_failed_withdrawal(telegram_id: int, db: Session = Depends(get_db))
     
     # Коммитим изменения
     try:
-        db.commit()
-        db.refresh(balance)
+        await db.commit()
+        await db.refresh(balance)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to commit changes: {str(e)}")
     
     return {
@@ -505,7 +512,7 @@ async def fix_failed_withdrawal(telegram_id: int, db: Session = Depends(get_db))
     }
 
 @router.post("/force-refund/{telegram_id}")
-async def force_refund(telegram_id: int, db: Session = Depends(get_db)):
+async def force_refund(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """
     Принудительный возврат средств: возвращает средства для ВСЕХ pending транзакций,
     независимо от наличия tx_hash. Используйте только в крайнем случае!
@@ -513,15 +520,15 @@ async def force_refund(telegram_id: int, db: Session = Depends(get_db)):
     from decimal import Decimal
     
     # Находим пользователя
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Находим ВСЕ pending транзакции
-    all_pending = db.query(models.TonTransaction).filter(
+    all_pending = (await db.scalars(select(models.TonTransaction).where(
         models.TonTransaction.user_id == user.id,
         models.TonTransaction.status == "pending"
-    ).all()
+    ))).all()
     
     if not all_pending:
         return {
@@ -530,9 +537,9 @@ async def force_refund(telegram_id: int, db: Session = Depends(get_db)):
         }
     
     # Возвращаем средства на баланс
-    balance = db.query(models.UserBalance).filter(
+    balance = await db.scalar(select(models.UserBalance).where(
         models.UserBalance.user_id == user.id
-    ).first()
+    ))
     
     if not balance:
         raise HTTPException(status_code=404, detail="Balance not found")
@@ -542,7 +549,7 @@ async def force_refund(telegram_id: int, db: Session = Depends(get_db)):
     
     for tx in all_pending:
         # Возвращаем средства
-        balance.ton_active_balance += tx.amount_nano
+        apply_balance_delta(db, balance, tx.amount_nano, reason="force_refund", ref_id=tx.id)
         total_refunded += tx.amount_nano
         
         # Помечаем транзакцию как failed
@@ -550,10 +557,10 @@ async def force_refund(telegram_id: int, db: Session = Depends(get_db)):
         tx.error_message = f"FORCE REFUND: Transaction cancelled and funds returned. Original tx_hash: {tx.tx_hash or 'none'}"
     
     try:
-        db.commit()
-        db.refresh(balance)
+        await db.commit()
+        await db.refresh(balance)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to commit: {str(e)}")
     
     return {
@@ -1,63 +1,53 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select
 from app.database import get_db
 from app import models, schemas
+from app.balance_ledger import apply_balance_delta, reconcile_balance
+from app.database_optimizations import balance_cache
 from decimal import Decimal
 from datetime import datetime, timedelta
 from typing import Dict, Any
 
 router = APIRouter()
 
-def recalculate_balance_from_transactions(user_id: int, db: Session) -> Decimal:
-    """
-    Пересчитывает баланс пользователя на основе:
-    1. Всех транзакций (депозиты и выводы)
-    2. Бюджета всех активных заданий (которые еще не отменены)
-    
-    Возвращает правильный баланс в нано-TON.
-    """
-    # Суммируем все обработанные депозиты
-    deposits = db.query(func.sum(models.Deposit.amount_nano)).filter(
-        models.Deposit.user_id == user_id,
-        models.Deposit.status == "processed"
-    ).scalar() or Decimal(0)
-    
-    # Суммируем все успешно отправленные выводы (только те, у которых есть tx_hash)
-    withdrawals = db.query(func.sum(models.TonTransaction.amount_nano)).filter(
-        models.TonTransaction.user_id == user_id,
-        models.TonTransaction.tx_hash.isnot(None),  # Только отправленные транзакции
-        models.TonTransaction.status.in_(["pending", "completed"])  # Успешные или в процессе
-    ).scalar() or Decimal(0)
-    
-    # Находим все активные задания (не отмененные) и считаем их бюджет
-    active_tasks = db.query(models.Task).filter(
-        models.Task.creator_id == user_id,
-        models.Task.status != models.TaskStatus.CANCELLED
-    ).all()
-    
-    # Считаем общий бюджет всех активных заданий (в нано-TON)
-    total_spent_on_tasks_nano = Decimal(0)
-    for task in active_tasks:
-        # price_per_slot_ton в БД хранится в нано-TON
-        price_per_slot_nano = Decimal(task.price_per_slot_ton)
-        task_budget_nano = Decimal(task.total_slots) * price_per_slot_nano
-        total_spent_on_tasks_nano += task_budget_nano
-    
-    # Правильный баланс = депозиты - выводы - потрачено на активные задания
-    correct_balance = deposits - withdrawals - total_spent_on_tasks_nano
+def balance_response(dto: Dict[str, Any]) -> schemas.BalanceResponse:
+    """Ответ API из DTO баланса (кэш или только что прочитанный из БД)"""
+    # Вычисляем фиатный баланс (реальные значения, без виртуальных)
+    ton_active = float(dto["ton_active_balance"] or 0)
+    fiat_balance = (ton_active / 10**9) * float(dto["last_fiat_rate"] or 250)
     
-    return correct_balance
-
+    return schemas.BalanceResponse(
+        ton_active_balance=dto["ton_active_balance"],
+        ton_escrow_balance=dto["ton_escrow_balance"],
+        fiat_balance=Decimal(str(fiat_balance)),
+        fiat_currency=dto["fiat_currency"],
+        subscription_limit_24h=dto["subscription_limit_24h"],
+        subscriptions_used_24h=dto["subscriptions_used_24h"]
+    )
 
 @router.get("/{telegram_id}", response_model=schemas.BalanceResponse)
-async def get_balance(telegram_id: int, db: Session = Depends(get_db)):
+async def get_balance(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Получение баланса пользователя с автоматической проверкой и корректировкой"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    # Баланс показывается на каждом экране Mini App - сначала пробуем кэш.
+    # Кэш сбрасывается после каждого commit, изменившего UserBalance
+    user_id = await balance_cache.get_user_id(telegram_id)
+    if user_id is not None:
+        dto = await balance_cache.get(user_id)
+        if dto is not None:
+            return balance_response(dto)
+    
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    await balance_cache.set_user_id(telegram_id, user.id)
+    
+    # Версию кэша читаем до чтения баланса из БД: если баланс изменится параллельно
+    # (между чтением и записью в кэш), записанный ниже DTO окажется устаревшим
+    # по версии и не будет отдан
+    version = await balance_cache.current_version(user.id)
     
-    balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+    balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user.id))
     if not balance:
         # Создаем баланс с нулевым балансом (реальные TON)
         balance = models.UserBalance(
@@ -67,43 +57,26 @@ async def get_balance(telegram_id: int, db: Session = Depends(get_db)):
             fiat_currency="RUB"
         )
         db.add(balance)
-        db.commit()
-        db.refresh(balance)
+        await db.commit()
+        await db.refresh(balance)
     
     # АВТОМАТИЧЕСКАЯ ПРОВЕРКА И КОРРЕКТИРОВКА БАЛАНСА
-    correct_balance = recalculate_balance_from_transactions(user.id, db)
-    current_balance = Decimal(balance.ton_active_balance or 0)
-    
-    # Если баланс не совпадает, корректируем
-    if current_balance != correct_balance:
-        difference = correct_balance - current_balance
-        print(f"⚠️ Balance mismatch for user {telegram_id}: current={current_balance/10**9:.4f} TON, correct={correct_balance/10**9:.4f} TON, difference={difference/10**9:.4f} TON", flush=True)
-        balance.ton_active_balance = correct_balance
-        db.commit()
-        db.refresh(balance)
-        print(f"✅ Balance corrected for user {telegram_id}: {correct_balance/10**9:.4f} TON", flush=True)
-    
-    # Вычисляем фиатный баланс (реальные значения, без виртуальных)
-    ton_active = float(balance.ton_active_balance or 0)
-    fiat_balance = (ton_active / 10**9) * float(balance.last_fiat_rate or 250)
+    # Инкрементальная сверка с журналом: читаются только записи после watermark снапшота
+    corrected = await reconcile_balance(db, balance)
+    await db.commit()
+    if corrected:
+        print(f"✅ Balance corrected for user {telegram_id}: {Decimal(balance.ton_active_balance)/10**9:.4f} TON", flush=True)
     
-    return schemas.BalanceResponse(
-        ton_active_balance=balance.ton_active_balance,
-        ton_escrow_balance=balance.ton_escrow_balance,
-        fiat_balance=Decimal(str(fiat_balance)),
-        fiat_currency=balance.fiat_currency,
-        subscription_limit_24h=balance.subscription_limit_24h,
-        subscriptions_used_24h=balance.subscriptions_used_24h
-    )
+    return balance_response(await balance_cache.set(user.id, balance, version))
 
 @router.patch("/{telegram_id}/currency")
-async def change_currency(telegram_id: int, currency: str = Query(...), db: Session = Depends(get_db)):
+async def change_currency(telegram_id: int, currency: str = Query(...), db: AsyncSession = Depends(get_db)):
     """Изменение валюты отображения баланса"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+    balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user.id))
     if not balance:
         raise HTTPException(status_code=404, detail="Balance not found")
     
@@ -116,14 +89,14 @@ async def change_currency(telegram_id: int, currency: str = Query(...), db: Sess
     
     balance.fiat_currency = currency
     balance.last_fiat_rate = currency_rates.get(currency, Decimal("250"))
-    db.commit()
+    await db.commit()
     
     return {"message": "Currency updated", "currency": currency}
 
 @router.get("/{telegram_id}/task-stats")
-async def get_task_stats(telegram_id: int, db: Session = Depends(get_db)):
+async def get_task_stats(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Получение статистики выполненных заданий пользователя"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -131,15 +104,15 @@ async def get_task_stats(telegram_id: int, db: Session = Depends(get_db)):
     today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
     
     # Получаем все выполненные задания пользователя
-    completed_tasks = db.query(
+    completed_tasks = (await db.execute(select(
         models.UserTask,
         models.Task
     ).join(
         models.Task, models.UserTask.task_id == models.Task.id
-    ).filter(
+    ).where(
         models.UserTask.user_id == user.id,
         models.UserTask.status == models.UserTaskStatus.COMPLETED
-    ).all()
+    ))).all()
     
     # Статистика по типам заданий
     stats: Dict[str, Dict[str, Any]] = {
@@ -175,14 +148,14 @@ async def get_task_stats(telegram_id: int, db: Session = Depends(get_db)):
 
 
 @router.get("/{telegram_id}/deposit-info")
-async def get_deposit_info(telegram_id: int, db: Session = Depends(get_db)):
+async def get_deposit_info(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """
     Получение информации для пополнения баланса.
     Возвращает адрес сервисного кошелька для перевода TON.
     Пользователь переводит TON на этот адрес, затем администратор пополняет баланс через админку.
     """
     import os
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -199,18 +172,19 @@ async def get_deposit_info(telegram_id: int, db: Session = Depends(get_db)):
 
 
 @router.get("/{telegram_id}/deposits")
-async def get_user_deposits(telegram_id: int, db: Session = Depends(get_db)):
+async def get_user_deposits(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Получение всех депозитов пользователя."""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     deposits = (
-        db.query(models.Deposit)
-        .filter(models.Deposit.user_id == user.id)
-        .order_by(models.Deposit.created_at.desc())
-        .all()
-    )
+        await db.scalars(
+            select(models.Deposit)
+            .where(models.Deposit.user_id == user.id)
+            .order_by(models.Deposit.created_at.desc())
+        )
+    ).all()
     
     return [
         {
@@ -230,7 +204,7 @@ async def get_user_deposits(telegram_id: int, db: Session = Depends(get_db)):
 async def user_withdraw(
     telegram_id: int,
     payload: schemas.UserWithdrawRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Вывод средств пользователя на внешний кошелек.
@@ -238,11 +212,11 @@ async def user_withdraw(
     """
     from app.ton_service import get_ton_service
     
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+    balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user.id))
     if not balance:
         raise HTTPException(status_code=404, detail="Balance not found")
     
@@ -277,7 +251,7 @@ async def user_withdraw(
 
 
 @router.post("/{telegram_id}/recalculate-from-tasks")
-async def recalculate_balance_from_tasks(telegram_id: int, db: Session = Depends(get_db)):
+async def recalculate_balance_from_tasks(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """
     Пересчитывает баланс пользователя на основе:
     1. Всех депозитов
@@ -286,11 +260,11 @@ async def recalculate_balance_from_tasks(telegram_id: int, db: Session = Depends
     
     Правильный баланс = депозиты - выводы - потрачено на активные задания
     """
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+    balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user.id))
     if not balance:
         raise HTTPException(status_code=404, detail="Balance not found")
     
@@ -302,25 +276,25 @@ async def recalculate_balance_from_tasks(telegram_id: int, db: Session = Depends
         return ton * Decimal(10**9)
     
     # 1. Суммируем все обработанные депозиты
-    deposits_nano = db.query(func.sum(models.Deposit.amount_nano)).filter(
+    deposits_nano = await db.scalar(select(func.sum(models.Deposit.amount_nano)).where(
         models.Deposit.user_id == user.id,
         models.Deposit.status == "processed"
-    ).scalar() or Decimal(0)
+    )) or Decimal(0)
     deposits_ton = nano_to_ton(deposits_nano)
     
     # 2. Суммируем все успешно отправленные выводы
-    withdrawals_nano = db.query(func.sum(models.TonTransaction.amount_nano)).filter(
+    withdrawals_nano = await db.scalar(select(func.sum(models.TonTransaction.amount_nano)).where(
         models.TonTransaction.user_id == user.id,
         models.TonTransaction.tx_hash.isnot(None),
         models.TonTransaction.status.in_(["pending", "completed"])
-    ).scalar() or Decimal(0)
+    )) or Decimal(0)
     withdrawals_ton = nano_to_ton(withdrawals_nano)
     
     # 3. Находим все активные задания (не отмененные)
-    active_tasks = db.query(models.Task).filter(
+    active_tasks = (await db.scalars(select(models.Task).where(
         models.Task.creator_id == user.id,
         models.Task.status != models.TaskStatus.CANCELLED
-    ).all()
+    ))).all()
     
     # 4. Считаем общий бюджет всех активных заданий
     total_spent_on_tasks_ton = Decimal(0)
@@ -351,16 +325,12 @@ async def recalculate_balance_from_tasks(telegram_id: int, db: Session = Depends
     current_balance_ton = nano_to_ton(current_balance_nano)
     
     # 7. Обновляем баланс (преобразуем в int для БД)
-    # Используем прямой SQL UPDATE для гарантии сохранения
-    from sqlalchemy import text
-    db.execute(
-        text("UPDATE user_balances SET ton_active_balance = :new_balance WHERE user_id = :user_id"),
-        {"new_balance": int(correct_balance_nano), "user_id": user.id}
-    )
-    db.commit()
+    # Корректировка записывается в журнал, чтобы сверка при чтении баланса ее не откатила
+    apply_balance_delta(db, balance, Decimal(int(correct_balance_nano)) - current_balance_nano, reason="recalculate")
+    await db.commit()
     
     # Обновляем объект в сессии
-    db.refresh(balance)
+    await db.refresh(balance)
     
     # Проверяем, что баланс действительно обновился
     updated_balance_nano = Decimal(balance.ton_active_balance or 0)
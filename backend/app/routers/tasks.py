@@ -1,17 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, or_, select, func
 from app.database import get_db
 from app import models, schemas
+from app.balance_ledger import BalanceChangeSet, apply_balance_delta
+from app.task_index import task_index
+from app.query_budget import debug_sampled, query_budget, unmetered
+from app.slot_reservations import consume_slot, reserve_slot
+from app.validation_jobs import enqueue_validation
 from decimal import Decimal
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import List, Optional, Tuple
+import base64
+import json
+import os
 
 router = APIRouter()
 
-def add_referral_commission(user_id: int, reward_ton: Decimal, db: Session):
-    """Начисление 5% комиссии рефереру с каждого выполненного задания"""
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+# Размер страницы ленты заданий
+FEED_PAGE_SIZE = int(os.getenv("FEED_PAGE_SIZE", "50"))
+FEED_MAX_PAGE_SIZE = 100
+
+async def add_referral_commission(user_id: int, reward_ton: Decimal, db: AsyncSession, changes: BalanceChangeSet):
+    """
+    Начисление 5% комиссии рефереру с каждого выполненного задания.
+    Начисление добавляется в changes и применяется вместе с наградой исполнителя.
+    """
+    user = await db.scalar(select(models.User).where(models.User.id == user_id))
     if not user or not user.referrer_id:
         return
     
@@ -19,12 +34,12 @@ def add_referral_commission(user_id: int, reward_ton: Decimal, db: Session):
     commission = reward_ton * Decimal("0.05")
     
     # Находим реферальную запись
-    referral = db.query(models.Referral).filter(
+    referral = await db.scalar(select(models.Referral).where(
         and_(
             models.Referral.referrer_id == user.referrer_id,
             models.Referral.referred_id == user.id
         )
-    ).first()
+    ))
     
     if referral:
         # Обновляем статистику реферала
@@ -32,15 +47,10 @@ def add_referral_commission(user_id: int, reward_ton: Decimal, db: Session):
         referral.referral_commission_ton += commission
         
         # Начисляем комиссию рефереру
-        referrer_balance = db.query(models.UserBalance).filter(
-            models.UserBalance.user_id == user.referrer_id
-        ).first()
-        
-        if referrer_balance:
-            referrer_balance.ton_active_balance += commission
-            referrer_balance.ton_referral_earnings += commission
+        changes.add(user.referrer_id, commission, reason="referral_commission", ref_id=user.id)
+        changes.add(user.referrer_id, commission, "referral", reason="referral_commission", ref_id=user.id)
 
-def deduct_app_commission(user_id: int, reward_ton: Decimal, db: Session) -> Decimal:
+def deduct_app_commission(user_id: int, reward_ton: Decimal, db: AsyncSession) -> Decimal:
     """
     Вычитает 10% комиссию приложения с исполнителя задания.
     Возвращает сумму, которую получит исполнитель после вычета комиссии.
@@ -58,15 +68,40 @@ def deduct_app_commission(user_id: int, reward_ton: Decimal, db: Session) -> Dec
     
     return user_reward
 
+def encode_feed_cursor(price_per_slot_ton: Decimal, task_id: int) -> str:
+    """Непрозрачный курсор ленты: позиция (цена, id) последнего задания страницы"""
+    raw = json.dumps({"p": str(price_per_slot_ton), "i": task_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_feed_cursor(cursor: str) -> Tuple[Decimal, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return Decimal(data["p"]), int(data["i"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @router.get("/", response_model=List[schemas.TaskListItem])
+@query_budget(6)  # пользователь, баланс, снятие истекшего бана, перестройка индекса, взятые задания, страница
 async def get_tasks(
     telegram_id: int,
-    db: Session = Depends(get_db),
-    task_type: Optional[str] = None
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+    task_type: Optional[str] = None,
+    limit: int = Query(FEED_PAGE_SIZE, ge=1, le=FEED_MAX_PAGE_SIZE, description="Размер страницы"),
+    cursor: Optional[str] = Query(None, description="Курсор из заголовка X-Next-Cursor предыдущей страницы"),
+    order: str = Query("desc", pattern="^(desc|asc)$", description="Порядок по цене: desc или asc")
 ):
-    """Получение списка доступных заданий для пользователя"""
+    """
+    Получение списка доступных заданий для пользователя.
+    
+    Лента отдается страницами по (price_per_slot_ton, id) в порядке order (по умолчанию - убывания).
+    Курсор следующей страницы - в заголовке X-Next-Cursor (нет заголовка - страниц больше нет),
+    приблизительное общее количество доступных заданий - в X-Total-Count.
+    """
+    after = decode_feed_cursor(cursor) if cursor else None
     # Получаем пользователя
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -82,13 +117,13 @@ async def get_tasks(
                 user.is_banned = False
                 user.ban_until = None
                 user.ban_reason = None
-                db.commit()
+                await db.commit()
         else:
             # Бан без срока - не показываем задания
             return []
     
     # Проверяем баланс (только для блокировки при отрицательном балансе)
-    balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+    balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user.id))
     if balance and balance.ton_active_balance < 0:
         return []  # Заблокирован доступ при отрицательном балансе
     
@@ -96,93 +131,73 @@ async def get_tasks(
     fiat_rate = float(balance.last_fiat_rate) if balance and balance.last_fiat_rate else 250.0
     fiat_currency = balance.fiat_currency if balance and balance.fiat_currency else 'RUB'
     
-    # Исключаем тестового пользователя (telegram_id=0) - это примеры заданий
-    test_creator = db.query(models.User).filter(models.User.telegram_id == 0).first()
-    test_creator_id = test_creator.id if test_creator else None
+    # Доступные задания - пересечение множеств в индексе таргетинга. Тестовые задания,
+    # примеры (созданные пользователями с telegram_id <= 0) и исчерпанные задания в индекс не попадают
+    await task_index.ensure_fresh(db)
     
-    # Формируем запрос - строго исключаем тестовые задания и примеры
-    query = db.query(models.Task).filter(
-        models.Task.status == models.TaskStatus.ACTIVE
+    # Фильтр по лимиту подписок (только если профиль заполнен)
+    hide_subscriptions = bool(
+        balance and user.age and user.gender and user.country
+        and balance.subscriptions_used_24h >= balance.subscription_limit_24h
     )
     
-    # Исключаем тестовые задания (is_test=True)
-    query = query.filter(
-        or_(
-            models.Task.is_test == False,
-            models.Task.is_test.is_(None)
-        )
+    # Фильтр по таргетингу применяется индексом только если профиль заполнен
+    eligible_ids = task_index.eligible_ids(
+        country=user.country,
+        gender=user.gender,
+        age=user.age,
+        task_type=task_type,
+        exclude_subscriptions=hide_subscriptions
     )
     
-    # Исключаем примеры заданий (созданные тестовым пользователем)
-    # Исключаем примеры заданий (созданные тестовым пользователем)
-    if test_creator_id:
-        query = query.filter(models.Task.creator_id != test_creator_id)
-    
-    # Дополнительная проверка: исключаем задания, созданные пользователями с telegram_id <= 0
-    # (на случай, если есть другие тестовые пользователи)
-    # (на случай, если есть другие тестовые пользователи)
-    test_users = db.query(models.User).filter(models.User.telegram_id <= 0).all()
-    if test_users:
-        test_user_ids = [u.id for u in test_users]
-        query = query.filter(~models.Task.creator_id.in_(test_user_ids))
-    
-    # Фильтр по типу задания
-    if task_type:
-        query = query.filter(models.Task.task_type == task_type)
-    
-    # Фильтр по таргетингу (только если профиль заполнен)
-    print(f"[DEBUG] Before targeting filter: {db.query(models.Task).filter(models.Task.status == models.TaskStatus.ACTIVE).count()} active tasks")
-    if user.age and user.gender and user.country:
-        print(f"[DEBUG] Applying targeting filters for user: age={user.age}, gender={user.gender}, country={user.country}")
-        query = query.filter(
-            or_(
-                models.Task.target_country.is_(None),
-                models.Task.target_country == user.country
-            )
-        ).filter(
-            or_(
-                models.Task.target_gender.is_(None),
-                models.Task.target_gender == user.gender
+    # Исключаем задания, которые пользователь уже брал (start_task вернул бы "Task already started").
+    # Проваленные/истекшие заявки не мешают взять задание снова
+    if eligible_ids:
+        claimed_ids = (await db.scalars(
+            select(models.UserTask.task_id).where(
+                models.UserTask.user_id == user.id,
+                models.UserTask.status != models.UserTaskStatus.FAILED
             )
+        )).all()
+        eligible_ids.difference_update(claimed_ids)
+    
+    # Оценка общего количества берется из индекса бесплатно (без COUNT по таблице)
+    response.headers["X-Total-Count"] = str(len(eligible_ids))
+    if not eligible_ids:
+        return []
+    
+    # Keyset-пагинация по индексу: берем на одно задание больше, чтобы понять, есть ли следующая страница
+    page_ids = task_index.page(eligible_ids, after, limit + 1, descending=order == "desc")
+    if len(page_ids) > limit:
+        page_ids = page_ids[:limit]
+        last = task_index.tasks[page_ids[-1]]
+        response.headers["X-Next-Cursor"] = encode_feed_cursor(last.price_per_slot_ton, last.id)
+    
+    # Загружаем только задания страницы (по первичному ключу), порядок - как в индексе
+    rows = (await db.scalars(
+        select(models.Task)
+        .where(
+            models.Task.id.in_(page_ids),
+            models.Task.status == models.TaskStatus.ACTIVE
         )
-        
-        # Фильтр по возрасту
-        query = query.filter(
-            or_(
-                models.Task.target_age_min.is_(None),
-                models.Task.target_age_min <= user.age
-            )
-        ).filter(
-            or_(
-                models.Task.target_age_max.is_(None),
-                models.Task.target_age_max >= user.age
-            )
-        )
-        print(f"[DEBUG] After targeting filters: {query.count()} tasks")
-    
-    # Фильтр по лимиту подписок (только если профиль заполнен)
-    if balance and user.age and user.gender and user.country:
-        # Проверяем, нужно ли скрывать задания на подписку
-        if balance.subscriptions_used_24h >= balance.subscription_limit_24h:
-            query = query.filter(models.Task.task_type != models.TaskType.SUBSCRIPTION)
-    
-    # Логируем количество заданий после всех фильтров
-    tasks_before_order = query.all()
-    print(f"[DEBUG] Tasks after all filters (before ordering): {len(tasks_before_order)}")
-    tasks = query.order_by(models.Task.price_per_slot_ton.desc()).all()
-    
-    print(f"[DEBUG] User profile: age={user.age}, gender={user.gender}, country={user.country}")
-    print(f"[DEBUG] Total active tasks in DB: {db.query(models.Task).filter(models.Task.status == models.TaskStatus.ACTIVE).count()}")
-    print(f"[DEBUG] Tasks with is_test=False: {db.query(models.Task).filter(models.Task.status == models.TaskStatus.ACTIVE, or_(models.Task.is_test == False, models.Task.is_test.is_(None))).count()}")
-    # DEBUG: Логируем количество найденных заданий
-    print(f"[DEBUG] Found {len(tasks)} tasks for user {telegram_id}")
+    )).all()
+    rows_by_id = {task.id: task for task in rows}
+    tasks = [rows_by_id[task_id] for task_id in page_ids if task_id in rows_by_id]
+    
+    # Отладочная диагностика - только для сэмплированных запросов и вне бюджета
+    if debug_sampled():
+        with unmetered():
+            print(f"[DEBUG] User profile: age={user.age}, gender={user.gender}, country={user.country}")
+            print(f"[DEBUG] Eligible tasks from targeting index: {len(eligible_ids)}")
+            print(f"[DEBUG] Total active tasks in DB: {await db.scalar(select(func.count()).select_from(models.Task).where(models.Task.status == models.TaskStatus.ACTIVE))}")
+            print(f"[DEBUG] Tasks with is_test=False: {await db.scalar(select(func.count()).select_from(models.Task).where(models.Task.status == models.TaskStatus.ACTIVE, or_(models.Task.is_test == False, models.Task.is_test.is_(None))))}")
+            print(f"[DEBUG] Found {len(tasks)} tasks for user {telegram_id}")
     
     # Формируем ответ
     result = []
     for task in tasks:
-        remaining_slots = task.total_slots - task.completed_slots
+        remaining_slots = task.total_slots - task.completed_slots - (task.reserved_slots or 0)
         if remaining_slots <= 0:
-            print(f"[DEBUG] Skipping task {task.id} - no remaining slots")
             continue
         
         price_fiat = float(task.price_per_slot_ton) / 10**9 * fiat_rate
@@ -207,30 +222,30 @@ async def get_tasks(
     return result
 
 @router.get("/my", response_model=List[schemas.TaskResponse])
-async def get_my_tasks(telegram_id: int = Query(..., description="Telegram ID пользователя"), db: Session = Depends(get_db)):
+async def get_my_tasks(telegram_id: int = Query(..., description="Telegram ID пользователя"), db: AsyncSession = Depends(get_db)):
     """Получение списка заданий, созданных пользователем"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Исключаем тестовые задания из списка "моих заданий"
-    tasks = db.query(models.Task).filter(
+    tasks = (await db.scalars(select(models.Task).where(
         models.Task.creator_id == user.id,
         models.Task.is_test == False  # Исключаем тестовые задания
-    ).order_by(models.Task.created_at.desc()).all()
+    ).order_by(models.Task.created_at.desc()))).all()
     return tasks
 
 @router.get("/{task_id}", response_model=schemas.TaskResponse)
-async def get_task(task_id: int, db: Session = Depends(get_db)):
+async def get_task(task_id: int, db: AsyncSession = Depends(get_db)):
     """Получение детальной информации о задании"""
-    task = db.query(models.Task).filter(models.Task.id == task_id).first()
+    task = await db.scalar(select(models.Task).where(models.Task.id == task_id))
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     print(f"[GET TASK] Task {task_id} - telegram_channel_id={task.telegram_channel_id}, telegram_post_id={task.telegram_post_id}, task_type={task.task_type}")
     return task
 
 @router.post("/", response_model=schemas.TaskResponse)
-async def create_task(task: schemas.TaskCreate, telegram_id: int, db: Session = Depends(get_db)):
+async def create_task(task: schemas.TaskCreate, telegram_id: int, db: AsyncSession = Depends(get_db)):
     """
     Создание нового задания.
     Списание средств с баланса заказчика (total_slots * price_per_slot_ton).
@@ -241,12 +256,12 @@ async def create_task(task: schemas.TaskCreate, telegram_id: int, db: Session =
     except Exception as e:
         print(f"[CREATE TASK] Error logging request: {e}")
     
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Проверяем баланс заказчика
-    balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+    balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user.id))
     if not balance:
         raise HTTPException(status_code=404, detail="Balance not found")
     
@@ -282,9 +297,6 @@ async def create_task(task: schemas.TaskCreate, telegram_id: int, db: Session =
             detail=f"Insufficient funds. Required: {total_budget_ton:.4f} TON, Available: {balance_ton:.4f} TON"
         )
     
-    # Списываем бюджет кампании с баланса (конвертируем в нано-TON только для БД)
-    balance.ton_active_balance -= ton_to_nano(total_budget_ton)
-    
     # Сохраняем цену в нано-TON в базе данных (для совместимости)
     task_dict = task.dict()
     task_dict['price_per_slot_ton'] = str(int(ton_to_nano(price_per_slot_ton)))
@@ -296,11 +308,16 @@ async def create_task(task: schemas.TaskCreate, telegram_id: int, db: Session =
     # Создаем задание
     db_task = models.Task(creator_id=user.id, **task_dict)
     db.add(db_task)
+    await db.flush()
+    
+    # Списываем бюджет кампании с баланса (конвертируем в нано-TON только для БД)
+    apply_balance_delta(db, balance, -ton_to_nano(total_budget_ton), reason="task_budget", ref_id=db_task.id)
     
     # Коммитим изменения
-    db.commit()
-    db.refresh(balance)
-    db.refresh(db_task)
+    await db.commit()
+    await db.refresh(balance)
+    await db.refresh(db_task)
+    task_index.upsert(db_task, user.telegram_id)
     
     new_balance_ton = nano_to_ton(Decimal(balance.ton_active_balance))
     print(f"[CREATE TASK] Balance after: {new_balance_ton} TON")
@@ -317,75 +334,81 @@ async def create_task(task: schemas.TaskCreate, telegram_id: int, db: Session =
     return db_task
 
 @router.patch("/{task_id}/pause")
-async def pause_task(task_id: int, telegram_id: int, db: Session = Depends(get_db)):
+async def pause_task(task_id: int, telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Остановка задания"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    task = db.query(models.Task).filter(
+    task = await db.scalar(select(models.Task).where(
         and_(
             models.Task.id == task_id,
             models.Task.creator_id == user.id
         )
-    ).first()
+    ))
     
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
     if task.status == models.TaskStatus.ACTIVE:
         task.status = models.TaskStatus.PAUSED
-        db.commit()
+        await db.commit()
+        task_index.upsert(task)
         return {"status": "paused", "message": "Задание остановлено"}
     else:
         raise HTTPException(status_code=400, detail="Задание уже остановлено или завершено")
 
 @router.patch("/{task_id}/resume")
-async def resume_task(task_id: int, telegram_id: int, db: Session = Depends(get_db)):
+async def resume_task(task_id: int, telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Возобновление задания"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    task = db.query(models.Task).filter(
+    task = await db.scalar(select(models.Task).where(
         and_(
             models.Task.id == task_id,
             models.Task.creator_id == user.id
         )
-    ).first()
+    ))
     
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
     if task.status == models.TaskStatus.PAUSED:
         task.status = models.TaskStatus.ACTIVE
-        db.commit()
+        await db.commit()
+        task_index.upsert(task, user.telegram_id)
         return {"status": "active", "message": "Задание возобновлено"}
     else:
         raise HTTPException(status_code=400, detail="Задание не может быть возобновлено")
 
 @router.patch("/{task_id}/cancel")
-async def cancel_task(task_id: int, telegram_id: int, db: Session = Depends(get_db)):
+async def cancel_task(task_id: int, telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Остановка задания с возвратом остатка на баланс"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    task = db.query(models.Task).filter(
+    # Строка задания блокируется до commit: reserve_slot (условный UPDATE той же строки)
+    # ждет отмены и после нее не проходит, поэтому все резервы видны в списке ниже
+    task = await db.scalar(select(models.Task).where(
         and_(
             models.Task.id == task_id,
             models.Task.creator_id == user.id
         )
-    ).first()
+    ).with_for_update().execution_options(populate_existing=True))
     
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
     if task.status == models.TaskStatus.COMPLETED:
         raise HTTPException(status_code=400, detail="Задание уже завершено")
+    if task.status == models.TaskStatus.CANCELLED:
+        raise HTTPException(status_code=400, detail="Задание уже остановлено")
     
     # Получаем баланс заказчика
-    balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+    balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user.id))
     if not balance:
         raise HTTPException(status_code=404, detail="Balance not found")
     
@@ -410,40 +433,45 @@ async def cancel_task(task_id: int, telegram_id: int, db: Session = Depends(get_
     print(f"[CANCEL TASK] Task {task_id}: {remaining_slots} remaining slots × {price_per_slot_ton} TON = {refund_amount_ton} TON refund")
     print(f"[CANCEL TASK] Balance before: {balance_ton} TON")
     
+    # Все возвраты применяются одной транзакцией (заказчик и исполнители)
+    changes = BalanceChangeSet()
+    
     # Возвращаем средства на баланс заказчика (конвертируем в нано-TON для БД)
     if refund_amount_ton > 0:
-        balance.ton_active_balance += ton_to_nano(refund_amount_ton)
+        changes.add(user.id, ton_to_nano(refund_amount_ton), reason="task_cancel_refund", ref_id=task.id)
     
     # Также нужно вернуть средства из эскроу исполнителей, если они есть
     # Находим все активные UserTask для этого задания
-    active_user_tasks = db.query(models.UserTask).filter(
+    active_user_tasks = (await db.scalars(select(models.UserTask).where(
         and_(
             models.UserTask.task_id == task_id,
             models.UserTask.status == models.UserTaskStatus.IN_PROGRESS
         )
-    ).all()
+    ))).all()
     
     # Возвращаем средства из эскроу исполнителей обратно на активный баланс заказчика
     for user_task in active_user_tasks:
         # Списываем средства из эскроу исполнителя
-        executor_balance = db.query(models.UserBalance).filter(
-            models.UserBalance.user_id == user_task.user_id
-        ).first()
-        if executor_balance:
-            executor_balance.ton_escrow_balance -= user_task.reward_ton
+        changes.add(user_task.user_id, -user_task.reward_ton, "escrow", reason="task_cancel_escrow", ref_id=task.id)
         
         # Возвращаем средства заказчику (из эскроу исполнителя на активный баланс заказчика)
-        balance.ton_active_balance += user_task.reward_ton
+        changes.add(user.id, user_task.reward_ton, reason="task_cancel_escrow", ref_id=task.id)
         
         # Обновляем статус UserTask
         user_task.status = models.UserTaskStatus.REFUNDED
     
+    # Резервы исполнителей возвращены вместе с эскроу
+    task.reserved_slots = 0
+    
+    await changes.apply(db)
+    
     # Останавливаем задание
     task.status = models.TaskStatus.CANCELLED
     
     # Коммитим все изменения
-    db.commit()
-    db.refresh(balance)
+    await db.commit()
+    await db.refresh(balance)
+    task_index.upsert(task)
     
     new_balance_ton = nano_to_ton(Decimal(balance.ton_active_balance))
     print(f"[CANCEL TASK] Balance after: {new_balance_ton} TON")
@@ -457,35 +485,40 @@ async def cancel_task(task_id: int, telegram_id: int, db: Session = Depends(get_
     }
 
 @router.post("/{task_id}/start", response_model=schemas.UserTaskResponse)
-async def start_task(task_id: int, telegram_id: int, db: Session = Depends(get_db)):
+async def start_task(task_id: int, telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Начало выполнения задания пользователем"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    task = db.query(models.Task).filter(models.Task.id == task_id).first()
+    task = await db.scalar(select(models.Task).where(models.Task.id == task_id))
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
     if task.status != models.TaskStatus.ACTIVE:
         raise HTTPException(status_code=400, detail="Task is not active")
     
-    if task.completed_slots >= task.total_slots:
+    if task.completed_slots + (task.reserved_slots or 0) >= task.total_slots:
         raise HTTPException(status_code=400, detail="No available slots")
     
     # Проверяем, не выполнял ли пользователь уже это задание
-    existing = db.query(models.UserTask).filter(
+    existing = await db.scalar(select(models.UserTask).where(
         and_(
             models.UserTask.user_id == user.id,
             models.UserTask.task_id == task_id
         )
-    ).first()
+    ))
     
     if existing and existing.status != models.UserTaskStatus.FAILED:
         raise HTTPException(status_code=400, detail="Task already started")
     
     # Для просмотра - сразу зачисляем средства (имитация)
     if task.task_type == models.TaskType.VIEW:
+        # Атомарно засчитываем слот (условный UPDATE, без перепродажи при одновременных стартах)
+        if not await consume_slot(db, task):
+            await db.rollback()
+            raise HTTPException(status_code=400, detail="No available slots")
+        
         # Вычитаем 10% комиссию приложения с исполнителя
         user_reward = deduct_app_commission(user.id, task.price_per_slot_ton, db)
         
@@ -500,21 +533,24 @@ async def start_task(task_id: int, telegram_id: int, db: Session = Depends(get_d
         )
         db.add(user_task)
         
-        # Начисляем исполнителю награду после вычета комиссии (безопасно, с блокировкой)
-        from app.database_optimizations import update_balance_safely
-        update_balance_safely(db, user.id, user_reward, "active")
+        # Награда исполнителю после вычета комиссии и 5% рефереру (от оригинальной награды) -
+        # одной транзакцией вместе со слотом и записью о выполнении
+        changes = BalanceChangeSet()
+        changes.add(user.id, user_reward, reason="task_reward", ref_id=task_id)
+        await add_referral_commission(user.id, task.price_per_slot_ton, db, changes)
+        await changes.apply(db)
         
-        # Начисляем 5% рефереру (от оригинальной награды)
-        add_referral_commission(user.id, task.price_per_slot_ton, db)
-        
-        # Обновляем счетчик выполненных слотов
-        task.completed_slots += 1
-        
-        db.commit()
-        db.refresh(user_task)
+        await db.commit()
+        await db.refresh(user_task)
+        task_index.upsert(task)
         return user_task
     
-    # Для подписки и комментария - создаем запись со статусом IN_PROGRESS
+    # Для подписки и комментария - резервируем слот до валидации
+    if not await reserve_slot(db, task):
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="No available slots")
+    
+    # Создаем запись со статусом IN_PROGRESS
     # price_per_slot_ton в БД хранится в нано-TON, используем напрямую
     from decimal import Decimal
     def nano_to_ton(nano: Decimal) -> Decimal:
@@ -531,52 +567,52 @@ async def start_task(task_id: int, telegram_id: int, db: Session = Depends(get_d
     )
     db.add(user_task)
     
-    # Резервируем средства в эскроу (безопасно, с блокировкой)
-    from app.database_optimizations import update_balance_safely
-    update_balance_safely(db, user.id, -price_per_slot_nano, "active")
-    update_balance_safely(db, user.id, price_per_slot_nano, "escrow")
+    # Резервируем средства в эскроу (одной транзакцией с резервом слота)
+    changes = BalanceChangeSet()
+    changes.add(user.id, -price_per_slot_nano, reason="escrow_hold", ref_id=task_id)
+    changes.add(user.id, price_per_slot_nano, "escrow", reason="escrow_hold", ref_id=task_id)
+    balances = await changes.apply(db)
     
     # Обновляем счетчик подписок, если это подписка
-    balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+    balance = balances.get(user.id)
     if task.task_type == models.TaskType.SUBSCRIPTION and balance:
         balance.subscriptions_used_24h += 1
     
-    db.commit()
-    db.refresh(user_task)
+    # Проверку комментария/подписки выполнит воркер очереди валидации
+    await db.flush()
+    enqueue_validation(db, user_task.id)
+    
+    await db.commit()
+    await db.refresh(user_task)
+    task_index.upsert(task)
     return user_task
 
 @router.post("/{task_id}/validate-comment")
-async def validate_comment(task_id: int, telegram_id: int, db: Session = Depends(get_db)):
+async def validate_comment(task_id: int, telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Валидация комментария через бота @BlackMirrowAdminBot"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user_task = db.query(models.UserTask).filter(
+    user_task = await db.scalar(select(models.UserTask).where(
         and_(
             models.UserTask.user_id == user.id,
             models.UserTask.task_id == task_id,
             models.UserTask.status == models.UserTaskStatus.IN_PROGRESS
         )
-    ).first()
+    ))
     
     if not user_task:
         raise HTTPException(status_code=404, detail="User task not found")
     
     # Используем реальную проверку через бота
     from app.comment_validator import validate_comment_task
-    import asyncio
-    
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+    # (общий для процесса клиент Bot из app.telegram_clients)
     
     await validate_comment_task(user_task.id, db)
     
     # Обновляем статус после проверки
-    db.refresh(user_task)
+    await db.refresh(user_task)
     
     if user_task.status == models.UserTaskStatus.COMPLETED:
         return {"status": "validated", "message": "Comment validated successfully"}
@@ -584,35 +620,29 @@ async def validate_comment(task_id: int, telegram_id: int, db: Session = Depends
         return {"status": "not_found", "message": "Comment not found. Please make sure you commented on the post and @BlackMirrowAdminBot is admin of the channel."}
 
 @router.post("/{task_id}/check-manually")
-async def check_task_manually(task_id: int, telegram_id: int, db: Session = Depends(get_db)):
+async def check_task_manually(task_id: int, telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Ручная проверка задания через бота @BlackMirrowAdminBot (для принудительной проверки)"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    task = db.query(models.Task).filter(models.Task.id == task_id).first()
+    task = await db.scalar(select(models.Task).where(models.Task.id == task_id))
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    user_task = db.query(models.UserTask).filter(
+    user_task = await db.scalar(select(models.UserTask).where(
         and_(
             models.UserTask.user_id == user.id,
             models.UserTask.task_id == task_id
         )
-    ).first()
+    ))
     
     if not user_task:
         raise HTTPException(status_code=404, detail="User task not found")
     
     # Используем реальную проверку через бота
     from app.comment_validator import validate_comment_task, validate_subscription_task
-    import asyncio
-    
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+    # (общий для процесса клиент Bot из app.telegram_clients)
     
     if task.task_type == models.TaskType.COMMENT:
         await validate_comment_task(user_task.id, db)
@@ -620,8 +650,8 @@ async def check_task_manually(task_id: int, telegram_id: int, db: Session = Depe
         await validate_subscription_task(user_task.id, db)
     
     # Обновляем статус после проверки
-    db.refresh(user_task)
-    db.refresh(task)
+    await db.refresh(user_task)
+    await db.refresh(task)
     
     return {
         "status": user_task.status.value,
@@ -633,35 +663,35 @@ async def check_task_manually(task_id: int, telegram_id: int, db: Session = Depe
     }
 
 @router.post("/{task_id}/report")
-async def report_task(task_id: int, telegram_id: int, db: Session = Depends(get_db)):
+async def report_task(task_id: int, telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Жалоба на задание (без описания, просто кнопка) - канал нарушает законы"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    task = db.query(models.Task).filter(models.Task.id == task_id).first()
+    task = await db.scalar(select(models.Task).where(models.Task.id == task_id))
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
     # Находим запись о выполнении задания (может быть в любом статусе)
-    user_task = db.query(models.UserTask).filter(
+    user_task = await db.scalar(select(models.UserTask).where(
         and_(
             models.UserTask.user_id == user.id,
             models.UserTask.task_id == task_id
         )
-    ).first()
+    ))
     
     if not user_task:
         raise HTTPException(status_code=404, detail="User task not found")
     
     # Проверяем, не была ли уже создана жалоба на это задание от этого пользователя
-    existing_report = db.query(models.TaskReport).filter(
+    existing_report = await db.scalar(select(models.TaskReport).where(
         and_(
             models.TaskReport.task_id == task_id,
             models.TaskReport.reporter_id == user.id,
             models.TaskReport.status == models.TaskReportStatus.PENDING
         )
-    ).first()
+    ))
     
     if existing_report:
         return {
@@ -678,7 +708,7 @@ async def report_task(task_id: int, telegram_id: int, db: Session = Depends(get_
     )
     db.add(report)
     
-    db.commit()
+    await db.commit()
     return {
         "status": "reported",
         "message": "Жалоба отправлена модератору. Спасибо за обратную связь!"
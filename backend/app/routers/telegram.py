@@ -0,0 +1,32 @@
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Request
+
+from app.telegram_webhook import ADMIN_BOT, MAIN_BOT, check_secret, telegram_webhook
+
+router = APIRouter()
+
+
+@router.post("/webhook/{bot_name}")
+async def telegram_webhook_update(
+    bot_name: str,
+    request: Request,
+    x_telegram_bot_api_secret_token: Optional[str] = Header(None),
+):
+    """
+    Прием обновлений Telegram в режиме webhook (TELEGRAM_WEBHOOK_URL).
+    Обновление только ставится в очередь; 503 - очередь заполнена, Telegram повторит доставку.
+    """
+    if not check_secret(x_telegram_bot_api_secret_token):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+    if bot_name not in (MAIN_BOT, ADMIN_BOT):
+        raise HTTPException(status_code=404, detail="Unknown bot")
+
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid update")
+
+    if not telegram_webhook.offer(bot_name, data):
+        raise HTTPException(status_code=503, detail="Update queue is full", headers={"Retry-After": "5"})
+    return {"ok": True}
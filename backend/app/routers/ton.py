@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
 from decimal import Decimal
 from app.database import get_db
 from app.schemas import (
@@ -8,12 +9,13 @@ from app.schemas import (
 )
 from app.ton_service import get_ton_service
 from app import models
+from app.balance_ledger import apply_balance_delta
 
 router = APIRouter()
 
 
 @router.post("/withdraw", response_model=TonWithdrawResponse)
-async def withdraw(payload: TonWithdrawRequest, db: Session = Depends(get_db)):
+async def withdraw(payload: TonWithdrawRequest, db: AsyncSession = Depends(get_db)):
     """
     Автоматический вывод без лимитов и ручного аппрува.
     Защита от двойных списаний через idempotency_key.
@@ -33,20 +35,21 @@ async def withdraw(payload: TonWithdrawRequest, db: Session = Depends(get_db)):
 
 
 @router.get("/transactions", response_model=list[TonTransactionResponse])
-async def list_transactions(db: Session = Depends(get_db)):
+async def list_transactions(db: AsyncSession = Depends(get_db)):
     """Журнал всех TON-транзакций."""
     records = (
-        db.query(models.TonTransaction)
-        .order_by(models.TonTransaction.created_at.desc())
-        .all()
-    )
+        await db.scalars(
+            select(models.TonTransaction)
+            .order_by(models.TonTransaction.created_at.desc())
+        )
+    ).all()
     return records
 
 
 @router.get("/transactions/{transaction_id}", response_model=TonTransactionResponse)
-async def get_transaction(transaction_id: int, db: Session = Depends(get_db)):
+async def get_transaction(transaction_id: int, db: AsyncSession = Depends(get_db)):
     """Получение конкретной транзакции по ID."""
-    tx = db.query(models.TonTransaction).filter(models.TonTransaction.id == transaction_id).first()
+    tx = await db.scalar(select(models.TonTransaction).where(models.TonTransaction.id == transaction_id))
     if not tx:
         from fastapi import HTTPException
         raise HTTPException(status_code=404, detail="Transaction not found")
@@ -54,24 +57,25 @@ async def get_transaction(transaction_id: int, db: Session = Depends(get_db)):
 
 
 @router.get("/transactions/user/{telegram_id}", response_model=list[TonTransactionResponse])
-async def get_user_transactions(telegram_id: int, db: Session = Depends(get_db)):
+async def get_user_transactions(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Получение всех транзакций пользователя."""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         from fastapi import HTTPException
         raise HTTPException(status_code=404, detail="User not found")
     
     records = (
-        db.query(models.TonTransaction)
-        .filter(models.TonTransaction.user_id == user.id)
-        .order_by(models.TonTransaction.created_at.desc())
-        .all()
-    )
+        await db.scalars(
+            select(models.TonTransaction)
+            .where(models.TonTransaction.user_id == user.id)
+            .order_by(models.TonTransaction.created_at.desc())
+        )
+    ).all()
     return records
 
 
 @router.post("/admin/withdraw", response_model=TonWithdrawResponse)
-async def admin_withdraw(payload: TonAdminWithdrawRequest, db: Session = Depends(get_db)):
+async def admin_withdraw(payload: TonAdminWithdrawRequest, db: AsyncSession = Depends(get_db)):
     """
     Вывод с сервисного кошелька на любой адрес.
     Используется администратором для прямого вывода средств.
@@ -98,9 +102,9 @@ async def admin_withdraw(payload: TonAdminWithdrawRequest, db: Session = Depends
 
 
 @router.post("/transactions/{transaction_id}/check-status")
-async def check_transaction_status(transaction_id: int, db: Session = Depends(get_db)):
+async def check_transaction_status(transaction_id: int, db: AsyncSession = Depends(get_db)):
     """Проверяет и обновляет статус транзакции через tonapi."""
-    tx = db.query(models.TonTransaction).filter(models.TonTransaction.id == transaction_id).first()
+    tx = await db.scalar(select(models.TonTransaction).where(models.TonTransaction.id == transaction_id))
     if not tx:
         from fastapi import HTTPException
         raise HTTPException(status_code=404, detail="Transaction not found")
@@ -110,20 +114,20 @@ async def check_transaction_status(transaction_id: int, db: Session = Depends(ge
     
     if new_status == "completed" and tx.status != "completed":
         tx.status = "completed"
-        db.commit()
+        await db.commit()
     elif new_status == "failed" and tx.status != "failed":
         tx.status = "failed"
         # Возвращаем средства пользователю только если это был пользовательский вывод
         if tx.user_id:
-            user = db.query(models.User).filter(models.User.id == tx.user_id).first()
+            user = await db.scalar(select(models.User).where(models.User.id == tx.user_id))
             if user:
-                balance = db.query(models.UserBalance).filter(
+                balance = await db.scalar(select(models.UserBalance).where(
                     models.UserBalance.user_id == user.id
-                ).first()
+                ))
                 if balance:
-                    balance.ton_active_balance += tx.amount_nano
-        db.commit()
+                    apply_balance_delta(db, balance, tx.amount_nano, reason="withdrawal_failed_refund", ref_id=tx.id)
+        await db.commit()
     
-    db.refresh(tx)
+    await db.refresh(tx)
     return {"transaction_id": tx.id, "status": tx.status, "checked_status": new_status}
 
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, and_, select
 from app.database import get_db
 from app import models, schemas
 from typing import Optional, List
@@ -16,9 +16,9 @@ def generate_referral_code() -> str:
     return ''.join(secrets.choice(alphabet) for _ in range(8))
 
 @router.post("/", response_model=schemas.UserResponse)
-async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     """Создание или обновление пользователя"""
-    db_user = db.query(models.User).filter(models.User.telegram_id == user.telegram_id).first()
+    db_user = await db.scalar(select(models.User).where(models.User.telegram_id == user.telegram_id))
     
     if db_user:
         # Обновляем существующего пользователя
@@ -27,16 +27,16 @@ async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         if 'referrer_code' in user_dict and not db_user.referrer_id:
             referrer_code = user_dict.pop('referrer_code')
             if referrer_code:
-                referrer = db.query(models.User).filter(models.User.referral_code == referrer_code).first()
+                referrer = await db.scalar(select(models.User).where(models.User.referral_code == referrer_code))
                 if referrer and referrer.id != db_user.id:
                     db_user.referrer_id = referrer.id
                     # Проверяем, нет ли уже записи о реферале
-                    existing_referral = db.query(models.Referral).filter(
+                    existing_referral = await db.scalar(select(models.Referral).where(
                         and_(
                             models.Referral.referrer_id == referrer.id,
                             models.Referral.referred_id == db_user.id
                         )
-                    ).first()
+                    ))
                     if not existing_referral:
                         # Создаем запись о реферале
                         referral = models.Referral(referrer_id=referrer.id, referred_id=db_user.id)
@@ -45,8 +45,8 @@ async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         for key, value in user_dict.items():
             if key != 'referrer_code':  # Не обновляем referrer_code через обычное обновление
                 setattr(db_user, key, value)
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
         return db_user
     
     # Создаем нового пользователя
@@ -55,7 +55,7 @@ async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     
     # Генерируем уникальный реферальный код
     referral_code = generate_referral_code()
-    while db.query(models.User).filter(models.User.referral_code == referral_code).first():
+    while await db.scalar(select(models.User).where(models.User.referral_code == referral_code)):
         referral_code = generate_referral_code()
     
     user_dict['referral_code'] = referral_code
@@ -63,7 +63,7 @@ async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     # Обрабатываем реферальный код
     referrer_id = None
     if referrer_code:
-        referrer = db.query(models.User).filter(models.User.referral_code == referrer_code).first()
+        referrer = await db.scalar(select(models.User).where(models.User.referral_code == referrer_code))
         if referrer:
             referrer_id = referrer.id
     
@@ -72,8 +72,8 @@ async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     
     db_user = models.User(**user_dict)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     # Создаем запись о реферале, если есть реферер
     if referrer_id:
@@ -88,14 +88,14 @@ async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         fiat_currency="RUB"
     )
     db.add(db_balance)
-    db.commit()
+    await db.commit()
     
     return db_user
 
 @router.get("/{telegram_id}", response_model=schemas.UserResponse)
-async def get_user(telegram_id: int, db: Session = Depends(get_db)):
+async def get_user(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Получение пользователя по telegram_id"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -106,29 +106,29 @@ async def get_user(telegram_id: int, db: Session = Depends(get_db)):
             user.is_banned = False
             user.ban_until = None
             user.ban_reason = None
-            db.commit()
-            db.refresh(user)
+            await db.commit()
+            await db.refresh(user)
     
     return user
 
 @router.put("/{telegram_id}", response_model=schemas.UserResponse)
-async def update_user(telegram_id: int, user_update: schemas.UserUpdate, db: Session = Depends(get_db)):
+async def update_user(telegram_id: int, user_update: schemas.UserUpdate, db: AsyncSession = Depends(get_db)):
     """Обновление профиля пользователя"""
-    db_user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    db_user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
     
     for key, value in user_update.dict(exclude_unset=True).items():
         setattr(db_user, key, value)
     
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 @router.get("/{telegram_id}/profile-complete")
-async def check_profile_complete(telegram_id: int, db: Session = Depends(get_db)):
+async def check_profile_complete(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Проверка заполненности обязательных полей профиля"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -136,25 +136,25 @@ async def check_profile_complete(telegram_id: int, db: Session = Depends(get_db)
     return {"is_complete": is_complete, "missing_fields": []}
 
 @router.get("/{telegram_id}/referral-info", response_model=schemas.ReferralInfo)
-async def get_referral_info(telegram_id: int, db: Session = Depends(get_db)):
+async def get_referral_info(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Получение информации о реферальной программе"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     if not user.referral_code:
         # Генерируем код, если его нет
         referral_code = generate_referral_code()
-        while db.query(models.User).filter(models.User.referral_code == referral_code).first():
+        while await db.scalar(select(models.User).where(models.User.referral_code == referral_code)):
             referral_code = generate_referral_code()
         user.referral_code = referral_code
-        db.commit()
+        await db.commit()
     
     # Подсчитываем рефералов
-    total_referrals = db.query(models.Referral).filter(models.Referral.referrer_id == user.id).count()
+    total_referrals = await db.scalar(select(func.count()).select_from(models.Referral).where(models.Referral.referrer_id == user.id))
     
     # Подсчитываем заработок с рефералов
-    balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+    balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user.id))
     total_earned_ton = balance.ton_referral_earnings if balance else Decimal(0)
     
     # Конвертируем в фиат
@@ -173,17 +173,17 @@ async def get_referral_info(telegram_id: int, db: Session = Depends(get_db)):
     )
 
 @router.get("/{telegram_id}/referrals", response_model=List[schemas.ReferralDetail])
-async def get_referrals(telegram_id: int, db: Session = Depends(get_db)):
+async def get_referrals(telegram_id: int, db: AsyncSession = Depends(get_db)):
     """Получение списка рефералов"""
-    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    referrals = db.query(models.Referral).filter(models.Referral.referrer_id == user.id).all()
+    referrals = (await db.scalars(select(models.Referral).where(models.Referral.referrer_id == user.id))).all()
     
     result = []
     for ref in referrals:
-        referred_user = db.query(models.User).filter(models.User.id == ref.referred_id).first()
+        referred_user = await db.scalar(select(models.User).where(models.User.id == ref.referred_id))
         result.append(schemas.ReferralDetail(
             referred_username=referred_user.username if referred_user else None,
             referred_first_name=referred_user.first_name if referred_user else None,
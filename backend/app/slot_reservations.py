@@ -0,0 +1,147 @@
+"""
+Резервирование слотов заданий.
+
+Слот занимается условным UPDATE по строке задания:
+    UPDATE tasks SET reserved_slots = reserved_slots + 1
+    WHERE id = :id AND status = 'active' AND completed_slots + reserved_slots < total_slots
+Проверка и изменение счетчика - одна операция в БД, поэтому при одновременных
+стартах задание не продается сверх total_slots. Блокируется только строка
+задания и только до commit вызывающей транзакции.
+
+reserved_slots - число исполнителей в статусе IN_PROGRESS. При валидации
+резерв переходит в completed_slots, при отмене/истечении - освобождается.
+Заявки IN_PROGRESS, не подтвержденные за RESERVATION_TTL_HOURS от взятия
+задания (очередь валидации за это время проверяет их каждые 5 минут), считаются
+брошенными: эскроу возвращается исполнителю, слот освобождается. Это не окно
+эскроу (escrow_ends_at, 7 дней): оно относится к подтвержденным заявкам, а
+неподтвержденная заявка держит слот только несколько часов.
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import models
+from app.balance_ledger import BalanceChangeSet
+from app.task_index import task_index
+
+# Сколько часов неподтвержденная заявка держит слот
+RESERVATION_TTL_HOURS = int(os.getenv("RESERVATION_TTL_HOURS", "2"))
+
+
+def _available():
+    return models.Task.completed_slots + models.Task.reserved_slots < models.Task.total_slots
+
+
+def _released_reserve():
+    # Заявки, созданные до появления счетчика, резерва не занимали - не уходим в минус
+    return case((models.Task.reserved_slots > 0, models.Task.reserved_slots - 1), else_=0)
+
+
+async def _update_slots(db: AsyncSession, task: models.Task, conditions, values) -> bool:
+    """Условный UPDATE счетчиков задания; при успехе обновляет объект task значениями из RETURNING."""
+    row = (await db.execute(
+        update(models.Task)
+        .where(models.Task.id == task.id, *conditions)
+        .values(**values)
+        .returning(models.Task.completed_slots, models.Task.reserved_slots)
+        .execution_options(synchronize_session=False)
+    )).first()
+    if row is None:
+        return False
+    set_committed_value(task, "completed_slots", row.completed_slots)
+    set_committed_value(task, "reserved_slots", row.reserved_slots)
+    return True
+
+
+async def reserve_slot(db: AsyncSession, task: models.Task) -> bool:
+    """Занимает слот под заявку IN_PROGRESS. False - свободных слотов нет или задание не активно."""
+    return await _update_slots(
+        db, task,
+        (models.Task.status == models.TaskStatus.ACTIVE, _available()),
+        {"reserved_slots": models.Task.reserved_slots + 1},
+    )
+
+
+async def consume_slot(db: AsyncSession, task: models.Task) -> bool:
+    """Сразу засчитывает слот как выполненный (просмотры, без эскроу)."""
+    return await _update_slots(
+        db, task,
+        (models.Task.status == models.TaskStatus.ACTIVE, _available()),
+        {"completed_slots": models.Task.completed_slots + 1},
+    )
+
+
+async def complete_reservation(db: AsyncSession, task: models.Task) -> bool:
+    """Заявка подтверждена: резерв переходит в выполненные слоты."""
+    return await _update_slots(
+        db, task, (),
+        {"reserved_slots": _released_reserve(), "completed_slots": models.Task.completed_slots + 1},
+    )
+
+
+async def release_reservation(db: AsyncSession, task: models.Task) -> bool:
+    """Заявка отменена или брошена: слот снова доступен."""
+    return await _update_slots(db, task, (), {"reserved_slots": _released_reserve()})
+
+
+async def revoke_completed_slot(db: AsyncSession, task: models.Task) -> bool:
+    """Засчитанный слот отменен (отписка после валидации): слот снова доступен. Счетчик не уходит в минус."""
+    return await _update_slots(
+        db, task, (models.Task.completed_slots > 0,),
+        {"completed_slots": models.Task.completed_slots - 1},
+    )
+
+
+async def expire_abandoned_reservations(db: AsyncSession) -> int:
+    """
+    Переводит в FAILED заявки IN_PROGRESS старше RESERVATION_TTL_HOURS,
+    возвращает исполнителю средства из эскроу и освобождает слот.
+    Каждая заявка - отдельная транзакция.
+
+    Returns:
+        Количество освобожденных заявок
+    """
+    deadline = datetime.utcnow() - timedelta(hours=RESERVATION_TTL_HOURS)
+    expired_ids = (await db.scalars(
+        select(models.UserTask.id).where(
+            models.UserTask.status == models.UserTaskStatus.IN_PROGRESS,
+            func.coalesce(models.UserTask.escrow_started_at, models.UserTask.created_at) < deadline
+        )
+    )).all()
+
+    expired = 0
+    for user_task_id in expired_ids:
+        user_task = await db.scalar(
+            select(models.UserTask)
+            .where(models.UserTask.id == user_task_id)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+        # Заявку могли подтвердить, пока мы шли по списку
+        if not user_task or user_task.status != models.UserTaskStatus.IN_PROGRESS:
+            await db.rollback()
+            continue
+
+        changes = BalanceChangeSet()
+        changes.add(user_task.user_id, -user_task.reward_ton, "escrow", reason="reservation_expired", ref_id=user_task.id)
+        changes.add(user_task.user_id, user_task.reward_ton, reason="reservation_expired", ref_id=user_task.id)
+        await changes.apply(db)
+
+        user_task.status = models.UserTaskStatus.FAILED
+        user_task.validation_result = False
+
+        task = await db.get(models.Task, user_task.task_id)
+        if task:
+            await release_reservation(db, task)
+
+        await db.commit()
+        if task:
+            task_index.upsert(task)
+        expired += 1
+
+    if expired:
+        print(f"[SLOT RESERVATIONS] Expired {expired} abandoned reservations", flush=True)
+    return expired
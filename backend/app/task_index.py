@@ -0,0 +1,215 @@
+"""
+In-process индекс таргетинга для ленты заданий.
+
+Держит в памяти активные задания с оставшимися слотами, разложенные по
+стране, полу, возрастной корзине и типу задания. Набор заданий, доступных
+пользователю, считается пересечением множеств вместо SQL-запроса с OR-фильтрами.
+
+Индекс обновляется при создании, остановке, возобновлении, отмене задания и
+при изменении числа выполненных слотов. Изменения, сделанные в обход API
+(админка, другой воркер), подхватываются полной перестройкой раз в
+TASK_INDEX_REFRESH_SECONDS.
+"""
+import asyncio
+import heapq
+import os
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import select, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+
+TASK_INDEX_REFRESH_SECONDS = int(os.getenv("TASK_INDEX_REFRESH_SECONDS", "60"))
+
+# Возрастные корзины по одному году: задание с диапазоном 18-35 лежит в 18 корзинах,
+# поэтому проверка возраста - это просто поиск по ключу
+MAX_TARGET_AGE = 120
+
+
+@dataclass
+class IndexedTask:
+    id: int
+    price_per_slot_ton: Decimal
+    task_type: models.TaskType
+    target_country: Optional[str]
+    target_gender: Optional[str]
+    target_age_min: Optional[int]
+    target_age_max: Optional[int]
+
+
+class TaskTargetingIndex:
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._loaded_at: Optional[float] = None
+        self._rebuilding = False
+        self._pending_changes: list = []
+        self._reset()
+
+    def _reset(self):
+        self.tasks: Dict[int, IndexedTask] = {}
+        # Ключ None - задание без ограничения по этому признаку
+        self.by_country: Dict[Optional[str], Set[int]] = {}
+        self.by_gender: Dict[Optional[str], Set[int]] = {}
+        self.by_age: Dict[Optional[int], Set[int]] = {}
+        self.by_type: Dict[models.TaskType, Set[int]] = {}
+
+    # --- Построение ---------------------------------------------------------
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > TASK_INDEX_REFRESH_SECONDS
+
+    def invalidate(self):
+        """Принудительная перестройка при следующем чтении (массовые изменения в админке)."""
+        self._loaded_at = None
+
+    async def ensure_fresh(self, db: AsyncSession):
+        """Перестраивает индекс из БД, если он еще не загружен или устарел."""
+        if not self.is_stale():
+            return
+        async with self._lock:
+            if not self.is_stale():
+                return
+            await self._rebuild(db)
+
+    async def _rebuild(self, db: AsyncSession):
+        self._rebuilding = True
+        self._pending_changes = []
+        try:
+            rows = (await db.execute(
+                select(models.Task, models.User.telegram_id)
+                .join(models.User, models.User.id == models.Task.creator_id)
+                .where(
+                    models.Task.status == models.TaskStatus.ACTIVE,
+                    or_(models.Task.is_test == False, models.Task.is_test.is_(None)),
+                    models.Task.completed_slots + models.Task.reserved_slots < models.Task.total_slots
+                )
+            )).all()
+
+            self._reset()
+            for task, creator_telegram_id in rows:
+                self._apply(task, creator_telegram_id)
+
+            # Изменения, закоммиченные пока шел SELECT, могли в него не попасть
+            for task_id, snapshot in self._pending_changes:
+                self._discard(task_id)
+                if snapshot is not None:
+                    self._add(snapshot)
+            self._loaded_at = time.monotonic()
+            print(f"[TASK INDEX] Rebuilt: {len(self.tasks)} active tasks", flush=True)
+        finally:
+            self._rebuilding = False
+            self._pending_changes = []
+
+    # --- Обновления ---------------------------------------------------------
+
+    def upsert(self, task: models.Task, creator_telegram_id: Optional[int] = None):
+        """
+        Обновляет задание в индексе после commit: создание, пауза, возобновление,
+        отмена, изменение completed_slots / reserved_slots. Неактивные и исчерпанные задания удаляются.
+        """
+        snapshot = self._apply(task, creator_telegram_id)
+        if self._rebuilding:
+            self._pending_changes.append((task.id, snapshot))
+
+    def remove(self, task_id: int):
+        self._discard(task_id)
+        if self._rebuilding:
+            self._pending_changes.append((task_id, None))
+
+    def _apply(self, task: models.Task, creator_telegram_id: Optional[int]) -> Optional[IndexedTask]:
+        self._discard(task.id)
+        remaining_slots = (task.total_slots or 0) - (task.completed_slots or 0) - (task.reserved_slots or 0)
+        if (
+            task.status != models.TaskStatus.ACTIVE
+            or task.is_test
+            or remaining_slots <= 0
+            or (creator_telegram_id is not None and creator_telegram_id <= 0)
+        ):
+            return None
+
+        entry = IndexedTask(
+            id=task.id,
+            price_per_slot_ton=Decimal(task.price_per_slot_ton),
+            task_type=models.TaskType(task.task_type),
+            target_country=task.target_country,
+            target_gender=task.target_gender,
+            target_age_min=task.target_age_min,
+            target_age_max=task.target_age_max,
+        )
+        self._add(entry)
+        return entry
+
+    def _add(self, entry: IndexedTask):
+        self.tasks[entry.id] = entry
+        self.by_country.setdefault(entry.target_country, set()).add(entry.id)
+        self.by_gender.setdefault(entry.target_gender, set()).add(entry.id)
+        self.by_type.setdefault(entry.task_type, set()).add(entry.id)
+        for age in self._age_keys(entry):
+            self.by_age.setdefault(age, set()).add(entry.id)
+
+    def _discard(self, task_id: int):
+        entry = self.tasks.pop(task_id, None)
+        if entry is None:
+            return
+        self.by_country.get(entry.target_country, set()).discard(task_id)
+        self.by_gender.get(entry.target_gender, set()).discard(task_id)
+        self.by_type.get(entry.task_type, set()).discard(task_id)
+        for age in self._age_keys(entry):
+            self.by_age.get(age, set()).discard(task_id)
+
+    @staticmethod
+    def _age_keys(entry: IndexedTask) -> List[Optional[int]]:
+        if entry.target_age_min is None and entry.target_age_max is None:
+            return [None]
+        age_min = max(entry.target_age_min or 0, 0)
+        age_max = min(entry.target_age_max if entry.target_age_max is not None else MAX_TARGET_AGE, MAX_TARGET_AGE)
+        return list(range(age_min, age_max + 1))
+
+    # --- Чтение -------------------------------------------------------------
+
+    def eligible_ids(
+        self,
+        country: Optional[str] = None,
+        gender: Optional[str] = None,
+        age: Optional[int] = None,
+        task_type: Optional[str] = None,
+        exclude_subscriptions: bool = False,
+    ) -> Set[int]:
+        """
+        ID заданий, доступных пользователю. Таргетинг применяется только при
+        заполненном профиле (country, gender и age заданы), как и раньше в get_tasks.
+        """
+        if country and gender and age:
+            result = self.by_country.get(None, set()) | self.by_country.get(country, set())
+            result &= self.by_gender.get(None, set()) | self.by_gender.get(gender, set())
+            result &= self.by_age.get(None, set()) | self.by_age.get(age, set())
+        else:
+            result = set(self.tasks)
+
+        if task_type:
+            try:
+                result &= self.by_type.get(models.TaskType(task_type), set())
+            except ValueError:
+                return set()
+        if exclude_subscriptions:
+            result -= self.by_type.get(models.TaskType.SUBSCRIPTION, set())
+        return result
+
+    def page(self, ids: Set[int], after: Optional[Tuple[Decimal, int]], limit: int, descending: bool = True) -> List[int]:
+        """
+        Keyset-страница по (price_per_slot_ton, id) в порядке убывания (descending=False - возрастания):
+        не больше limit заданий из ids, идущих строго после курсора after = (цена, id).
+        """
+        sign = -1 if descending else 1
+        after_key = (sign * Decimal(after[0]), sign * after[1]) if after else None
+        keys = ((sign * self.tasks[i].price_per_slot_ton, sign * i) for i in ids if i in self.tasks)
+        if after_key is not None:
+            keys = (key for key in keys if key > after_key)
+        return [sign * task_id for _, task_id in heapq.nsmallest(limit, keys)]
+
+
+task_index = TaskTargetingIndex()
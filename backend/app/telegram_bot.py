@@ -2,10 +2,13 @@
 Telegram Bot для BlackMirrowMarket
 Пока базовая структура, будет расширена для валидации заданий
 """
+import asyncio
 import os
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes
 from dotenv import load_dotenv
+from app.telegram_clients import shared_bot
 
 load_dotenv()
 
@@ -37,9 +40,17 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/help - Показать справку"
     )
 
-def setup_bot(token: str):
-    """Настройка и запуск бота"""
-    application = Application.builder().token(token).build()
+def setup_bot(token: str, update_queue: Optional[asyncio.Queue] = None):
+    """
+    Настройка и запуск бота.
+    update_queue - ограниченная очередь для режима webhook (app.telegram_webhook).
+    """
+    # Общий для процесса клиент Bot с пулом соединений; Application сама инициализирует
+    # и закрывает его при запуске/остановке polling
+    builder = Application.builder().bot(shared_bot(token))
+    if update_queue is not None:
+        builder = builder.update_queue(update_queue)
+    application = builder.build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -0,0 +1,71 @@
+"""
+Общие клиенты Telegram Bot API на процесс.
+
+Один telegram.Bot на токен с пулом HTTP-соединений: валидатор, ручные проверки
+из routers/tasks.py, ингестия обновлений и telegram_bot.py используют одни и те же
+keep-alive соединения вместо нового пула и TLS-рукопожатия на каждую проверку.
+Long polling (getUpdates) идет через отдельный запрос-объект и не занимает общий пул.
+Клиенты закрываются в shutdown_bots() при остановке приложения.
+"""
+import asyncio
+import os
+from typing import Dict
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+TELEGRAM_ADMIN_BOT_TOKEN = os.getenv("TELEGRAM_ADMIN_BOT_TOKEN")
+
+# Размер пула соединений к api.telegram.org (параллельные проверки подписок упираются в него)
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.getenv("TELEGRAM_CONNECTION_POOL_SIZE", "32"))
+
+_bots: Dict[str, Bot] = {}
+_init_lock = asyncio.Lock()
+
+
+def shared_bot(token: str) -> Bot:
+    """Bot для токена (создается один раз на процесс, без инициализации)."""
+    bot = _bots.get(token)
+    if bot is None:
+        bot = Bot(
+            token=token,
+            request=HTTPXRequest(
+                connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE,
+                pool_timeout=10.0,
+            ),
+            get_updates_request=HTTPXRequest(connection_pool_size=1),
+        )
+        _bots[token] = bot
+    return bot
+
+
+async def get_bot(token: str) -> Bot:
+    """Инициализированный общий Bot для токена."""
+    bot = shared_bot(token)
+    if not bot._initialized:
+        async with _init_lock:
+            if not bot._initialized:
+                try:
+                    await bot.initialize()
+                except Exception as e:
+                    # Bot API доступен и без get_me - инициализация повторится при следующем вызове
+                    print(f"[TELEGRAM] Bot initialization failed: {e}")
+    return bot
+
+
+async def get_admin_bot() -> Bot:
+    """Общий клиент @BlackMirrowAdminBot (валидация комментариев и подписок)."""
+    return await get_bot(TELEGRAM_ADMIN_BOT_TOKEN)
+
+
+async def shutdown_bots():
+    """Закрывает пулы соединений всех ботов процесса."""
+    for bot in list(_bots.values()):
+        try:
+            if bot._initialized:
+                await bot.shutdown()
+            else:
+                await bot.request.shutdown()
+        except Exception as e:
+            print(f"[TELEGRAM] Error shutting down bot: {e}")
+    _bots.clear()
@@ -0,0 +1,87 @@
+"""
+Ограничение частоты запросов к Telegram Bot API.
+
+Token bucket глобально на бота и отдельно на каждый чат. При ответе 429
+(RetryAfter) весь бот делает паузу на retry_after секунд - Telegram считает
+лимит на токен бота, а не на отдельный запрос - и запрос повторяется.
+"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+from telegram.error import RetryAfter
+
+T = TypeVar("T")
+
+# Telegram не публикует лимиты для методов чтения; ориентируемся на лимиты отправки
+# (~30 запросов/с на бота) с запасом, остальное отлавливаем через 429
+TELEGRAM_GLOBAL_RPS = float(os.getenv("TELEGRAM_GLOBAL_RPS", "25"))
+TELEGRAM_PER_CHAT_RPS = float(os.getenv("TELEGRAM_PER_CHAT_RPS", "5"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+
+# Сколько бакетов чатов держать в памяти
+MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TelegramRateLimiter:
+    def __init__(self, global_rps: float = TELEGRAM_GLOBAL_RPS, per_chat_rps: float = TELEGRAM_PER_CHAT_RPS):
+        self.global_bucket = TokenBucket(global_rps)
+        self.per_chat_rps = per_chat_rps
+        self.chat_buckets: Dict[Hashable, TokenBucket] = {}
+        self._paused_until = 0.0
+
+    def _chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                self.chat_buckets.clear()
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rps)
+        return bucket
+
+    async def _wait_pause(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def call(self, chat_id: Hashable, request: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполняет запрос к Bot API с учетом лимитов.
+        request - функция без аргументов, создающая корутину (нужна для повтора).
+        После TELEGRAM_MAX_RETRIES ответов 429 пробрасывает RetryAfter.
+        """
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            await self._wait_pause()
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await request()
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                print(f"[TELEGRAM] 429 for chat {chat_id}, retry after {retry_after}s (attempt {attempt + 1})")
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+
+
+telegram_limiter = TelegramRateLimiter()
@@ -0,0 +1,372 @@
+"""
+Ингестия обновлений админ-бота (@BlackMirrowAdminBot).
+
+Цикл getUpdates забирает сообщения из групп обсуждений каналов и сохраняет их
+в discussion_messages. Offset хранится в telegram_update_offsets и фиксируется
+в той же транзакции, что и сообщения, поэтому после рестарта обновления не
+теряются и не записываются повторно.
+
+Telegram допускает одного потребителя getUpdates на токен, а цикл запускается в
+каждом воркере API. Опрашивает тот процесс, который держит аренду строки offset
+(lease_owner / lease_until, условный UPDATE - как аренда в recheck_scheduler),
+остальные ждут ее окончания. Long poll идет вне транзакции: offset читается
+вместе с продлением аренды, результаты записываются новой транзакцией.
+
+Проверка комментария к заданию - один поиск по индексу
+(chat_id, reply_to_message_id, from_user_id) вместо отдельного getUpdates
+на каждое задание.
+
+Комментарий в группе обсуждения - это ответ на автоматически пересланный пост
+канала. Такой комментарий сохраняется с chat_id/chat_username канала и
+reply_to_message_id = номер поста в канале, т.е. ровно так, как задание
+ссылается на пост (https://t.me/channel/123).
+
+Удаление сообщения Bot API не присылает, поэтому перепроверка комментария
+(comment_validator.check_comment_periodically) проверяет сохраненное сообщение
+вживую: бот копирует его в служебный чат TELEGRAM_COMMENT_PROBE_CHAT_ID и сразу
+удаляет копию (без уведомления); "message to copy not found" - комментарий
+удален. Это два запроса на проверку, поэтому проверки идут с нарастающим
+интервалом (recheck_scheduler.RECHECK_BACKOFF_TYPES). Без служебного
+чата удаление обнаружить нельзя, и перепроверки комментариев не назначаются.
+
+Обновления chat_member (приходят из каналов, где бот администратор) дают
+события выхода пользователя из канала - они сохраняются в
+channel_member_events, и по ним возвращается эскроу отписавшихся
+(comment_validator.process_leave_events) без ежедневного get_chat_member.
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple, Union
+
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram import Bot, ChatMember, ChatMemberUpdated, Message, Update
+from telegram.error import BadRequest, TelegramError
+
+from app import models
+from app.database import AsyncSessionLocal
+from app.telegram_clients import get_admin_bot
+
+TELEGRAM_ADMIN_BOT_TOKEN = os.getenv("TELEGRAM_ADMIN_BOT_TOKEN")
+
+ADMIN_BOT_NAME = "admin"
+
+# Long polling: сколько секунд Telegram держит запрос, если обновлений нет
+UPDATES_POLL_TIMEOUT = int(os.getenv("TELEGRAM_UPDATES_POLL_TIMEOUT", "25"))
+
+# Аренда опроса: продлевается на каждом шаге цикла, после падения процесса ее через
+# UPDATES_LEASE_SECONDS забирает другой; процесс без аренды проверяет ее раз в UPDATES_STANDBY_SECONDS
+UPDATES_LEASE_SECONDS = UPDATES_POLL_TIMEOUT + 35
+UPDATES_STANDBY_SECONDS = 15
+
+# Сколько дней хранить сообщения (проверка комментария идет до часа после валидации)
+DISCUSSION_MESSAGES_RETENTION_DAYS = int(os.getenv("DISCUSSION_MESSAGES_RETENTION_DAYS", "14"))
+
+# Служебный чат (бот - участник) для проверки, не удален ли комментарий
+TELEGRAM_COMMENT_PROBE_CHAT_ID = os.getenv("TELEGRAM_COMMENT_PROBE_CHAT_ID")
+
+# chat_member нужно запрашивать явно - по умолчанию Telegram его не присылает
+ALLOWED_UPDATES = ["message", "edited_message", "chat_member"]
+
+# Статусы, при которых пользователь считается подписчиком (как в check_subscription_exists)
+MEMBER_STATUSES = {ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER}
+
+
+def parse_post_link(post_link: str) -> Optional[Tuple[Union[int, str], int]]:
+    """
+    Разбирает ссылку на пост.
+
+    https://t.me/c/3503023298/3 -> (-1003503023298, 3)  (приватный канал, chat_id как в Bot API)
+    https://t.me/channel/123    -> ("channel", 123)
+    """
+    try:
+        if '/c/' in post_link:
+            parts = post_link.split('/c/', 1)[1].split('/')
+            if len(parts) >= 2:
+                return int(f"-100{parts[0]}"), int(parts[1])
+        else:
+            parts = post_link.replace('https://', '').replace('http://', '').replace('t.me/', '').split('/')
+            if len(parts) >= 2:
+                return parts[0].lstrip('@').lower(), int(parts[1])
+    except ValueError:
+        pass
+    return None
+
+
+def message_record(message: Message) -> dict:
+    """Поля DiscussionMessage для сообщения из группы."""
+    chat_id = message.chat.id
+    chat_username = message.chat.username
+    reply_to_message_id = None
+
+    reply = message.reply_to_message
+    if reply:
+        reply_to_message_id = reply.message_id
+        # Комментарий к посту: ответ на автоматическую пересылку поста канала в группу обсуждения
+        if reply.forward_from_chat and reply.forward_from_message_id:
+            chat_id = reply.forward_from_chat.id
+            chat_username = reply.forward_from_chat.username
+            reply_to_message_id = reply.forward_from_message_id
+
+    return {
+        "source_chat_id": message.chat.id,
+        "message_id": message.message_id,
+        "chat_id": chat_id,
+        "chat_username": chat_username.lower() if chat_username else None,
+        "reply_to_message_id": reply_to_message_id,
+        "from_user_id": message.from_user.id if message.from_user else None,
+        "text": message.text or message.caption,
+    }
+
+
+def _is_member(member: ChatMember) -> bool:
+    if member.status in MEMBER_STATUSES:
+        return True
+    return member.status == ChatMember.RESTRICTED and bool(getattr(member, "is_member", False))
+
+
+def leave_event(update: ChatMemberUpdated) -> Optional[models.ChannelMemberEvent]:
+    """Событие выхода из канала или None, если это не выход (вступление, смена прав)."""
+    if update.chat.type != "channel":
+        return None
+    if not _is_member(update.old_chat_member) or _is_member(update.new_chat_member):
+        return None
+    username = update.chat.username
+    return models.ChannelMemberEvent(
+        chat_id=update.chat.id,
+        chat_username=username.lower() if username else None,
+        user_telegram_id=update.new_chat_member.user.id,
+        old_status=update.old_chat_member.status,
+        new_status=update.new_chat_member.status,
+        event_at=update.date.replace(tzinfo=None) if update.date.tzinfo else update.date,
+    )
+
+
+async def store_updates(db: AsyncSession, updates: List[Update]) -> int:
+    """
+    Сохраняет сообщения групп и выходы из каналов из пачки обновлений (commit не делает).
+    Отредактированные сообщения обновляют текст уже сохраненных.
+
+    Returns:
+        Количество новых сообщений и событий выхода
+    """
+    records = {}
+    leaves = 0
+    for update in updates:
+        if update.chat_member:
+            event = leave_event(update.chat_member)
+            if event is not None:
+                db.add(event)
+                leaves += 1
+            continue
+        message = update.message or update.edited_message
+        if not message or not message.chat or message.chat.type == "private":
+            continue
+        record = message_record(message)
+        records[(record["source_chat_id"], record["message_id"])] = record
+    if not records:
+        return leaves
+
+    existing = {
+        (row.source_chat_id, row.message_id): row
+        for row in (await db.scalars(
+            select(models.DiscussionMessage).where(or_(*[
+                and_(
+                    models.DiscussionMessage.source_chat_id == source_chat_id,
+                    models.DiscussionMessage.message_id == message_id
+                )
+                for source_chat_id, message_id in records
+            ]))
+        )).all()
+    }
+
+    added = 0
+    for key, record in records.items():
+        row = existing.get(key)
+        if row is not None:
+            row.text = record["text"]
+        else:
+            db.add(models.DiscussionMessage(**record))
+            added += 1
+    return added + leaves
+
+
+async def claim_lease(db: AsyncSession, owner: str) -> Optional[int]:
+    """
+    Берет или продлевает аренду опроса (commit делает сам).
+    Returns: последний обработанный update_id или None - аренду держит другой процесс.
+    """
+    if await db.get(models.TelegramUpdateOffset, ADMIN_BOT_NAME) is None:
+        db.add(models.TelegramUpdateOffset(bot_name=ADMIN_BOT_NAME, last_update_id=0))
+        try:
+            await db.commit()
+        except IntegrityError:
+            # Строку одновременно создал другой процесс
+            await db.rollback()
+
+    now = datetime.utcnow()
+    last_update_id = await db.scalar(
+        update(models.TelegramUpdateOffset)
+        .where(
+            models.TelegramUpdateOffset.bot_name == ADMIN_BOT_NAME,
+            or_(
+                models.TelegramUpdateOffset.lease_owner == owner,
+                models.TelegramUpdateOffset.lease_until.is_(None),
+                models.TelegramUpdateOffset.lease_until < now
+            )
+        )
+        .values(lease_owner=owner, lease_until=now + timedelta(seconds=UPDATES_LEASE_SECONDS))
+        .returning(models.TelegramUpdateOffset.last_update_id)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return last_update_id
+
+
+async def ingest_once(bot: Bot, db: AsyncSession, owner: str) -> Optional[int]:
+    """
+    Один вызов getUpdates: сохраняет сообщения и сдвигает offset одной транзакцией.
+    Returns: количество новых записей или None - аренду держит другой процесс.
+    """
+    last_update_id = await claim_lease(db, owner)
+    if last_update_id is None:
+        return None
+
+    # Транзакции нет: long poll не держит соединение с БД
+    updates = await bot.get_updates(
+        offset=last_update_id + 1 if last_update_id else None,
+        timeout=UPDATES_POLL_TIMEOUT,
+        allowed_updates=ALLOWED_UPDATES
+    )
+    if not updates:
+        return 0
+
+    offset_row = await db.get(
+        models.TelegramUpdateOffset, ADMIN_BOT_NAME, with_for_update=True, populate_existing=True
+    )
+    if offset_row.lease_owner != owner:
+        # Аренда истекла и ее забрал другой процесс - он получит эти обновления сам
+        await db.rollback()
+        return 0
+    updates = [update for update in updates if update.update_id > offset_row.last_update_id]
+    added = await store_updates(db, updates)
+    if updates:
+        offset_row.last_update_id = max(update.update_id for update in updates)
+    await db.commit()
+    return added
+
+
+async def find_comment(db: AsyncSession, post_link: str, user_telegram_id: int) -> bool:
+    """Есть ли сохраненный комментарий пользователя к посту (поиск по индексу)."""
+    return await find_comment_message(db, post_link, user_telegram_id) is not None
+
+
+async def find_comment_message(db: AsyncSession, post_link: str, user_telegram_id: int) -> Optional[models.DiscussionMessage]:
+    """Сохраненный комментарий пользователя к посту или None."""
+    parsed = parse_post_link(post_link)
+    if not parsed:
+        print(f"[COMMENT VALIDATOR] Could not parse post_link: {post_link}")
+        return None
+    chat, message_id = parsed
+    chat_matches = (
+        models.DiscussionMessage.chat_id == chat if isinstance(chat, int)
+        else models.DiscussionMessage.chat_username == chat
+    )
+
+    found = await db.scalar(
+        select(models.DiscussionMessage).where(
+            chat_matches,
+            models.DiscussionMessage.reply_to_message_id == message_id,
+            models.DiscussionMessage.from_user_id == user_telegram_id
+        ).limit(1)
+    )
+    if found is None:
+        # Сообщение со ссылкой на пост тоже засчитывается как комментарий
+        found = await db.scalar(
+            select(models.DiscussionMessage).where(
+                chat_matches,
+                models.DiscussionMessage.from_user_id == user_telegram_id,
+                models.DiscussionMessage.text.contains(post_link)
+            ).limit(1)
+        )
+    return found
+
+
+def comment_probe_enabled() -> bool:
+    return bool(TELEGRAM_COMMENT_PROBE_CHAT_ID)
+
+
+async def message_still_exists(bot: Bot, source_chat_id: int, message_id: int) -> Optional[bool]:
+    """
+    Не удалено ли сообщение: копия в служебный чат и ее удаление.
+    Returns: None - проверить не удалось (нет служебного чата, сеть, лимит).
+    """
+    if not TELEGRAM_COMMENT_PROBE_CHAT_ID:
+        return None
+    try:
+        copy = await bot.copy_message(
+            chat_id=TELEGRAM_COMMENT_PROBE_CHAT_ID,
+            from_chat_id=source_chat_id,
+            message_id=message_id,
+            disable_notification=True
+        )
+    except BadRequest as e:
+        if "not found" in str(e).lower():
+            return False
+        print(f"[COMMENT VALIDATOR] Could not probe message {message_id} in {source_chat_id}: {e}")
+        return None
+    except TelegramError as e:
+        print(f"[COMMENT VALIDATOR] Could not probe message {message_id} in {source_chat_id}: {e}")
+        return None
+    try:
+        await bot.delete_message(chat_id=TELEGRAM_COMMENT_PROBE_CHAT_ID, message_id=copy.message_id)
+    except TelegramError as e:
+        print(f"[COMMENT VALIDATOR] Could not delete probe copy {copy.message_id}: {e}")
+    return True
+
+
+async def cleanup_old_messages(db: AsyncSession):
+    deadline = datetime.utcnow() - timedelta(days=DISCUSSION_MESSAGES_RETENTION_DAYS)
+    await db.execute(delete(models.DiscussionMessage).where(models.DiscussionMessage.created_at < deadline))
+    await db.execute(delete(models.ChannelMemberEvent).where(
+        models.ChannelMemberEvent.processed_at.isnot(None),
+        models.ChannelMemberEvent.created_at < deadline
+    ))
+    await db.commit()
+
+
+async def run_update_ingestion():
+    """Фоновый цикл ингестии обновлений админ-бота (запускается в каждом процессе, опрашивает держатель аренды)."""
+    if not TELEGRAM_ADMIN_BOT_TOKEN:
+        print("[TELEGRAM UPDATES] TELEGRAM_ADMIN_BOT_TOKEN not set, ingestion disabled")
+        return
+
+    last_cleanup = 0.0
+    owner = uuid.uuid4().hex
+    # Общий клиент процесса (закрывается в shutdown приложения)
+    bot = await get_admin_bot()
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                added = await ingest_once(bot, db, owner)
+                if added is None:
+                    await asyncio.sleep(UPDATES_STANDBY_SECONDS)
+                    continue
+                if added:
+                    print(f"[TELEGRAM UPDATES] Stored {added} discussion messages and leave events")
+                    # Выходы из каналов - сразу возвращаем эскроу отписавшихся
+                    from app.comment_validator import process_leave_events
+                    await process_leave_events(db)
+
+                loop_time = asyncio.get_running_loop().time()
+                if loop_time - last_cleanup > 3600:
+                    await cleanup_old_messages(db)
+                    last_cleanup = loop_time
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[TELEGRAM UPDATES] Error in ingestion loop: {e}")
+            await asyncio.sleep(10)
@@ -0,0 +1,142 @@
+"""
+Режим webhook для ботов Telegram (включается переменной TELEGRAM_WEBHOOK_URL).
+
+В режиме polling run_bot.py (run_polling) и ингестия админ-бота (getUpdates)
+держат long poll, и два процесса с одним токеном конфликтуют
+(см. BOT_CONFLICT_FIX.md). С webhook Telegram сам присылает обновления в API:
+
+    POST /api/telegram/webhook/main   - основной бот (/start, /help)
+    POST /api/telegram/webhook/admin  - админ-бот (комментарии, chat_member)
+
+Запрос проверяется по заголовку X-Telegram-Bot-Api-Secret-Token и кладется
+в ограниченную очередь процесса. Обработчик /start (Application из
+telegram_bot.py) и запись в discussion_messages / channel_member_events читают
+из своих очередей. Если очередь заполнена, endpoint отвечает 503 - Telegram
+повторит доставку позже (backpressure). Webhook регистрирует каждый воркер при
+старте (set_webhook идемпотентен), поэтому один токен обслуживают все воркеры.
+"""
+import asyncio
+import hmac
+import os
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+from app.database import AsyncSessionLocal
+
+# Публичный адрес API, например https://blackmirrowmarket-production.up.railway.app
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+TELEGRAM_WEBHOOK_PATH = "/api/telegram/webhook"
+
+# Размер очереди обновлений на бота; при переполнении endpoint отвечает 503
+TELEGRAM_WEBHOOK_QUEUE_SIZE = int(os.getenv("TELEGRAM_WEBHOOK_QUEUE_SIZE", "1000"))
+# Сколько обновлений админ-бота записывать одной транзакцией
+ADMIN_UPDATES_BATCH_SIZE = 100
+
+MAIN_BOT = "main"
+ADMIN_BOT = "admin"
+
+
+def webhook_enabled() -> bool:
+    return bool(TELEGRAM_WEBHOOK_URL and TELEGRAM_WEBHOOK_SECRET)
+
+
+def check_secret(secret_token: Optional[str]) -> bool:
+    return bool(TELEGRAM_WEBHOOK_SECRET) and hmac.compare_digest(
+        (secret_token or "").encode(), TELEGRAM_WEBHOOK_SECRET.encode()
+    )
+
+
+class TelegramWebhook:
+    def __init__(self):
+        self.main_application: Optional[Application] = None
+        self.admin_queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=TELEGRAM_WEBHOOK_QUEUE_SIZE)
+        self._admin_bot = None
+        self._consumer: Optional[asyncio.Task] = None
+
+    def offer(self, bot_name: str, data: dict) -> bool:
+        """
+        Кладет обновление в очередь бота без ожидания.
+        Returns: False - очередь заполнена (или бот не запущен в этом процессе).
+        """
+        try:
+            if bot_name == MAIN_BOT and self.main_application is not None:
+                update = Update.de_json(data, self.main_application.bot)
+                self.main_application.update_queue.put_nowait(update)
+                return True
+            if bot_name == ADMIN_BOT and self._consumer is not None:
+                self.admin_queue.put_nowait(data)
+                return True
+        except asyncio.QueueFull:
+            print(f"[TELEGRAM WEBHOOK] Queue for {bot_name} bot is full, asking Telegram to retry")
+        return False
+
+    async def _consume_admin_updates(self):
+        """Пишет обновления админ-бота пачками (как ингестия через getUpdates)."""
+        from app.comment_validator import process_leave_events
+        from app.telegram_updates import store_updates
+
+        while True:
+            batch = [await self.admin_queue.get()]
+            while len(batch) < ADMIN_UPDATES_BATCH_SIZE and not self.admin_queue.empty():
+                batch.append(self.admin_queue.get_nowait())
+            try:
+                updates = [Update.de_json(data, self._admin_bot) for data in batch]
+                async with AsyncSessionLocal() as db:
+                    added = await store_updates(db, updates)
+                    await db.commit()
+                    if added:
+                        await process_leave_events(db)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[TELEGRAM WEBHOOK] Error storing admin bot updates: {e}")
+
+    async def start(self):
+        """Запускает обработчики и регистрирует webhook у Telegram (вызывается при старте API)."""
+        from app.telegram_bot import TELEGRAM_BOT_TOKEN, setup_bot
+        from app.telegram_clients import get_admin_bot
+        from app.telegram_updates import ALLOWED_UPDATES, TELEGRAM_ADMIN_BOT_TOKEN
+
+        if TELEGRAM_BOT_TOKEN:
+            application = setup_bot(
+                TELEGRAM_BOT_TOKEN, update_queue=asyncio.Queue(maxsize=TELEGRAM_WEBHOOK_QUEUE_SIZE)
+            )
+            await application.initialize()
+            await application.start()
+            await application.bot.set_webhook(
+                url=f"{TELEGRAM_WEBHOOK_URL}{TELEGRAM_WEBHOOK_PATH}/{MAIN_BOT}",
+                secret_token=TELEGRAM_WEBHOOK_SECRET,
+                allowed_updates=["message", "callback_query"],
+            )
+            self.main_application = application
+            print("[TELEGRAM WEBHOOK] Main bot webhook registered")
+
+        if TELEGRAM_ADMIN_BOT_TOKEN:
+            self._admin_bot = await get_admin_bot()
+            await self._admin_bot.set_webhook(
+                url=f"{TELEGRAM_WEBHOOK_URL}{TELEGRAM_WEBHOOK_PATH}/{ADMIN_BOT}",
+                secret_token=TELEGRAM_WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+            self._consumer = asyncio.create_task(self._consume_admin_updates())
+            print("[TELEGRAM WEBHOOK] Admin bot webhook registered")
+
+    async def stop(self):
+        """
+        Останавливает обработчики процесса. Webhook у Telegram не снимается -
+        его продолжают обслуживать остальные воркеры.
+        """
+        if self._consumer is not None:
+            self._consumer.cancel()
+            await asyncio.gather(self._consumer, return_exceptions=True)
+            self._consumer = None
+        if self.main_application is not None:
+            application, self.main_application = self.main_application, None
+            await application.stop()
+            await application.shutdown()
+
+
+telegram_webhook = TelegramWebhook()
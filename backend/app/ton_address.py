@@ -0,0 +1,75 @@
+"""
+Канонический адрес TON.
+
+Один и тот же кошелек записывается по-разному: user-friendly bounceable (EQ...),
+non-bounceable (UQ...), url-safe или стандартный base64, raw (0:hex). Раньше
+адреса сравнивались строковыми операциями (upper(), replace("-", ""), UQ -> EQ),
+что и дорого, и неверно (base64 чувствителен к регистру, "-" и "+" - разные
+символы url-safe и стандартного алфавита). Теперь адрес один раз разбирается
+в (workchain, hash) и сравнивается по ним:
+
+    parse_address("UQ...")           -> TonAddress(workchain=0, hash_part=b"...")
+    canonical_address("EQ...")       -> "0:ed16..."  (None, если адрес не разбирается)
+    same_address("EQ...", "0:ed16...") -> True
+
+Каноническая форма - raw "workchain:hex", она хранится в
+deposits.from_address_canonical и ton_transactions.to_address_canonical.
+Разбор кэшируется (LRU): адреса сервисного кошелька и отправителей повторяются
+на каждом проходе проверки депозитов.
+"""
+from functools import lru_cache
+from typing import List, NamedTuple, Optional
+
+from pytoniq import Address as PytoniqAddress
+
+ADDRESS_CACHE_SIZE = 4096
+
+
+class TonAddress(NamedTuple):
+    workchain: int
+    hash_part: bytes
+
+    @property
+    def raw(self) -> str:
+        """Каноническая форма: "workchain:hex"."""
+        return f"{self.workchain}:{self.hash_part.hex()}"
+
+    def to_pytoniq(self) -> PytoniqAddress:
+        return PytoniqAddress((self.workchain, self.hash_part))
+
+    def friendly(self, bounceable: bool = True) -> str:
+        return self.to_pytoniq().to_str(is_user_friendly=True, is_bounceable=bounceable)
+
+    def variants(self) -> List[str]:
+        """Все формы записи адреса (для API, которые принимают не любую)."""
+        return [self.raw, self.friendly(bounceable=True), self.friendly(bounceable=False)]
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def parse_address(value: str) -> TonAddress:
+    """Разбирает адрес в любой форме. Raises: ValueError - адрес некорректен."""
+    try:
+        address = PytoniqAddress(value.strip())
+    except Exception as e:
+        raise ValueError(f"Invalid TON address {value!r}: {e}") from e
+    return TonAddress(address.wc, bytes(address.hash_part))
+
+
+def canonical_address(value: Optional[str]) -> Optional[str]:
+    """Каноническая форма адреса или None, если адрес пустой или не разбирается."""
+    if not value:
+        return None
+    try:
+        return parse_address(value).raw
+    except ValueError:
+        return None
+
+
+def same_address(a: Optional[str], b: Optional[str]) -> bool:
+    """Один и тот же адрес (в любых формах записи). Неразбираемые адреса сравниваются как строки."""
+    if not a or not b:
+        return False
+    canonical_a, canonical_b = canonical_address(a), canonical_address(b)
+    if canonical_a is None or canonical_b is None:
+        return a.strip() == b.strip()
+    return canonical_a == canonical_b
@@ -0,0 +1,121 @@
+"""
+Реестр HTTP-провайдеров TON (tonapi.io, toncenter.com) с оценкой здоровья.
+
+Раньше каждый проход проверки депозитов сначала пробовал tonapi.io и только
+после ошибки (то есть после полного таймаута) шел в toncenter.com - деградировавший
+провайдер обходился в таймаут на каждом цикле. Теперь по каждому провайдеру
+хранятся последние PROVIDER_WINDOW вызовов за PROVIDER_WINDOW_SECONDS (задержка и успех):
+
+    score = средняя задержка + доля ошибок * PROVIDER_ERROR_PENALTY_SECONDS
+
+registry.call([...], fn) вызывает fn(provider) у провайдера с лучшей оценкой и
+при ошибке переходит к следующему. После CIRCUIT_FAILURE_THRESHOLD ошибок подряд
+цепь провайдера размыкается на CIRCUIT_OPEN_SECONDS (при повторных отказах пауза
+удваивается до CIRCUIT_MAX_OPEN_SECONDS) - в это время провайдер не вызывается
+совсем. По окончании паузы проходит один пробный вызов: успех замыкает цепь,
+ошибка снова ее размыкает. Старые вызовы выпадают из окна, поэтому провайдер,
+от которого ушли из-за ошибок, со временем снова получает запросы.
+
+remember()/recall() хранят найденное для провайдера (например, формат адреса,
+который принимает tonapi.io), чтобы не подбирать его на каждом проходе.
+"""
+import sys
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+PROVIDER_WINDOW = 20
+PROVIDER_WINDOW_SECONDS = 300.0
+PROVIDER_ERROR_PENALTY_SECONDS = 10.0
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_OPEN_SECONDS = 30.0
+CIRCUIT_MAX_OPEN_SECONDS = 600.0
+
+T = TypeVar("T")
+
+
+class ProvidersUnavailable(Exception):
+    """У всех провайдеров разомкнута цепь."""
+
+
+class ProviderHealth:
+    def __init__(self, name: str):
+        self.name = name
+        # (время вызова, задержка, успех)
+        self._calls = deque(maxlen=PROVIDER_WINDOW)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.open_seconds = CIRCUIT_OPEN_SECONDS
+        self.memory: Dict[str, Any] = {}
+
+    def available(self, now: float) -> bool:
+        return now >= self.open_until
+
+    def score(self, now: float) -> float:
+        """Средняя задержка + штраф за долю ошибок в окне. Чем меньше, тем лучше."""
+        while self._calls and self._calls[0][0] < now - PROVIDER_WINDOW_SECONDS:
+            self._calls.popleft()
+        if not self._calls:
+            return 0.0
+        avg_latency = sum(latency for _, latency, _ in self._calls) / len(self._calls)
+        error_rate = sum(1 for _, _, ok in self._calls if not ok) / len(self._calls)
+        return avg_latency + error_rate * PROVIDER_ERROR_PENALTY_SECONDS
+
+    def record_success(self, latency: float, now: float):
+        self._calls.append((now, latency, True))
+        self.consecutive_failures = 0
+        self.open_seconds = CIRCUIT_OPEN_SECONDS
+
+    def record_failure(self, latency: float, now: float):
+        self._calls.append((now, latency, False))
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.open_until = now + self.open_seconds
+            print(f"⚠️ Provider {self.name}: circuit open for {self.open_seconds:.0f}s after {self.consecutive_failures} failures", file=sys.stderr, flush=True)
+            self.open_seconds = min(self.open_seconds * 2, CIRCUIT_MAX_OPEN_SECONDS)
+
+
+class ProviderRegistry:
+    def __init__(self, names: List[str]):
+        self._health: Dict[str, ProviderHealth] = {name: ProviderHealth(name) for name in names}
+
+    def health(self, name: str) -> ProviderHealth:
+        if name not in self._health:
+            self._health[name] = ProviderHealth(name)
+        return self._health[name]
+
+    def remember(self, name: str, key: str, value: Any):
+        self.health(name).memory[key] = value
+
+    def recall(self, name: str, key: str) -> Optional[Any]:
+        return self.health(name).memory.get(key)
+
+    def ordered(self, names: List[str]) -> List[ProviderHealth]:
+        """Провайдеры с замкнутой цепью, от лучшей оценки к худшей."""
+        now = time.monotonic()
+        return sorted(
+            (self.health(name) for name in names if self.health(name).available(now)),
+            key=lambda health: health.score(now)
+        )
+
+    async def call(self, names: List[str], fn: Callable[[str], Awaitable[T]]) -> T:
+        """
+        Вызывает fn(provider) у самого здорового провайдера, при ошибке - у следующего.
+        Исключение fn считается отказом провайдера.
+        """
+        last_error: Optional[Exception] = None
+        for health in self.ordered(names):
+            started = time.monotonic()
+            try:
+                result = await fn(health.name)
+            except Exception as e:
+                health.record_failure(time.monotonic() - started, time.monotonic())
+                print(f"⚠️ Provider {health.name} failed: {e}", file=sys.stderr, flush=True)
+                last_error = e
+                continue
+            health.record_success(time.monotonic() - started, time.monotonic())
+            return result
+        if last_error is not None:
+            raise last_error
+        raise ProvidersUnavailable(f"All providers are unavailable (circuit open): {', '.join(names)}")
+
@@ -4,24 +4,84 @@ import uuid
 import ssl
 import asyncio
 import aiohttp
-import json
-import shutil
-import tarfile
-import tempfile
-import urllib.request
+import random
 import re
+from contextlib import asynccontextmanager
 from decimal import Decimal
-from typing import Optional, Tuple
-from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
 
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from pytoniq.liteclient import LiteBalancer
 from pytoniq.contract.wallets.wallet import WalletV4R2, Address
 from pytoniq import Address as PytoniqAddress
 
 from app import models
+from app.balance_ledger import apply_balance_delta
+from app.ton_address import canonical_address, parse_address, same_address
+from app.ton_providers import ProviderRegistry
+from app.ton_signer import NodeSigner
+from app.wallet_seqno import SeqnoManager
+
+
+# Пул HTTP-соединений к tonapi.io / toncenter.com (одна сессия на провайдера на процесс)
+TON_HTTP_LIMIT_PER_HOST = int(os.getenv("TON_HTTP_LIMIT_PER_HOST", "10"))
+TON_HTTP_DNS_CACHE_SECONDS = 300
+TON_HTTP_KEEPALIVE_SECONDS = 60
+
+# Пакетные выводы: несколько переводов в одном внешнем сообщении (один seqno).
+# wallet v4r2 принимает не больше 4 исходящих сообщений за раз (v5r1 - до 255),
+# поэтому размер пакета ограничен 4: так пакет проходит и через fallback на v4r2.
+TON_WITHDRAWAL_BATCHING = os.getenv("TON_WITHDRAWAL_BATCHING", "1") == "1"
+WALLET_MAX_OUT_MESSAGES = 4
+TON_WITHDRAWAL_BATCH_SIZE = max(1, min(int(os.getenv("TON_WITHDRAWAL_BATCH_SIZE", "4")), WALLET_MAX_OUT_MESSAGES))
+# Максимальная сумма одного пакета (нанотоны); вывод больше лимита уходит отдельным сообщением
+TON_WITHDRAWAL_BATCH_MAX_NANO = int(os.getenv("TON_WITHDRAWAL_BATCH_MAX_NANO", str(100 * 10**9)))
+# Сколько внешних сообщений отправлять за один проход process_pending_withdrawals
+WITHDRAWAL_MESSAGES_PER_ROUND = 10
+# Повторные отправки выводов после ошибки: пауза растет от WITHDRAWAL_RETRY_BASE_SECONDS
+# вдвое до WITHDRAWAL_RETRY_MAX_SECONDS, из нее случайно берется от половины до целой
+# (чтобы выводы, упавшие на одном сбое провайдера, не повторялись одной волной)
+WITHDRAWAL_RETRY_BASE_SECONDS = 30
+WITHDRAWAL_RETRY_MAX_SECONDS = 900
+# После стольких неудачных попыток или через WITHDRAWAL_MAX_WAIT после создания
+# неотправленный вывод помечается failed (средства не списывались)
+WITHDRAWAL_MAX_AUTO_ATTEMPTS = 7
+WITHDRAWAL_MAX_WAIT = timedelta(hours=1)
+# Опрос подтверждений отправленных выводов: пауза между проверками строки растет
+# от CONFIRMATION_POLL_BASE_SECONDS вдвое до CONFIRMATION_POLL_MAX_SECONDS,
+# одновременно идет не больше TON_CONFIRMATION_CONCURRENCY запросов
+CONFIRMATION_POLL_BASE_SECONDS = 30
+CONFIRMATION_POLL_MAX_SECONDS = 1800
+TON_CONFIRMATION_CONCURRENCY = int(os.getenv("TON_CONFIRMATION_CONCURRENCY", "8"))
+
+# subwallet_id стандартного кошелька v4r2 в workchain 0
+WALLET_V4_DEFAULT_ID = 698983191
+
+# Сканирование депозитов: размер страницы и максимум страниц за один проход
+DEPOSIT_SCAN_PAGE_SIZE = 100
+DEPOSIT_SCAN_MAX_PAGES = int(os.getenv("DEPOSIT_SCAN_MAX_PAGES", "50"))
+# Провайдеры, через которые можно сканировать депозиты (порядок выбирает ProviderRegistry)
+DEPOSIT_PROVIDERS = ["tonapi", "toncenter"]
+
+
+class _ProviderSession:
+    """Общая сессия провайдера с таймаутом по умолчанию для запросов конкретного вызова."""
+
+    def __init__(self, session: aiohttp.ClientSession, timeout: aiohttp.ClientTimeout):
+        self._session = session
+        self._timeout = timeout
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self._timeout)
+        return self._session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self._timeout)
+        return self._session.post(url, **kwargs)
 
 
 class TonService:
@@ -45,6 +105,14 @@ class TonService:
         self._wallet = None
         # Глобальный лок для последовательной отправки (seqno)
         self._send_lock = asyncio.Lock()
+        # Долгоживущие HTTP-сессии по провайдерам (keep-alive, кэш DNS), закрываются в close()
+        self._http_sessions: Dict[str, aiohttp.ClientSession] = {}
+        # Здоровье провайдеров (задержка, ошибки, circuit breaker) и найденные форматы адресов
+        self._providers = ProviderRegistry(DEPOSIT_PROVIDERS)
+        # Постоянный процесс ton_sender.js --daemon (запускается при первой отправке)
+        self._signer = NodeSigner()
+        # Локальный seqno кошелька: из сети читается только после неудачной отправки
+        self._seqno = SeqnoManager(self.wallet_address or "service", self._get_seqno_via_api)
 
         # Делаем переменные опциональными, чтобы приложение могло запуститься без них
         # (TON функции просто не будут работать)
@@ -252,27 +320,13 @@ class TonService:
                             wallet_addr = None
                         
                         if wallet_addr:
-                            wallet_addr_str = str(wallet_addr)
-                            # Нормализуем адреса для сравнения
-                            try:
-                                wallet_addr_normalized = str(Address(wallet_addr_str))
-                                expected_addr_normalized = str(Address(expected_addr))
-                                
-                                # Сравниваем без учета формата (UQ vs EQ)
-                                if wallet_addr_normalized != expected_addr_normalized:
-                                    # Пробуем сравнить в разных форматах
-                                    try:
-                                        wallet_addr_user = Address(wallet_addr_str).to_str(is_user_friendly=True, is_bounceable=True)
-                                        expected_addr_user = Address(expected_addr).to_str(is_user_friendly=True, is_bounceable=True)
-                                        if wallet_addr_user != expected_addr_user:
-                                            print(f"⚠️ Warning: Wallet address mismatch!", file=sys.stderr, flush=True)
-                                            print(f"  Expected: {expected_addr}", file=sys.stderr, flush=True)
-                                            print(f"  Got from mnemonic: {wallet_addr_str}", file=sys.stderr, flush=True)
-                                            print(f"  This mnemonic may not match TON_WALLET_ADDRESS", file=sys.stderr, flush=True)
-                                    except Exception:
-                                        pass
-                            except Exception:
-                                pass
+                            wallet_addr_str = wallet_addr.to_str() if hasattr(wallet_addr, "to_str") else str(wallet_addr)
+                            # Сравниваем без учета формата записи (UQ / EQ / raw)
+                            if not same_address(wallet_addr_str, expected_addr):
+                                print(f"⚠️ Warning: Wallet address mismatch!", file=sys.stderr, flush=True)
+                                print(f"  Expected: {expected_addr}", file=sys.stderr, flush=True)
+                                print(f"  Got from mnemonic: {wallet_addr_str}", file=sys.stderr, flush=True)
+                                print(f"  This mnemonic may not match TON_WALLET_ADDRESS", file=sys.stderr, flush=True)
                         else:
                             print("ℹ️ Skip address verification: wallet address not available from client", file=sys.stderr, flush=True)
                     except Exception as addr_check_error:
@@ -439,20 +493,42 @@ class TonService:
                     )
                 raise Exception(f"Failed to initialize wallet: {error_msg}")
 
-    async def get_wallet_balance(self) -> int:
-        """Возвращает баланс сервисного кошелька в нано-TON через tonapi.io."""
-        try:
-            # Создаем SSL контекст без проверки сертификатов (для разработки на macOS)
+    def _http_session(self, provider: str) -> aiohttp.ClientSession:
+        """Сессия провайдера (tonapi / toncenter); создается при первом обращении."""
+        session = self._http_sessions.get(provider)
+        if session is None or session.closed:
+            # SSL контекст без проверки сертификатов (для разработки на macOS)
             ssl_context = ssl.create_default_context()
             ssl_context.check_hostname = False
             ssl_context.verify_mode = ssl.CERT_NONE
-            
-            # Используем SSL контекст в connector
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=10),
-                connector=connector
-            ) as session:
+
+            connector = aiohttp.TCPConnector(
+                ssl=ssl_context,
+                limit_per_host=TON_HTTP_LIMIT_PER_HOST,
+                ttl_dns_cache=TON_HTTP_DNS_CACHE_SECONDS,
+                keepalive_timeout=TON_HTTP_KEEPALIVE_SECONDS,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self._http_sessions[provider] = session
+        return session
+
+    @asynccontextmanager
+    async def _session(self, provider: str, timeout: int):
+        """Общая сессия провайдера для блока запросов (сессия после блока не закрывается)."""
+        yield _ProviderSession(self._http_session(provider), aiohttp.ClientTimeout(total=timeout))
+
+    async def close(self):
+        """Закрывает HTTP-сессии и процесс подписи (при остановке приложения)."""
+        await self._signer.close()
+        for session in self._http_sessions.values():
+            if not session.closed:
+                await session.close()
+        self._http_sessions.clear()
+
+    async def get_wallet_balance(self) -> int:
+        """Возвращает баланс сервисного кошелька в нано-TON через tonapi.io."""
+        try:
+            async with self._session("tonapi", timeout=10) as session:
                 url = f"https://tonapi.io/v2/accounts/{self.wallet_address}"
                 headers = {"Authorization": f"Bearer {self.api_key}"}
                 async with session.get(url, headers=headers) as resp:
@@ -472,19 +548,9 @@ class TonService:
             raise Exception("TON_WALLET_ADDRESS and TONAPI_KEY must be set")
         
         try:
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=15),
-                connector=connector
-            ) as session:
+            async with self._session("tonapi", timeout=15) as session:
                 # Пробуем разные форматы адреса
-                addresses_to_try = [self.wallet_address]
-                if self.wallet_address.startswith("UQ"):
-                    addresses_to_try.append("EQ" + self.wallet_address[2:])
+                addresses_to_try = self._deposit_address_variants(self.wallet_address)
                 
                 for addr in addresses_to_try:
                     url = f"https://tonapi.io/v2/accounts/{addr}"
@@ -968,20 +1034,8 @@ class TonService:
             print(f"❌ Traceback: {traceback.format_exc()}", file=sys.stderr, flush=True)
             raise Exception(f"Failed to create transaction manually: {e}")
     
-    async def _send_raw_via_http(self, to_address: str, amount_nano: int, comment: str = None) -> str:
-        """
-        Отправка TON через HTTP API без прямого подключения к блокчейну.
-        Создает и подписывает транзакцию локально, затем отправляет через HTTP.
-        """
-        if not self.seed_phrase:
-            raise Exception("TON_WALLET_SEED is not set")
-        
-        # Получаем seqno через API
-        print(f"🔄 Getting wallet seqno via HTTP API...", file=sys.stderr, flush=True)
-        seqno = await self._get_seqno_via_api()
-        print(f"✅ Seqno: {seqno}", file=sys.stderr, flush=True)
-        
-        # Очищаем и валидируем мнемонику
+    def _seed_words(self) -> List[str]:
+        """Очищает и валидирует мнемонику TON_WALLET_SEED."""
         cleaned_seed = self.seed_phrase.strip()
         while (cleaned_seed.startswith('"') and cleaned_seed.endswith('"')) or \
               (cleaned_seed.startswith("'") and cleaned_seed.endswith("'")):
@@ -993,6 +1047,24 @@ class TonService:
         seed_words = [w.strip() for w in cleaned_seed.split() if w.strip()]
         if len(seed_words) != 24:
             raise Exception(f"Invalid mnemonic: expected 24 words, got {len(seed_words)}")
+        return seed_words
+    
+    async def _send_raw_via_http(self, to_address: str, amount_nano: int, comment: str = None, seqno: Optional[int] = None) -> str:
+        """
+        Отправка TON через HTTP API без прямого подключения к блокчейну.
+        Создает и подписывает транзакцию локально, затем отправляет через HTTP.
+        seqno выдает SeqnoManager; без него seqno читается из сети.
+        """
+        if not self.seed_phrase:
+            raise Exception("TON_WALLET_SEED is not set")
+        
+        if seqno is None:
+            # Получаем seqno через API
+            print(f"🔄 Getting wallet seqno via HTTP API...", file=sys.stderr, flush=True)
+            seqno = await self._get_seqno_via_api()
+        print(f"✅ Seqno: {seqno}", file=sys.stderr, flush=True)
+        
+        seed_words = self._seed_words()
         
         # Создаем транзакцию вручную
         print(f"🔄 Creating transaction manually (no blockchain connection)...", file=sys.stderr, flush=True)
@@ -1007,19 +1079,48 @@ class TonService:
             # Fallback на использование pytoniq (может потребовать подключения)
             raise Exception(f"Failed to create transaction manually: {manual_error}")
     
+    async def _send_batch_via_http(self, transfers: List[Tuple[str, int, Optional[str]]], seqno: int) -> str:
+        """
+        Пакетная отправка без Node: перевод wallet v4r2 с несколькими исходящими
+        сообщениями подписывается локально (pytoniq) и отправляется через HTTP.
+        Returns: хеш подписанного тела перевода (как у ton_sender.js).
+        """
+        import base64
+        from pytoniq.contract.contract import Contract
+        from pytoniq_core.crypto.keys import mnemonic_to_private_key
+        
+        if not self.seed_phrase:
+            raise Exception("TON_WALLET_SEED is not set")
+        
+        _, private_key = mnemonic_to_private_key(self._seed_words())
+        messages = [
+            # send_mode=1 (PAY_GAS_SEPARATELY, без IGNORE_ERRORS): при ошибке не уходит весь пакет
+            WalletV4R2.create_wallet_internal_message(
+                destination=PytoniqAddress(to_address),
+                send_mode=1,
+                value=amount_nano,
+                body=str(comment) if comment else None,
+                bounce=True
+            )
+            for to_address, amount_nano, comment in transfers
+        ]
+        transfer = WalletV4R2.raw_create_transfer_msg(
+            private_key=private_key,
+            seqno=seqno,
+            wallet_id=WALLET_V4_DEFAULT_ID,
+            messages=messages
+        )
+        external = Contract.create_external_msg(dest=PytoniqAddress(self.wallet_address), body=transfer)
+        boc_base64 = base64.b64encode(external.serialize().to_boc()).decode()
+        print(f"✅ Batch of {len(transfers)} transfers signed (seqno={seqno})", file=sys.stderr, flush=True)
+        await self._send_boc_via_http(boc_base64)
+        return transfer.hash.hex()
+    
     async def _send_boc_via_http(self, boc_base64: str) -> str:
         """Отправляет подписанную транзакцию (BOC) через tonapi.io или toncenter.com API."""
         print(f"🔄 Sending transaction via HTTP API...", file=sys.stderr, flush=True)
         
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
-        async with aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=30),
-            connector=connector
-        ) as session:
+        async with self._session("toncenter", timeout=30) as session:
             # Сначала пробуем tonapi.io (у нас есть TONAPI_KEY)
             if self.api_key:
                 try:
@@ -1064,137 +1165,19 @@ class TonService:
             print(f"⚠️ HTTP-based sending failed: {http_error}, trying direct method...", file=sys.stderr, flush=True)
             return await self._send_raw(to_address, amount_nano)
     
-    async def _send_via_node(self, to_address: str, amount_nano: int, comment: str = None) -> str:
+    async def _send_via_node(self, to_address: str, amount_nano: int, comment: str = None, seqno: Optional[int] = None) -> str:
         """
-        Отправка через Node-скрипт (ton_sender.js) с использованием @ton/ton (поддержка wallet v5r1).
+        Отправка через Node-процесс подписи (ton_sender.js --daemon) с использованием @ton/ton (поддержка wallet v5r1).
         """
-        base_dir = os.path.dirname(__file__)
-        script_candidates = [
-            os.path.normpath(os.path.join(base_dir, "..", "ton_sender.js")),            # /app/ton_sender.js (backend root)
-            os.path.normpath(os.path.join(base_dir, "ton_sender.js")),                  # /app/app/ton_sender.js (same dir)
-            os.path.normpath(os.path.join(base_dir, "..", "backend", "ton_sender.js")), # /app/backend/ton_sender.js (if repo root used)
-        ]
-        script_path = next((p for p in script_candidates if os.path.exists(p)), None)
-        if not script_path:
-            raise Exception(f"Node sender script not found. Tried: {script_candidates}")
-        workdir = os.path.dirname(script_path)
-        
-        node_bin = shutil.which("node") or shutil.which("nodejs")
-        if not node_bin:
-            # Автозагрузка node в /tmp, если недоступен в PATH (Railway buildpacks могли не подтянуть)
-            node_bin = await self._ensure_node_binary()
-            if not node_bin:
-                raise Exception("Node binary not found in PATH and download failed")
-        npm_candidate = os.path.join(os.path.dirname(node_bin), "npm")
-        npm_bin = npm_candidate if os.path.exists(npm_candidate) else shutil.which("npm")
-        print(f"🔍 node_bin={node_bin}, npm_bin={npm_bin}", file=sys.stderr, flush=True)
-        
-        cmd = [node_bin, script_path, "--to", to_address, "--amount", str(amount_nano)]
-        if comment:
-            cmd.extend(["--comment", str(comment)])
-        
-        env = os.environ.copy()
-        # Важно: добавить путь к скачанному node/npm в PATH, иначе shebang "/usr/bin/env node" внутри npm ломается
-        node_dir = os.path.dirname(node_bin)
-        env["PATH"] = f"{node_dir}:{env.get('PATH', '')}"
-        # Обеспечиваем поиск модулей рядом со скриптом и в backend/node_modules
-        node_modules_candidates = [
-            os.path.join(workdir, "node_modules"),
-            os.path.join(workdir, "backend", "node_modules"),
-            os.path.join(os.path.dirname(workdir), "backend", "node_modules"),
-            os.path.join(os.path.dirname(workdir), "node_modules"),
+        return await self._send_batch_via_node([(to_address, amount_nano, comment)], seqno)
+    
+    async def _send_batch_via_node(self, transfers: List[Tuple[str, int, Optional[str]]], seqno: Optional[int] = None) -> str:
+        """Отправка нескольких переводов одним внешним сообщением (один seqno) через процесс подписи."""
+        messages = [
+            {"to": to_address, "amount": str(amount_nano), **({"comment": str(comment)} if comment else {})}
+            for to_address, amount_nano, comment in transfers
         ]
-        found_modules = [p for p in node_modules_candidates if os.path.isdir(p)]
-        if found_modules:
-            existing_np = env.get("NODE_PATH", "")
-            env["NODE_PATH"] = ":".join(found_modules + ([existing_np] if existing_np else []))
-        else:
-            print(f"⚠️ node_modules not found; will try npm install if npm is available", file=sys.stderr, flush=True)
-            # Попытка npm install, если есть package.json
-            pkg_dirs = [
-                workdir,
-                os.path.join(workdir, "backend"),
-                os.path.join(os.path.dirname(workdir), "backend"),
-            ]
-            pkg_dir = next((d for d in pkg_dirs if os.path.exists(os.path.join(d, "package.json"))), None)
-            if pkg_dir and npm_bin:
-                try:
-                    env["npm_config_registry"] = env.get("npm_config_registry") or "https://registry.npmjs.org/"
-                    print(f"🔧 Running npm install in {pkg_dir} ...", file=sys.stderr, flush=True)
-                    proc_npm = await asyncio.create_subprocess_exec(
-                        npm_bin, "install",
-                        cwd=pkg_dir,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE,
-                        env=env,
-                    )
-                    out_npm, err_npm = await proc_npm.communicate()
-                    if proc_npm.returncode != 0:
-                        print(f"⚠️ npm install failed ({proc_npm.returncode}): {err_npm.decode()}", file=sys.stderr, flush=True)
-                    else:
-                        print(f"✅ npm install completed", file=sys.stderr, flush=True)
-                    # После попытки npm install — обновляем поиск node_modules даже если ошибка
-                    node_modules_candidates.insert(0, os.path.join(pkg_dir, "node_modules"))
-                    found_modules = [p for p in node_modules_candidates if os.path.isdir(p)]
-                    if found_modules:
-                        existing_np = env.get("NODE_PATH", "")
-                        env["NODE_PATH"] = ":".join(found_modules + ([existing_np] if existing_np else []))
-                except Exception as npm_err:
-                    print(f"⚠️ npm install error: {npm_err}", file=sys.stderr, flush=True)
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            env=env,
-            cwd=workdir,
-        )
-        stdout, stderr = await proc.communicate()
-        out_text = stdout.decode().strip()
-        err_text = stderr.decode().strip()
-        
-        if proc.returncode != 0:
-            raise Exception(f"Node sender failed (exit {proc.returncode}): {err_text or out_text}")
-        
-        try:
-            data = json.loads(out_text)
-        except Exception as parse_error:
-            raise Exception(f"Failed to parse node sender output: {parse_error}. Raw: {out_text}")
-        
-        if not data.get("ok"):
-            raise Exception(f"Node sender error: {data.get('error') or out_text}")
-        
-        tx_hash = data.get("txHash") or data.get("hash") or data.get("tx_hash")
-        if not tx_hash:
-            raise Exception(f"Node sender returned no tx_hash. Raw: {out_text}")
-        
-        return tx_hash
-
-    async def _ensure_node_binary(self) -> str:
-        """
-        Гарантирует наличие бинаря node, скачивая его в /tmp, если не найден.
-        Возвращает путь к бинарю или None при ошибке.
-        """
-        cached_path = "/tmp/node-v18.19.0-linux-x64/bin/node"
-        if os.path.exists(cached_path):
-            return cached_path
-
-        url = "https://nodejs.org/dist/v18.19.0/node-v18.19.0-linux-x64.tar.xz"
-        try:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                archive_path = os.path.join(tmpdir, "node.tar.xz")
-                print(f"⬇️ Downloading Node.js from {url} ...", file=sys.stderr, flush=True)
-                urllib.request.urlretrieve(url, archive_path)
-
-                print(f"📦 Extracting Node.js to /tmp ...", file=sys.stderr, flush=True)
-                with tarfile.open(archive_path) as tar:
-                    tar.extractall("/tmp")
-
-            if os.path.exists(cached_path):
-                os.chmod(cached_path, 0o755)
-                return cached_path
-        except Exception as e:
-            print(f"⚠️ Failed to download/extract node: {e}", file=sys.stderr, flush=True)
-            return None
+        return await self._signer.send(messages, seqno)
     
     async def _send_raw(self, to_address: str, amount_nano: int, comment: str = None) -> str:
         """
@@ -1206,17 +1189,38 @@ class TonService:
             # 1) Пробуем отправить через Node (@ton/ton) — новый подход
             try:
                 print(f"🚀 Using Node sender (@ton/ton) with wallet v5r1 support...", file=sys.stderr, flush=True)
-                return await self._send_via_node(to_address, amount_nano, comment)
+                return await self._send_with_seqno(lambda seqno: self._send_via_node(to_address, amount_nano, comment, seqno))
             except Exception as node_error:
                 print(f"⚠️ Node sender failed: {node_error}, falling back to HTTP/manual BOC", file=sys.stderr, flush=True)
             
             # 2) Fallback: старый HTTP/manual путь
             print(f"🚀 Using HTTP-based transaction sending (fallback)...", file=sys.stderr, flush=True)
-            return await self._send_raw_via_http(to_address, amount_nano, comment)
+            return await self._send_with_seqno(lambda seqno: self._send_raw_via_http(to_address, amount_nano, comment, seqno))
+
+    async def _send_batch(self, transfers: List[Tuple[str, int, Optional[str]]]) -> str:
+        """
+        Отправляет несколько переводов (to_address, amount_nano, comment) одним
+        внешним сообщением с одним seqno. Returns: хеш, общий для всех переводов пакета.
+        """
+        async with self._send_lock:
+            try:
+                print(f"🚀 Sending batch of {len(transfers)} transfers via Node sender (@ton/ton)...", file=sys.stderr, flush=True)
+                return await self._send_with_seqno(lambda seqno: self._send_batch_via_node(transfers, seqno))
+            except Exception as node_error:
+                print(f"⚠️ Node sender failed: {node_error}, falling back to HTTP/pytoniq batch", file=sys.stderr, flush=True)
+            return await self._send_with_seqno(lambda seqno: self._send_batch_via_http(transfers, seqno))
+    
+    async def _send_with_seqno(self, send: Callable[[int], Awaitable[str]]) -> str:
+        """
+        Выполняет send(seqno) с seqno из локального счетчика (SeqnoManager). Вызывать под _send_lock.
+        Ошибка send - следующая отправка перечитает seqno из сети.
+        """
+        async with self._seqno.reserve() as seqno:
+            return await send(seqno)
 
     async def create_withdrawal(
         self,
-        db: Session,
+        db: AsyncSession,
         telegram_id: int,
         to_address: str,
         amount_nano: Decimal,
@@ -1238,20 +1242,21 @@ class TonService:
                 detail="TON wallet not configured. TON_WALLET_SEED is not set."
             )
 
-        user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
+        user = await db.scalar(select(models.User).where(models.User.telegram_id == telegram_id))
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        balance = db.query(models.UserBalance).filter(models.UserBalance.user_id == user.id).first()
+        balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user.id))
         if not balance:
             raise HTTPException(status_code=404, detail="Balance not found")
 
         key = idempotency_key or str(uuid.uuid4())
 
         existing = (
-            db.query(models.TonTransaction)
-            .filter(models.TonTransaction.idempotency_key == key)
-            .first()
+            await db.scalar(
+                select(models.TonTransaction)
+                .where(models.TonTransaction.idempotency_key == key)
+            )
         )
         if existing:
             return existing, False
@@ -1267,9 +1272,10 @@ class TonService:
         # ВАЖНО: Проверяем, не была ли уже создана транзакция с таким idempotency_key
         # и не был ли уже списан баланс
         existing_tx = (
-            db.query(models.TonTransaction)
-            .filter(models.TonTransaction.idempotency_key == key)
-            .first()
+            await db.scalar(
+                select(models.TonTransaction)
+                .where(models.TonTransaction.idempotency_key == key)
+            )
         )
         if existing_tx:
             # Если транзакция уже существует, проверяем, был ли списан баланс
@@ -1282,19 +1288,20 @@ class TonService:
         tx = models.TonTransaction(
             user_id=user.id,
             to_address=to_address,
+            to_address_canonical=canonical_address(to_address),
             amount_nano=amount_nano,
             status="pending",
             idempotency_key=key,
         )
         db.add(tx)
-        db.commit()
-        db.refresh(tx)
+        await db.commit()
+        await db.refresh(tx)
 
         try:
             # Валидация адреса
             try:
-                Address(to_address)
-            except Exception as addr_error:
+                parse_address(to_address)
+            except ValueError as addr_error:
                 raise HTTPException(
                     status_code=400,
                     detail=f"Invalid TON address: {to_address}. Error: {str(addr_error)}"
@@ -1318,15 +1325,15 @@ class TonService:
                     tx_hash = await self._send_raw(to_address, int(amount_nano), comment)
                     # ТОЛЬКО после успешной отправки списываем средства (ОДИН РАЗ)
                     if not funds_deducted:
-                        balance.ton_active_balance -= amount_nano
+                        apply_balance_delta(db, balance, -amount_nano, reason="withdrawal", ref_id=tx.id)
                         funds_deducted = True
                         print(f"✅ Transaction sent successfully on attempt {attempt}. Funds deducted from balance.", file=sys.stderr, flush=True)
                     else:
                         print(f"✅ Transaction sent successfully on attempt {attempt}. Funds already deducted, skipping.", file=sys.stderr, flush=True)
                     tx.tx_hash = tx_hash
                     tx.status = "pending"
-                    db.commit()
-                    db.refresh(tx)
+                    await db.commit()
+                    await db.refresh(tx)
                     break  # Успешно отправили
                 except Exception as send_error:
                     last_error = send_error
@@ -1342,8 +1349,8 @@ class TonService:
                         print(f"⚠️ All {max_retries} attempts failed. Transaction not sent, funds NOT deducted.", file=sys.stderr, flush=True)
                         tx.status = "failed"
                         tx.error_message = f"All {max_retries} send attempts failed: {error_msg[:200]}. Transaction not sent, funds remain on balance."
-                        db.commit()
-                        db.refresh(tx)
+                        await db.commit()
+                        await db.refresh(tx)
                         # Возвращаем транзакцию, но не выбрасываем ошибку - средства не списывались
                         return tx, True
                     
@@ -1354,8 +1361,8 @@ class TonService:
             if not tx_hash:
                 tx.status = "failed"
                 tx.error_message = f"Transaction not sent after {max_retries} attempts. Funds remain on balance."
-                db.commit()
-                db.refresh(tx)
+                await db.commit()
+                await db.refresh(tx)
                 return tx, True
                 
         except HTTPException:
@@ -1363,7 +1370,7 @@ class TonService:
             # Средства не списывались, так что просто удаляем транзакцию или помечаем как failed
             tx.status = "failed"
             tx.error_message = "Transaction validation failed. Funds not deducted."
-            db.commit()
+            await db.commit()
             raise
         except Exception as exc:
             # Ошибка при отправке - средства НЕ списывались
@@ -1374,8 +1381,8 @@ class TonService:
             
             tx.status = "failed"
             tx.error_message = f"Transaction failed: {error_msg[:500]}. Funds NOT deducted."
-            db.commit()
-            db.refresh(tx)
+            await db.commit()
+            await db.refresh(tx)
             raise HTTPException(
                 status_code=500, 
                 detail=f"TON send failed: {error_msg}"
@@ -1385,7 +1392,7 @@ class TonService:
 
     async def send_from_service_wallet(
         self,
-        db: Session,
+        db: AsyncSession,
         to_address: str,
         amount_nano: Decimal,
         notes: Optional[str] = None,
@@ -1414,9 +1421,10 @@ class TonService:
 
         # Проверяем идемпотентность
         existing = (
-            db.query(models.TonTransaction)
-            .filter(models.TonTransaction.idempotency_key == key)
-            .first()
+            await db.scalar(
+                select(models.TonTransaction)
+                .where(models.TonTransaction.idempotency_key == key)
+            )
         )
         if existing:
             return existing
@@ -1425,6 +1433,7 @@ class TonService:
         tx = models.TonTransaction(
             user_id=None,  # Админский вывод
             to_address=to_address,
+            to_address_canonical=canonical_address(to_address),
             amount_nano=amount_nano,
             status="pending",
             idempotency_key=key,
@@ -1432,22 +1441,22 @@ class TonService:
         )
 
         db.add(tx)
-        db.commit()
-        db.refresh(tx)
+        await db.commit()
+        await db.refresh(tx)
 
         try:
             # Отправляем транзакцию
             tx_hash = await self._send_raw(to_address, int(amount_nano))
             tx.tx_hash = tx_hash
             tx.status = "pending"
-            db.commit()
-            db.refresh(tx)
+            await db.commit()
+            await db.refresh(tx)
         except Exception as exc:
             # При ошибке помечаем как failed
             tx.status = "failed"
             tx.error_message = str(exc)
-            db.commit()
-            db.refresh(tx)
+            await db.commit()
+            await db.refresh(tx)
             raise HTTPException(status_code=500, detail=f"TON send failed: {exc}")
 
         return tx
@@ -1460,193 +1469,403 @@ class TonService:
         if not tx_hash or tx_hash == "unknown":
             return "pending"
         
-        try:
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=10),
-                connector=connector
-            ) as session:
+        async def lookup(provider: str) -> str:
+            async with self._session(provider, timeout=10) as session:
                 url = f"https://tonapi.io/v2/blockchain/transactions/{tx_hash}"
                 headers = {"Authorization": f"Bearer {self.api_key}"}
                 async with session.get(url, headers=headers) as resp:
                     if resp.status == 200:
-                        data = await resp.json()
                         # Если транзакция найдена - она completed
                         return "completed"
                     elif resp.status == 404:
                         # Транзакция еще не найдена в блокчейне
                         return "pending"
-                    else:
-                        return "pending"
+                    raise Exception(f"tonapi.io error: {resp.status}")
+        
+        try:
+            # Ошибки учитываются в здоровье tonapi; при разомкнутой цепи запрос не делается
+            return await self._providers.call(["tonapi"], lookup)
         except Exception:
             # При ошибке считаем pending
             return "pending"
 
-    async def _check_deposits_via_api(self, db: Session, normalized_address: str):
-        """Резервный метод: проверка депозитов через TON Center API"""
+    @staticmethod
+    def _deposit_address_variants(normalized_address: str) -> list:
+        """Варианты записи адреса кошелька для tonapi.io: как задан, raw, bounceable, non-bounceable."""
+        clean_address = normalized_address.strip()
+        addresses_to_try = [clean_address]
+        try:
+            variants = parse_address(clean_address).variants()
+        except ValueError as addr_error:
+            print(f"⚠️ Не удалось разобрать адрес кошелька: {addr_error}", file=sys.stderr, flush=True)
+            return addresses_to_try
+        return addresses_to_try + [addr for addr in variants if addr != clean_address]
+    
+    @staticmethod
+    def _is_own_wallet(source: str, normalized_address: str) -> bool:
+        """Отправитель - наш сервисный кошелек (исходящая транзакция / вывод)."""
+        return same_address(source, normalized_address)
+    
+    @staticmethod
+    def _telegram_id_from_comment(msg_text_str: str) -> Optional[str]:
+        """Ищет Telegram ID (8-12 цифр, опционально с префиксом tg:) в комментарии."""
+        if not msg_text_str:
+            return None
+        match_id = re.search(r'(?:tg:)?(\d{8,12})', msg_text_str)
+        return match_id.group(1) if match_id else None
+    
+    def _parse_tonapi_deposit(self, tx: dict, normalized_address: str) -> Optional[dict]:
+        """Входящий перевод из транзакции tonapi.io или None (исходящая, нулевая сумма, без in_msg)."""
         import sys
-        print("🔄 Пробуем через TON Center API (toncenter.com)...", file=sys.stderr, flush=True)
+        tx_hash = tx.get("hash", "")
+        in_msg = tx.get("in_msg")
+        if not tx_hash or not in_msg:
+            return None
+        
+        value = int(in_msg.get("value", 0))
+        if value <= 0:
+            return None
+        
+        # Получаем адрес отправителя
+        source = in_msg.get("source", {})
+        if isinstance(source, dict):
+            source = source.get("address", "") or source.get("raw_form", "")
+        if not source:
+            source = str(in_msg.get("source", ""))
+        
+        # КРИТИЧНО: исходящая транзакция с нашего кошелька (вывод) - не депозит
+        if self._is_own_wallet(source, normalized_address):
+            print(f"⚠️ ПРОПУСКАЕМ: транзакция {tx_hash[:16]}... - вывод с нашего кошелька", file=sys.stderr, flush=True)
+            return None
+        
+        # Получаем комментарий из тела сообщения - пробуем все возможные варианты
+        msg_text_str = ""
+        
+        # Вариант 1: msg_data.text
+        msg_data = in_msg.get("msg_data", {})
+        if isinstance(msg_data, dict):
+            msg_text_str = msg_data.get("text", "") or msg_data.get("body", "") or msg_data.get("comment", "")
+            if not msg_text_str and "text" in msg_data:
+                msg_text_str = str(msg_data["text"])
+        
+        # Вариант 2: decoded_body
+        if not msg_text_str:
+            decoded = in_msg.get("decoded_body", {})
+            if isinstance(decoded, dict):
+                msg_text_str = decoded.get("text", "") or decoded.get("comment", "") or decoded.get("body", "")
+        
+        # Вариант 3: body (base64)
+        if not msg_text_str:
+            body_b64 = in_msg.get("body", "")
+            if body_b64:
+                try:
+                    import base64
+                    decoded_bytes = base64.b64decode(body_b64)
+                    # Пропускаем первые 4 байта (обычно это op code)
+                    if len(decoded_bytes) > 4:
+                        msg_text_str = decoded_bytes[4:].decode('utf-8', errors='ignore').strip()
+                    elif len(decoded_bytes) > 0:
+                        msg_text_str = decoded_bytes.decode('utf-8', errors='ignore').strip()
+                except Exception as decode_err:
+                    print(f"⚠️ Ошибка декодирования body: {decode_err}", file=sys.stderr, flush=True)
+        
+        # Вариант 4: comment напрямую
+        if not msg_text_str:
+            msg_text_str = in_msg.get("comment", "") or in_msg.get("text", "")
+        
+        # Вариант 5: msg_data как строка
+        if not msg_text_str and isinstance(msg_data, str):
+            msg_text_str = msg_data
+        
+        return {
+            "tx_hash": tx_hash,
+            "lt": int(tx.get("lt", 0)),
+            "from_address": source,
+            "amount_nano": value,
+            "telegram_id": self._telegram_id_from_comment(msg_text_str),
+        }
+    
+    def _parse_toncenter_deposit(self, tx: dict, normalized_address: str) -> Optional[dict]:
+        """Входящий перевод из транзакции toncenter.com (hash приводится к hex, как у tonapi.io)."""
+        import base64
+        tx_id = tx.get("transaction_id", {})
+        tx_hash = self._toncenter_hash(tx_id.get("hash", ""))
+        in_msg = tx.get("in_msg")
+        if not tx_hash or not in_msg:
+            return None
+        
+        value = int(in_msg.get("value", 0))
+        if value <= 0:
+            return None
         
+        source = in_msg.get("source", "")
+        if self._is_own_wallet(source, normalized_address):
+            return None
+        
+        # Получаем комментарий
+        msg_text_str = ""
+        msg_body = in_msg.get("message", "")
+        if msg_body:
+            try:
+                decoded = base64.b64decode(msg_body)
+                msg_text_str = decoded.decode('utf-8', errors='ignore').strip()
+            except Exception:
+                msg_text_str = str(msg_body)
+        
+        return {
+            "tx_hash": tx_hash,
+            "lt": int(tx_id.get("lt", 0)),
+            "from_address": source,
+            "amount_nano": value,
+            "telegram_id": self._telegram_id_from_comment(msg_text_str),
+        }
+    
+    @staticmethod
+    def _toncenter_hash(tx_hash: str) -> str:
+        """toncenter.com отдает hash в base64, tonapi.io - в hex; в Deposit.tx_hash храним hex."""
+        import base64
         try:
-            import aiohttp
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
+            raw = base64.b64decode(tx_hash, validate=True)
+            if len(raw) == 32:
+                return raw.hex()
+        except Exception:
+            pass
+        return tx_hash
+    
+    async def _lock_deposit_cursor(self, db: AsyncSession, normalized_address: str) -> Optional[models.ChainCursor]:
+        """
+        Блокирует курсор депозитов кошелька (SELECT FOR UPDATE SKIP LOCKED) до commit.
+        None - курсор держит другой процесс (он уже сканирует депозиты).
+        """
+        from sqlalchemy.exc import IntegrityError
+        name = f"deposits:{normalized_address}"
+        cursor = await db.scalar(
+            select(models.ChainCursor)
+            .where(models.ChainCursor.name == name)
+            .with_for_update(skip_locked=True)
+        )
+        if cursor is not None:
+            return cursor
+        if await db.scalar(select(models.ChainCursor.name).where(models.ChainCursor.name == name)):
+            await db.rollback()
+            return None
+        
+        # Первый запуск: курсор создается, сканируется только последняя страница
+        cursor = models.ChainCursor(name=name, last_lt=0)
+        db.add(cursor)
+        try:
+            await db.flush()
+        except IntegrityError:
+            await db.rollback()
+            return None
+        return cursor
+    
+    async def _fetch_tonapi_transactions(self, normalized_address: str, after_lt: int) -> list:
+        """
+        Транзакции кошелька новее after_lt через tonapi.io: страницы от старых к новым
+        (sort_order=asc, after_lt - последняя транзакция предыдущей страницы). При лимите
+        DEPOSIT_SCAN_MAX_PAGES возвращается непрерывный отрезок сразу после курсора,
+        остальное дочитает следующий проход. Без курсора - только последняя страница.
+        """
+        import sys
+        async with self._session("tonapi", timeout=15) as session:
+            headers = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Accept": "application/json"
+            }
+            
+            # Формат адреса, который принимает tonapi.io, определяется один раз
+            account = self._providers.recall("tonapi", "account")
+            if account is None:
+                for addr in self._deposit_address_variants(normalized_address):
+                    url = f"https://tonapi.io/v2/blockchain/accounts/{addr}/transactions"
+                    try:
+                        async with session.get(url, headers=headers, params={"limit": 1}) as resp:
+                            if resp.status == 200:
+                                account = addr
+                                break
+                    except Exception as req_error:
+                        print(f"⚠️ Ошибка запроса к tonapi.io: {req_error}. Пробуем следующий вариант...", file=sys.stderr, flush=True)
+                if account is None:
+                    raise Exception("tonapi.io did not accept any wallet address format")
+                self._providers.remember("tonapi", "account", account)
             
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=10),
-                connector=connector
-            ) as session:
-                url = "https://toncenter.com/api/v2/getTransactions"
+            url = f"https://tonapi.io/v2/blockchain/accounts/{account}/transactions"
+            collected = []
+            page_after_lt = after_lt
+            for _ in range(DEPOSIT_SCAN_MAX_PAGES):
+                params = {"limit": DEPOSIT_SCAN_PAGE_SIZE, "sort_order": "asc" if after_lt else "desc"}
+                if page_after_lt:
+                    params["after_lt"] = page_after_lt
+                async with session.get(url, headers=headers, params=params) as resp:
+                    if resp.status != 200:
+                        text = await resp.text()
+                        raise Exception(f"tonapi.io error: {resp.status} - {text[:200]}")
+                    page = (await resp.json()).get("transactions", [])
+                
+                new = [tx for tx in page if int(tx.get("lt", 0)) > page_after_lt]
+                collected.extend(new)
+                # Дошли до последней транзакции или это первый запуск
+                if not after_lt or len(page) < DEPOSIT_SCAN_PAGE_SIZE or not new:
+                    return collected
+                page_after_lt = max(int(tx.get("lt", 0)) for tx in new)
+            
+            print(f"⚠️ Достигнут лимит {DEPOSIT_SCAN_MAX_PAGES} страниц при сканировании депозитов, продолжение - в следующем проходе", file=sys.stderr, flush=True)
+            return collected
+    
+    async def _fetch_toncenter_transactions(self, normalized_address: str, after_lt: int) -> Tuple[list, bool]:
+        """
+        То же через toncenter.com: страницы от новых к старым по (lt, hash) последней транзакции
+        (читать от старых к новым toncenter.com не умеет).
+        Returns: (транзакции, дочитали ли до курсора). Если уперлись в DEPOSIT_SCAN_MAX_PAGES,
+        между курсором и самой старой прочитанной транзакцией остался разрыв.
+        """
+        async with self._session("toncenter", timeout=10) as session:
+            url = "https://toncenter.com/api/v2/getTransactions"
+            collected = []
+            seen = set()
+            page_start = None
+            for _ in range(DEPOSIT_SCAN_MAX_PAGES):
                 params = {
                     "address": normalized_address,
-                    "limit": 50,
+                    "limit": DEPOSIT_SCAN_PAGE_SIZE,
                     "archival": "true"  # TON Center API требует строку, а не булево значение
                 }
-                
-                # TON Center API может работать без ключа для публичных запросов
-                # Но если ключ есть, используем его
                 if self.api_key:
                     params["api_key"] = self.api_key
-                    print(f"🔑 Используем API ключ для TON Center", file=sys.stderr, flush=True)
-                else:
-                    print(f"ℹ️ API ключ не установлен, пробуем публичный запрос", file=sys.stderr, flush=True)
-                
-                print(f"🌐 Запрос к TON Center: {url} с адресом {normalized_address[:20]}...", file=sys.stderr, flush=True)
+                if page_start:
+                    params["lt"], params["hash"] = page_start
                 
                 async with session.get(url, params=params) as resp:
-                    print(f"📡 TON Center API ответ: статус {resp.status}", file=sys.stderr, flush=True)
-                    
-                    if resp.status == 200:
-                        data = await resp.json()
-                        if data.get("ok"):
-                            transactions = data.get("result", [])
-                            print(f"📊 Найдено транзакций через TON Center: {len(transactions)}", file=sys.stderr, flush=True)
-                            
-                            if len(transactions) == 0:
-                                print("ℹ️ Новых транзакций не найдено", file=sys.stderr, flush=True)
-                                return
-                            
-                            # Обрабатываем транзакции
-                            for tx in transactions:
-                                tx_hash = tx.get("transaction_id", {}).get("hash", "")
-                                if not tx_hash:
-                                    continue
-                                
-                                existing = db.query(models.Deposit).filter(
-                                    models.Deposit.tx_hash == tx_hash
-                                ).first()
-                                if existing:
-                                    continue
-                                
-                                in_msg = tx.get("in_msg")
-                                if not in_msg:
-                                    continue
-                                
-                                value = int(in_msg.get("value", 0))
-                                if value <= 0:
-                                    continue
-                                
-                                source = in_msg.get("source", "")
-                                
-                                # КРИТИЧНО: Проверяем, что это НЕ исходящая транзакция с нашего кошелька
-                                # Если отправитель - это наш сервисный кошелек, это исходящая транзакция (вывод), пропускаем
-                                if source and normalized_address:
-                                    source_normalized = source.strip().upper().replace("-", "")
-                                    wallet_normalized = normalized_address.strip().upper().replace("-", "")
-                                    if (source_normalized == wallet_normalized or 
-                                        source_normalized.replace("UQ", "EQ") == wallet_normalized.replace("UQ", "EQ") or
-                                        source_normalized == wallet_normalized.replace("UQ", "EQ") or
-                                        source_normalized.replace("UQ", "EQ") == wallet_normalized):
-                                        print(f"⚠️⚠️⚠️ ПРОПУСКАЕМ (TON Center API): Это исходящая транзакция (вывод) с нашего кошелька.", file=sys.stderr, flush=True)
-                                        continue
-                                
-                                # Получаем комментарий
-                                msg_text_str = ""
-                                msg_body = in_msg.get("message", "")
-                                if msg_body:
-                                    try:
-                                        import base64
-                                        decoded = base64.b64decode(msg_body)
-                                        msg_text_str = decoded.decode('utf-8', errors='ignore').strip()
-                                    except:
-                                        msg_text_str = str(msg_body)
-                                
-                                # Ищем Telegram ID
-                                telegram_id = None
-                                if msg_text_str:
-                                    print(f"📝 Комментарий: {msg_text_str[:100]}", file=sys.stderr, flush=True)
-                                    match_id = re.search(r'(?:tg:)?(\d{8,12})', msg_text_str)
-                                    if match_id:
-                                        telegram_id = match_id.group(1)
-                                        print(f"✅ Найден Telegram ID: {telegram_id}", file=sys.stderr, flush=True)
-                                
-                                # Создаем депозит
-                                deposit = models.Deposit(
-                                    tx_hash=tx_hash,
-                                    from_address=source,
-                                    amount_nano=value,
-                                    telegram_id_from_comment=telegram_id,
-                                    status="pending"
-                                )
-                                db.add(deposit)
-                                db.commit()
-                                
-                                # Зачисляем на баланс если нашли ID
-                                if telegram_id:
-                                    try:
-                                        user = db.query(models.User).filter(
-                                            models.User.telegram_id == int(telegram_id)
-                                        ).first()
-                                        
-                                        if user:
-                                            balance = db.query(models.UserBalance).filter(
-                                                models.UserBalance.user_id == user.id
-                                            ).first()
-                                            
-                                            if not balance:
-                                                balance = models.UserBalance(
-                                                    user_id=user.id,
-                                                    ton_active_balance=value,
-                                                    last_fiat_rate=Decimal("250"),
-                                                    fiat_currency="RUB"
-                                                )
-                                                db.add(balance)
-                                            else:
-                                                balance.ton_active_balance += value
-                                            
-                                            deposit.user_id = user.id
-                                            deposit.status = "processed"
-                                            deposit.processed_at = datetime.utcnow()
-                                            db.commit()
-                                            
-                                            print(f"✅ Автоматически зачислено {value / 10**9:.4f} TON пользователю {telegram_id}", file=sys.stderr, flush=True)
-                                    except Exception as e:
-                                        print(f"⚠️ Ошибка обработки: {e}", file=sys.stderr, flush=True)
-                        else:
-                            error_msg = data.get('error', 'Unknown')
-                            print(f"⚠️ TON Center API ошибка: {error_msg}", file=sys.stderr, flush=True)
-                    elif resp.status == 401:
-                        # 401 - Unauthorized, возможно API ключ неверный или не требуется
-                        text = await resp.text()
-                        print(f"⚠️ TON Center API 401 Unauthorized. Ответ: {text[:200]}", file=sys.stderr, flush=True)
-                        print(f"💡 Попробуйте проверить TONAPI_KEY в Railway или оставьте его пустым для публичных запросов", file=sys.stderr, flush=True)
-                    else:
+                    if resp.status != 200:
                         text = await resp.text()
-                        print(f"⚠️ TON Center API статус {resp.status}. Ответ: {text[:200]}", file=sys.stderr, flush=True)
-        except Exception as e:
-            print(f"❌ Ошибка TON Center API: {e}", file=sys.stderr, flush=True)
+                        raise Exception(f"TON Center API HTTP error: {resp.status} - {text[:200]}")
+                    data = await resp.json()
+                    if not data.get("ok"):
+                        raise Exception(f"TON Center API error: {data.get('error', 'Unknown')}")
+                    page = data.get("result", [])
+                
+                # Следующая страница начинается с последней транзакции предыдущей
+                page = [tx for tx in page if tx.get("transaction_id", {}).get("hash") not in seen]
+                seen.update(tx.get("transaction_id", {}).get("hash") for tx in page)
+                new = [tx for tx in page if int(tx.get("transaction_id", {}).get("lt", 0)) > after_lt]
+                collected.extend(new)
+                if not after_lt or not page or len(new) < len(page):
+                    return collected, True
+                oldest = page[-1]["transaction_id"]
+                page_start = (oldest.get("lt"), oldest.get("hash"))
+            print(f"⚠️ Достигнут лимит {DEPOSIT_SCAN_MAX_PAGES} страниц при сканировании депозитов через toncenter.com, курсор не сдвигается", file=sys.stderr, flush=True)
+            return collected, False
+    
+    async def _ingest_deposits(self, db: AsyncSession, cursor: models.ChainCursor, deposits: list, newest: Tuple[int, str]) -> int:
+        """
+        Записывает новые депозиты, зачисляет их и сдвигает курсор одной транзакцией.
+        Уже записанные отсекаются одним запросом tx_hash IN (...).
+        
+        Returns:
+            Количество зачисленных депозитов
+        """
+        import sys
+        from app.balance_ledger import lock_balances
+        
+        credited = 0
+        hashes = list({deposit["tx_hash"] for deposit in deposits})
+        existing = set((await db.scalars(
+            select(models.Deposit.tx_hash).where(models.Deposit.tx_hash.in_(hashes))
+        )).all()) if hashes else set()
+        
+        new_deposits = []
+        for deposit in sorted(deposits, key=lambda d: d["lt"]):
+            if deposit["tx_hash"] in existing:
+                continue
+            existing.add(deposit["tx_hash"])
+            new_deposits.append(deposit)
+        
+        if new_deposits:
+            telegram_ids = {int(d["telegram_id"]) for d in new_deposits if d["telegram_id"]}
+            users = {
+                user.telegram_id: user
+                for user in (await db.scalars(
+                    select(models.User).where(models.User.telegram_id.in_(telegram_ids))
+                )).all()
+            } if telegram_ids else {}
+            balances = await lock_balances(db, [user.id for user in users.values()])
+            
+            for deposit in new_deposits:
+                record = models.Deposit(
+                    tx_hash=deposit["tx_hash"],
+                    from_address=deposit["from_address"],
+                    from_address_canonical=canonical_address(deposit["from_address"]),
+                    amount_nano=deposit["amount_nano"],
+                    telegram_id_from_comment=deposit["telegram_id"],
+                    status="pending"
+                )
+                db.add(record)
+                
+                user = users.get(int(deposit["telegram_id"])) if deposit["telegram_id"] else None
+                if user is None:
+                    print(f"⚠️ Депозит {deposit['tx_hash'][:16]}... ({deposit['amount_nano'] / 10**9:.4f} TON) без пользователя, Telegram ID={deposit['telegram_id'] or 'не найден'}", file=sys.stderr, flush=True)
+                    continue
+                
+                balance = balances.get(user.id)
+                if balance is None:
+                    balance = models.UserBalance(
+                        user_id=user.id,
+                        ton_active_balance=0,
+                        last_fiat_rate=Decimal("250"),
+                        fiat_currency="RUB"
+                    )
+                    db.add(balance)
+                    balances[user.id] = balance
+                apply_balance_delta(db, balance, deposit["amount_nano"], reason="deposit", ref_id=deposit["tx_hash"])
+                
+                record.user_id = user.id
+                record.status = "processed"
+                record.processed_at = datetime.utcnow()
+                credited += 1
+                print(f"✅ АВТОМАТИЧЕСКИ ЗАЧИСЛЕНО {deposit['amount_nano'] / 10**9:.4f} TON пользователю {deposit['telegram_id']} (ID в БД: {user.id})", file=sys.stderr, flush=True)
+        
+        newest_lt, newest_hash = newest
+        if newest_lt > (cursor.last_lt or 0):
+            cursor.last_lt = newest_lt
+            cursor.last_hash = newest_hash
+        await db.commit()
+        if new_deposits:
+            print(f"✅ Новых депозитов: {len(new_deposits)}, зачислено: {credited}", file=sys.stderr, flush=True)
+        return credited
+    
+    async def _scan_deposits(self, provider: str, normalized_address: str, after_lt: int) -> Tuple[list, Tuple[int, Optional[str]]]:
+        """
+        Транзакции новее after_lt через провайдера provider.
+        Returns: (депозиты, (lt, hash), до которой транзакции прочитаны без разрывов, или (0, None))
+        """
+        if provider == "tonapi":
+            transactions = await self._fetch_tonapi_transactions(normalized_address, after_lt)
+            deposits = [d for d in (self._parse_tonapi_deposit(tx, normalized_address) for tx in transactions) if d]
+            newest = max(((int(tx.get("lt", 0)), tx.get("hash")) for tx in transactions), default=(0, None))
+        else:
+            transactions, complete = await self._fetch_toncenter_transactions(normalized_address, after_lt)
+            deposits = [d for d in (self._parse_toncenter_deposit(tx, normalized_address) for tx in transactions) if d]
+            # С разрывом курсор не сдвигается: прочитанные депозиты записываются (повтор отсечет
+            # tx_hash), пропущенные дочитает следующий проход
+            newest = max(
+                ((int(tx["transaction_id"].get("lt", 0)), self._toncenter_hash(tx["transaction_id"].get("hash", ""))) for tx in transactions),
+                default=(0, None)
+            ) if complete else (0, None)
+        return deposits, newest
 
-    async def check_incoming_deposits(self, db: Session):
+    async def check_incoming_deposits(self, db: AsyncSession):
         """
         Проверяет входящие транзакции на сервисный кошелек и автоматически зачисляет на балансы пользователей.
         Ищет Telegram ID в комментарии транзакции.
-        Использует прямой запрос к блокчейну через pytoniq вместо TON API.
+        
+        Читаются только транзакции новее сохраненного курсора (chain_cursors.last_lt);
+        курсор сдвигается только до транзакции, до которой все прочитано без разрывов
+        (см. _scan_deposits), поэтому всплеск депозитов не теряется, а пустая минута
+        стоит один запрос к API. Провайдера (tonapi.io или toncenter.com)
+        выбирает ProviderRegistry по задержке и ошибкам; провайдер с разомкнутой
+        цепью пропускается без ожидания таймаута. Запись депозитов, зачисление и
+        сдвиг курсора - одна транзакция (exactly-once).
         """
         import sys
         
@@ -1654,361 +1873,144 @@ class TonService:
         if not self.wallet_address:
             print("⚠️ TON_WALLET_ADDRESS не настроен", file=sys.stderr, flush=True)
             return
+        if not self.api_key:
+            print("⚠️ TONAPI_KEY не установлен, пропускаем проверку депозитов", file=sys.stderr, flush=True)
+            return
         
         # Нормализуем адрес
         normalized_address = self.wallet_address.strip()
-        print(f"🔍 Проверка депозитов для кошелька: {normalized_address[:20]}...", file=sys.stderr, flush=True)
-        
-        # Используем tonapi.io для проверки депозитов (у нас уже есть API ключ)
-        print("🔄 Используем tonapi.io для проверки депозитов...", file=sys.stderr, flush=True)
-        return await self._check_deposits_via_tonapi(db, normalized_address)
-    
-    async def _check_deposits_via_tonapi(self, db: Session, normalized_address: str):
-        """
-        Проверяет входящие депозиты через tonapi.io.
-        Парсит комментарии транзакций для извлечения Telegram ID и автоматически зачисляет средства.
-        """
-        import sys
-        
-        if not self.api_key:
-            print("⚠️ TONAPI_KEY не установлен, пропускаем проверку через tonapi.io", file=sys.stderr, flush=True)
-            return
         
         try:
-            # Нормализуем адрес: конвертируем user-friendly (UQ...) в raw (EQ...)
-            clean_address = normalized_address.strip()
-            
-            # Собираем все возможные варианты адреса
-            addresses_to_try = []
-            
-            # 1. Исходный адрес
-            addresses_to_try.append(clean_address)
-            
-            # 2. Пробуем конвертировать через pytoniq
-            try:
-                from pytoniq import Address as PytoniqAddress
-                addr_obj = PytoniqAddress(clean_address)
-                # Получаем raw формат (EQ...)
-                raw_bounceable = addr_obj.to_str(is_user_friendly=False, is_bounceable=True)
-                raw_non_bounceable = addr_obj.to_str(is_user_friendly=False, is_bounceable=False)
-                if raw_bounceable not in addresses_to_try:
-                    addresses_to_try.append(raw_bounceable)
-                if raw_non_bounceable not in addresses_to_try:
-                    addresses_to_try.append(raw_non_bounceable)
-                print(f"✅ Адрес нормализован через pytoniq: {clean_address[:20]}... → {raw_bounceable[:20]}...", file=sys.stderr, flush=True)
-            except Exception as addr_error:
-                print(f"⚠️ Не удалось нормализовать адрес через pytoniq: {addr_error}", file=sys.stderr, flush=True)
-            
-            # 3. Простая конвертация UQ -> EQ
-            if clean_address.startswith("UQ"):
-                eq_address = "EQ" + clean_address[2:]
-                if eq_address not in addresses_to_try:
-                    addresses_to_try.append(eq_address)
-                    print(f"🔄 Добавлен вариант адреса: {eq_address[:30]}...", file=sys.stderr, flush=True)
-            
-            # 4. Пробуем без дефисов (URL encoding может требовать)
-            for addr in addresses_to_try[:]:  # Копируем список
-                addr_no_dash = addr.replace("-", "")
-                if addr_no_dash not in addresses_to_try:
-                    addresses_to_try.append(addr_no_dash)
-            
-            print(f"📋 Всего вариантов адреса для проверки: {len(addresses_to_try)}", file=sys.stderr, flush=True)
+            cursor = await self._lock_deposit_cursor(db, normalized_address)
+            if cursor is None:
+                print("ℹ️ Депозиты сканирует другой процесс", file=sys.stderr, flush=True)
+                return
             
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=15),
-                connector=connector
-            ) as session:
-                success = False
-                transactions = []
-                
-                # Пробуем разные endpoints и форматы адресов
-                endpoints_to_try = [
-                    "/v2/accounts/{}/transactions",
-                    "/v2/blockchain/accounts/{}/transactions",
-                ]
-                
-                for endpoint_template in endpoints_to_try:
-                    if success:
-                        break
-                    
-                    for addr in addresses_to_try:
-                        if success:
-                            break
-                            
-                        url = f"https://tonapi.io{endpoint_template.format(addr)}"
-                        headers = {
-                            "Authorization": f"Bearer {self.api_key}",
-                            "Accept": "application/json"
-                        }
-                        
-                        params = {
-                            "limit": 100,  # Получаем последние 100 транзакций
-                            "min_lt": 0  # Можно добавить фильтр по логическому времени
-                        }
-                        
-                        # Убрано логирование каждого запроса - это нормальный процесс поиска правильного endpoint
-                        
-                        try:
-                            async with session.get(url, headers=headers, params=params) as resp:
-                                if resp.status == 200:
-                                    data = await resp.json()
-                                    transactions = data.get("transactions", [])
-                                    if transactions:
-                                        print(f"✅✅✅ УСПЕШНО получены транзакции через адрес {addr[:30]}... (endpoint: {endpoint_template})", file=sys.stderr, flush=True)
-                                        success = True
-                                        break
-                                    else:
-                                        print(f"⚠️ Ответ 200, но транзакций нет. Пробуем следующий вариант...", file=sys.stderr, flush=True)
-                                elif resp.status == 404:
-                                    # 404 - это нормально, просто этот endpoint не поддерживает такой формат адреса
-                                    # Не логируем, чтобы не пугать пользователя
-                                    continue
-                                else:
-                                    text = await resp.text()
-                                    print(f"⚠️ tonapi.io ошибка: статус {resp.status}. Ответ: {text[:200]}", file=sys.stderr, flush=True)
-                                    continue
-                        except Exception as req_error:
-                            print(f"⚠️ Ошибка запроса к tonapi.io: {req_error}. Пробуем следующий вариант...", file=sys.stderr, flush=True)
-                            continue
-                
-                if not success:
-                    print(f"❌❌❌ Не удалось получить транзакции через tonapi.io ни для одного формата адреса/endpoint", file=sys.stderr, flush=True)
-                    print(f"🔄 Пробуем fallback через TON Center API...", file=sys.stderr, flush=True)
-                    # Fallback на TON Center API
-                    await self._check_deposits_via_api(db, clean_address)
-                    return
-                
-                if len(transactions) == 0:
-                    print("ℹ️ Новых транзакций не найдено", file=sys.stderr, flush=True)
-                    return
-                
-                print(f"📊 Найдено транзакций через tonapi.io: {len(transactions)}", file=sys.stderr, flush=True)
-                
-                processed_count = 0
-                # Обрабатываем транзакции (они идут от новых к старым)
-                for tx in transactions:
-                    try:
-                        # Получаем хэш транзакции
-                        tx_hash = tx.get("hash", "")
-                        if not tx_hash:
-                            print(f"⚠️ Транзакция без hash, пропускаем", file=sys.stderr, flush=True)
-                            continue
-                        
-                        # Проверяем, не обрабатывали ли мы уже эту транзакцию
-                        existing = db.query(models.Deposit).filter(
-                            models.Deposit.tx_hash == tx_hash
-                        ).first()
-                        if existing:
-                            print(f"ℹ️ Транзакция {tx_hash[:16]}... уже обработана (статус: {existing.status})", file=sys.stderr, flush=True)
-                            continue
-                        
-                        # Получаем входящие сообщения (incoming transactions)
-                        in_msg = tx.get("in_msg")
-                        if not in_msg:
-                            print(f"⚠️ Транзакция {tx_hash[:16]}... без in_msg, пропускаем", file=sys.stderr, flush=True)
-                            continue
-                        
-                        # Получаем сумму транзакции
-                        value = int(in_msg.get("value", 0))
-                        if value <= 0:
-                            print(f"⚠️ Транзакция {tx_hash[:16]}... с нулевой суммой, пропускаем", file=sys.stderr, flush=True)
-                            continue
-                        
-                        print(f"💰 Найдена транзакция: {tx_hash[:16]}... Сумма: {value / 10**9:.4f} TON", file=sys.stderr, flush=True)
-                        
-                        # Получаем адрес отправителя
-                        source = in_msg.get("source", {})
-                        if isinstance(source, dict):
-                            source = source.get("address", "") or source.get("raw_form", "")
-                        if not source:
-                            source = str(in_msg.get("source", ""))
-                        
-                        print(f"📤 Отправитель: {source[:30]}...", file=sys.stderr, flush=True)
-                        
-                        # КРИТИЧНО: Проверяем, что это НЕ исходящая транзакция с нашего кошелька
-                        # Если отправитель - это наш сервисный кошелек, это исходящая транзакция (вывод), пропускаем
-                        if source and normalized_address:
-                            # Нормализуем оба адреса для сравнения
-                            source_normalized = source.strip().upper().replace("-", "")
-                            wallet_normalized = normalized_address.strip().upper().replace("-", "")
-                            # Также проверяем варианты с UQ/EQ
-                            if (source_normalized == wallet_normalized or 
-                                source_normalized.replace("UQ", "EQ") == wallet_normalized.replace("UQ", "EQ") or
-                                source_normalized == wallet_normalized.replace("UQ", "EQ") or
-                                source_normalized.replace("UQ", "EQ") == wallet_normalized):
-                                print(f"⚠️⚠️⚠️ ПРОПУСКАЕМ: Это исходящая транзакция (вывод) с нашего кошелька. Отправитель совпадает с сервисным кошельком.", file=sys.stderr, flush=True)
-                                continue
-                        
-                        # Получаем комментарий из тела сообщения - пробуем все возможные варианты
-                        telegram_id = None
-                        msg_text_str = ""
-                        
-                        # Вариант 1: msg_data.text
-                        msg_data = in_msg.get("msg_data", {})
-                        if isinstance(msg_data, dict):
-                            msg_text_str = msg_data.get("text", "") or msg_data.get("body", "") or msg_data.get("comment", "")
-                            if not msg_text_str and "text" in msg_data:
-                                msg_text_str = str(msg_data["text"])
-                        
-                        # Вариант 2: decoded_body
-                        if not msg_text_str:
-                            decoded = in_msg.get("decoded_body", {})
-                            if isinstance(decoded, dict):
-                                msg_text_str = decoded.get("text", "") or decoded.get("comment", "") or decoded.get("body", "")
-                        
-                        # Вариант 3: body (base64)
-                        if not msg_text_str:
-                            body_b64 = in_msg.get("body", "")
-                            if body_b64:
-                                try:
-                                    import base64
-                                    decoded_bytes = base64.b64decode(body_b64)
-                                    # Пропускаем первые 4 байта (обычно это op code)
-                                    if len(decoded_bytes) > 4:
-                                        msg_text_str = decoded_bytes[4:].decode('utf-8', errors='ignore').strip()
-                                    elif len(decoded_bytes) > 0:
-                                        # Если меньше 4 байт, пробуем декодировать всё
-                                        msg_text_str = decoded_bytes.decode('utf-8', errors='ignore').strip()
-                                except Exception as decode_err:
-                                    print(f"⚠️ Ошибка декодирования body: {decode_err}", file=sys.stderr, flush=True)
-                        
-                        # Вариант 4: comment напрямую
-                        if not msg_text_str:
-                            msg_text_str = in_msg.get("comment", "") or in_msg.get("text", "")
-                        
-                        # Вариант 5: пробуем из msg_data как строку
-                        if not msg_text_str and isinstance(msg_data, str):
-                            msg_text_str = msg_data
-                        
-                        # Логируем структуру для диагностики
-                        if not msg_text_str:
-                            print(f"🔍 Структура in_msg для диагностики: {str(in_msg)[:500]}", file=sys.stderr, flush=True)
-                        
-                        # Ищем Telegram ID в комментарии
-                        if msg_text_str:
-                            print(f"📝 Комментарий транзакции: {msg_text_str[:200]}", file=sys.stderr, flush=True)
-                            # Ищем паттерн: числа от 8 до 12 цифр (Telegram ID)
-                            match_id = re.search(r'(?:tg:)?(\d{8,12})', msg_text_str)
-                            if match_id:
-                                telegram_id = match_id.group(1)
-                                print(f"✅✅✅ Найден Telegram ID в комментарии: {telegram_id}", file=sys.stderr, flush=True)
-                            else:
-                                print(f"⚠️ Telegram ID не найден в комментарии. Комментарий: '{msg_text_str[:100]}'", file=sys.stderr, flush=True)
-                        else:
-                            print(f"⚠️ Комментарий не найден в транзакции {tx_hash[:16]}...", file=sys.stderr, flush=True)
-                        
-                        # Создаем запись о депозите (даже если Telegram ID не найден)
-                        deposit = models.Deposit(
-                            tx_hash=tx_hash,
-                            from_address=source,
-                            amount_nano=value,
-                            telegram_id_from_comment=telegram_id,
-                            status="pending"
-                        )
-                        db.add(deposit)
-                        db.commit()
-                        print(f"💾 Создана запись о депозите: ID={deposit.id}, TX={tx_hash[:16]}..., сумма={value / 10**9:.4f} TON, Telegram ID={telegram_id or 'не найден'}", file=sys.stderr, flush=True)
-                        
-                        # Зачисляем на баланс если нашли ID
-                        if telegram_id:
-                            try:
-                                user = db.query(models.User).filter(
-                                    models.User.telegram_id == int(telegram_id)
-                                ).first()
-                                
-                                if user:
-                                    balance = db.query(models.UserBalance).filter(
-                                        models.UserBalance.user_id == user.id
-                                    ).first()
-                                    
-                                    if not balance:
-                                        balance = models.UserBalance(
-                                            user_id=user.id,
-                                            ton_active_balance=value,
-                                            last_fiat_rate=Decimal("250"),
-                                            fiat_currency="RUB"
-                                        )
-                                        db.add(balance)
-                                        print(f"✅ Создан новый баланс для пользователя {telegram_id}", file=sys.stderr, flush=True)
-                                    else:
-                                        balance.ton_active_balance += value
-                                        print(f"✅ Обновлен баланс пользователя {telegram_id}: +{value / 10**9:.4f} TON", file=sys.stderr, flush=True)
-                                    
-                                    deposit.user_id = user.id
-                                    deposit.status = "processed"
-                                    deposit.processed_at = datetime.utcnow()
-                                    db.commit()
-                                    
-                                    print(f"✅✅✅ АВТОМАТИЧЕСКИ ЗАЧИСЛЕНО {value / 10**9:.4f} TON пользователю {telegram_id} (ID в БД: {user.id})", file=sys.stderr, flush=True)
-                                    processed_count += 1
-                                else:
-                                    print(f"⚠️ Пользователь с Telegram ID {telegram_id} не найден в БД", file=sys.stderr, flush=True)
-                            except Exception as e:
-                                import traceback
-                                print(f"❌ Ошибка обработки депозита для {telegram_id}: {e}", file=sys.stderr, flush=True)
-                                traceback.print_exc(file=sys.stderr)
-                        else:
-                            print(f"⚠️ Telegram ID не найден в комментарии транзакции {tx_hash[:16]}...", file=sys.stderr, flush=True)
-                        
-                    except Exception as tx_error:
-                        import traceback
-                        print(f"❌ Ошибка обработки транзакции: {tx_error}", file=sys.stderr, flush=True)
-                        traceback.print_exc(file=sys.stderr)
-                        continue
-                
-                print(f"✅ Обработано новых депозитов: {processed_count}", file=sys.stderr, flush=True)
-                        
+            after_lt = cursor.last_lt or 0
+            deposits, newest = await self._providers.call(
+                DEPOSIT_PROVIDERS,
+                lambda provider: self._scan_deposits(provider, normalized_address, after_lt)
+            )
+            await self._ingest_deposits(db, cursor, deposits, newest)
         except Exception as e:
             import traceback
-            print(f"❌ Критическая ошибка при проверке депозитов через tonapi.io: {e}", file=sys.stderr, flush=True)
+            await db.rollback()
+            print(f"❌ Ошибка при проверке депозитов: {e}", file=sys.stderr, flush=True)
             traceback.print_exc(file=sys.stderr)
     
-    async def process_pending_withdrawals(self, db: Session):
+    @staticmethod
+    def _withdrawal_age(tx: models.TonTransaction) -> timedelta:
+        """Сколько времени прошло с момента создания вывода."""
+        if not tx.created_at:
+            return timedelta(0)
+        created_at = tx.created_at.replace(tzinfo=None) if tx.created_at.tzinfo else tx.created_at
+        return datetime.utcnow() - created_at
+    
+    @staticmethod
+    def _withdrawal_retry_delay(attempts: int) -> float:
+        """Пауза перед следующей попыткой отправки: экспонента с jitter (от половины до целой)."""
+        delay = min(WITHDRAWAL_RETRY_BASE_SECONDS * 2 ** (attempts - 1), WITHDRAWAL_RETRY_MAX_SECONDS)
+        return delay / 2 + random.uniform(0, delay / 2)
+    
+    def _record_withdrawal_failure(self, tx: models.TonTransaction, error: Exception):
+        """
+        Записывает неудачную попытку отправки и назначает следующую (commit не делает).
+        Средства НЕ списывались, так что возвращать нечего.
+        """
+        error_msg = str(error)
+        tx.send_attempts = (tx.send_attempts or 0) + 1
+        tx.last_error_class = type(error).__name__[:100]
+        time_since_creation = self._withdrawal_age(tx)
+        
+        # Если попыток слишком много или транзакция слишком старая - помечаем как failed
+        if tx.send_attempts >= WITHDRAWAL_MAX_AUTO_ATTEMPTS or time_since_creation > WITHDRAWAL_MAX_WAIT:
+            print(f"⚠️ Too many failed attempts ({tx.send_attempts}) or too old transaction {tx.id}, marking as failed (funds were never deducted).", file=sys.stderr, flush=True)
+            tx.status = "failed"
+            tx.next_attempt_at = None
+            tx.error_message = f"Transaction failed after {tx.send_attempts} attempts: {error_msg[:200]}. Funds were never deducted."
+        else:
+            delay = self._withdrawal_retry_delay(tx.send_attempts)
+            tx.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            tx.error_message = f"Attempt {tx.send_attempts} failed: {error_msg[:200]}"
+            print(f"🔁 Transaction {tx.id}: retry {tx.send_attempts + 1} in {delay:.0f}s", file=sys.stderr, flush=True)
+    
+    @staticmethod
+    def _plan_withdrawal_batches(txs: List[models.TonTransaction]) -> List[List[models.TonTransaction]]:
+        """
+        Раскладывает выводы по пакетам в порядке очереди: не больше TON_WITHDRAWAL_BATCH_SIZE
+        переводов и не больше TON_WITHDRAWAL_BATCH_MAX_NANO на пакет.
+        Вывод больше лимита уходит отдельным пакетом из одного перевода.
+        """
+        batches: List[List[models.TonTransaction]] = []
+        current: List[models.TonTransaction] = []
+        current_value = 0
+        for tx in txs:
+            amount = int(tx.amount_nano)
+            if current and (
+                len(current) >= TON_WITHDRAWAL_BATCH_SIZE
+                or current_value + amount > TON_WITHDRAWAL_BATCH_MAX_NANO
+            ):
+                batches.append(current)
+                current, current_value = [], 0
+            current.append(tx)
+            current_value += amount
+        if current:
+            batches.append(current)
+        return batches
+    
+    async def process_pending_withdrawals(self, db: AsyncSession):
         """
         Обрабатывает pending транзакции вывода, которые не удалось отправить сразу.
         Пробует отправить их снова. Средства списываются ТОЛЬКО после успешной отправки.
+        В режиме TON_WITHDRAWAL_BATCHING выводы уходят пакетами - по несколько
+        переводов в одном внешнем сообщении (см. _process_withdrawal_batches).
         """
         from app.models import TonTransaction
-        import sys
-        from datetime import datetime, timedelta
         
-        # Находим все pending транзакции без tx_hash (средства еще не списаны)
+        # Выводы, отправленные в прошлый раз, но не записанные до конца (сбой между
+        # фиксацией отправки и списанием): списываем, а не отправляем повторно
+        recorded = await self._record_sent_withdrawals(db)
+        if recorded:
+            print(f"✅ Deducted funds for {recorded} withdrawals sent in a previous round", file=sys.stderr, flush=True)
+        
+        # Находим pending транзакции без tx_hash (средства еще не списаны), для которых
+        # наступило время попытки (next_attempt_at NULL - еще не пробовали)
         # ВАЖНО: tx_hash.is_(None) проверяет, что tx_hash действительно NULL в БД
-        pending_txs = db.query(TonTransaction).filter(
+        per_message = TON_WITHDRAWAL_BATCH_SIZE if TON_WITHDRAWAL_BATCHING else 1
+        pending_txs = (await db.scalars(select(TonTransaction).where(
             TonTransaction.status == "pending",
-            TonTransaction.tx_hash.is_(None)
-        ).limit(10).all()  # Обрабатываем максимум 10 за раз
+            TonTransaction.tx_hash.is_(None),
+            or_(TonTransaction.next_attempt_at.is_(None), TonTransaction.next_attempt_at <= datetime.utcnow())
+        ).order_by(TonTransaction.id).limit(WITHDRAWAL_MESSAGES_PER_ROUND * per_message))).all()
         
         if not pending_txs:
             return
         
         print(f"🔄 Processing {len(pending_txs)} pending withdrawal transactions (funds not deducted yet)...", file=sys.stderr, flush=True)
         
+        if TON_WITHDRAWAL_BATCHING:
+            await self._process_withdrawal_batches(db, pending_txs)
+            return
+        
         for tx in pending_txs:
             try:
                 # Проверяем, сколько времени прошло с момента создания транзакции
-                time_since_creation = datetime.utcnow() - (tx.created_at.replace(tzinfo=None) if tx.created_at and tx.created_at.tzinfo else tx.created_at) if tx.created_at else timedelta(0)
-                max_wait_time = timedelta(minutes=10)  # Максимальное время ожидания - 10 минут
+                time_since_creation = self._withdrawal_age(tx)
                 
                 # Если транзакция слишком старая и все еще не отправлена - помечаем как failed
                 # Средства НЕ списывались, так что возвращать нечего
-                if time_since_creation > max_wait_time:
+                if time_since_creation > WITHDRAWAL_MAX_WAIT:
                     print(f"⚠️ Transaction {tx.id} is too old ({time_since_creation}), marking as failed (funds were never deducted).", file=sys.stderr, flush=True)
                     tx.status = "failed"
                     tx.error_message = f"Transaction failed: could not send after {time_since_creation}. Funds were never deducted."
-                    db.commit()
+                    await db.commit()
                     continue
                 
                 # Получаем пользователя для комментария
                 user = None
                 comment = None
                 if tx.user_id:
-                    user = db.query(models.User).filter(models.User.id == tx.user_id).first()
+                    user = await db.scalar(select(models.User).where(models.User.id == tx.user_id))
                     if user:
                         comment = str(user.telegram_id)
                 
@@ -2021,88 +2023,199 @@ class TonService:
                 # Пробуем отправить транзакцию
                 print(f"🔄 Attempting to send pending transaction {tx.id}...", file=sys.stderr, flush=True)
                 tx_hash = await self._send_raw(tx.to_address, int(tx.amount_nano), comment)
-                
-                # ТОЛЬКО после успешной отправки списываем средства (если еще не списаны)
-                if tx.user_id and user:
-                    balance = db.query(models.UserBalance).filter(
-                        models.UserBalance.user_id == user.id
-                    ).first()
-                    if balance:
-                        # Проверяем, не были ли средства уже списаны (по наличию tx_hash в БД)
-                        # Перезагружаем транзакцию из БД для проверки актуального состояния
-                        db.refresh(tx)
-                        if not tx.tx_hash:  # Если tx_hash все еще None, списываем
-                            balance.ton_active_balance -= tx.amount_nano
-                            print(f"✅ Funds deducted from balance after successful send: {float(tx.amount_nano) / 10**9:.4f} TON", file=sys.stderr, flush=True)
-                        else:
-                            print(f"⚠️ Transaction {tx.id} already has tx_hash, funds already deducted, skipping.", file=sys.stderr, flush=True)
-                
-                tx.tx_hash = tx_hash
-                tx.status = "pending"  # Остается pending до подтверждения
-                tx.error_message = None  # Очищаем ошибку
-                db.commit()
-                print(f"✅ Pending transaction {tx.id} sent successfully! Hash: {tx_hash[:20]}...", file=sys.stderr, flush=True)
             except Exception as e:
-                error_msg = str(e)
-                print(f"⚠️ Failed to send pending transaction {tx.id}: {error_msg}", file=sys.stderr, flush=True)
-                
-                # Подсчитываем количество попыток по error_message
-                attempt_count = tx.error_message.count("attempt") if tx.error_message else 0
-                max_auto_attempts = 5  # Максимум автоматических попыток
-                
-                # Проверяем время с момента создания
-                time_since_creation = datetime.utcnow() - (tx.created_at.replace(tzinfo=None) if tx.created_at and tx.created_at.tzinfo else tx.created_at) if tx.created_at else timedelta(0)
-                max_wait_time = timedelta(minutes=10)
-                
-                # Если попыток слишком много или транзакция слишком старая - помечаем как failed
-                # Средства НЕ списывались, так что возвращать нечего
-                if attempt_count >= max_auto_attempts or time_since_creation > max_wait_time:
-                    print(f"⚠️ Too many failed attempts ({attempt_count}) or too old transaction {tx.id}, marking as failed (funds were never deducted).", file=sys.stderr, flush=True)
-                    tx.status = "failed"
-                    tx.error_message = f"Transaction failed after {attempt_count + 1} attempts: {error_msg[:200]}. Funds were never deducted."
-                    db.commit()
-                else:
-                    # Обновляем error_message с информацией о попытке
-                    new_error = f"Attempt {attempt_count + 1} failed: {error_msg[:200]}"
-                    if tx.error_message:
-                        tx.error_message = f"{tx.error_message}; {new_error}"
-                    else:
-                        tx.error_message = new_error
-                    db.commit()
+                print(f"⚠️ Failed to send pending transaction {tx.id}: {e}", file=sys.stderr, flush=True)
+                self._record_withdrawal_failure(tx, e)
+                await db.commit()
                 # Продолжаем обработку других транзакций
+                continue
+            
+            # ТОЛЬКО после успешной отправки списываем средства (см. _record_sent_withdrawals)
+            self._mark_withdrawals_sent(db, [tx], tx_hash)
+            await db.commit()
+            await self._record_sent_withdrawals(db, [tx.id])
+            print(f"✅ Pending transaction {tx.id} sent successfully! Hash: {tx_hash[:20]}...", file=sys.stderr, flush=True)
+    
+    async def _process_withdrawal_batches(self, db: AsyncSession, pending_txs: List[models.TonTransaction]):
+        """
+        Отправляет выводы пакетами: один seqno и одно подтверждение на пакет вместо
+        одного на вывод. Каждой строке записываются общий tx_hash пакета, batch_id и
+        message_index - номер ее перевода во внешнем сообщении. Списание средств
+        всего пакета - одной транзакцией БД после успешной отправки.
+        """
+        ready = []
+        for tx in pending_txs:
+            time_since_creation = self._withdrawal_age(tx)
+            if time_since_creation > WITHDRAWAL_MAX_WAIT:
+                print(f"⚠️ Transaction {tx.id} is too old ({time_since_creation}), marking as failed (funds were never deducted).", file=sys.stderr, flush=True)
+                tx.status = "failed"
+                tx.error_message = f"Transaction failed: could not send after {time_since_creation}. Funds were never deducted."
+            else:
+                ready.append(tx)
+        await db.commit()
+        if not ready:
+            return
+        
+        # Комментарий перевода - Telegram ID пользователя (как при одиночной отправке)
+        user_ids = {tx.user_id for tx in ready if tx.user_id}
+        telegram_ids = dict((await db.execute(
+            select(models.User.id, models.User.telegram_id).where(models.User.id.in_(user_ids))
+        )).all()) if user_ids else {}
+        
+        for batch in self._plan_withdrawal_batches(ready):
+            transfers = [
+                (tx.to_address, int(tx.amount_nano), str(telegram_ids[tx.user_id]) if tx.user_id in telegram_ids else None)
+                for tx in batch
+            ]
+            batch_ids = [tx.id for tx in batch]
+            try:
+                print(f"🔄 Sending withdrawal batch {batch_ids} ({sum(amount for _, amount, _ in transfers) / 10**9:.4f} TON)...", file=sys.stderr, flush=True)
+                tx_hash = await self._send_batch(transfers)
+            except Exception as e:
+                print(f"⚠️ Failed to send withdrawal batch {batch_ids}: {e}", file=sys.stderr, flush=True)
+                for tx in batch:
+                    self._record_withdrawal_failure(tx, e)
+                await db.commit()
+                continue
+            
+            # ТОЛЬКО после успешной отправки списываем средства (см. _record_sent_withdrawals)
+            try:
+                self._mark_withdrawals_sent(db, batch, tx_hash, batch_id=uuid.uuid4().hex)
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                print(f"❌ Withdrawal batch {batch_ids} was sent (hash {tx_hash}) but could not be recorded: {e}", file=sys.stderr, flush=True)
+                raise
+            await self._record_sent_withdrawals(db, batch_ids)
+            print(f"✅ Withdrawal batch {batch_ids} sent successfully! Hash: {tx_hash[:20]}...", file=sys.stderr, flush=True)
     
-    async def update_pending_transactions(self, db: Session):
+    @staticmethod
+    def _mark_withdrawals_sent(db: AsyncSession, txs: List[models.TonTransaction], tx_hash: str, batch_id: Optional[str] = None):
         """
-        Обновляет статусы всех pending транзакций через tonapi.
-        Вызывается периодически (например, каждые 30 секунд).
+        Фиксирует отправку (commit делает вызывающий): tx_hash и статус "sent_unrecorded".
+        Такие строки не берет запрос повторной отправки (status "pending", tx_hash NULL),
+        поэтому сбой до списания средств не приводит к повторной отправке.
         """
+        for message_index, tx in enumerate(txs):
+            tx.tx_hash = tx_hash
+            if batch_id:
+                tx.batch_id = batch_id
+                tx.message_index = message_index
+            tx.status = "sent_unrecorded"
+            tx.error_message = None
+            tx.next_attempt_at = None
+    
+    async def _record_sent_withdrawals(self, db: AsyncSession, tx_ids: Optional[List[int]] = None) -> int:
+        """
+        Списывает средства по выводам в статусе "sent_unrecorded" и переводит их в
+        "pending" (ожидание подтверждения). Строки блокируются, поэтому списание не
+        повторяется. Без tx_ids - все такие строки (хвосты прошлых проходов).
+        Returns: сколько выводов записано.
+        """
+        from app.balance_ledger import lock_balances
+        
+        query = select(models.TonTransaction).where(models.TonTransaction.status == "sent_unrecorded")
+        if tx_ids is not None:
+            query = query.where(models.TonTransaction.id.in_(tx_ids))
+        try:
+            txs = (await db.scalars(
+                query.order_by(models.TonTransaction.id).with_for_update().execution_options(populate_existing=True)
+            )).all()
+            if not txs:
+                return 0
+            balances = await lock_balances(db, {tx.user_id for tx in txs if tx.user_id})
+            for tx in txs:
+                if tx.user_id in balances:
+                    apply_balance_delta(db, balances[tx.user_id], -tx.amount_nano, reason="withdrawal", ref_id=tx.id)
+                tx.status = "pending"  # Остается pending до подтверждения
+            await db.commit()
+            return len(txs)
+        except Exception as e:
+            await db.rollback()
+            print(f"❌ Sent withdrawals {tx_ids or 'from previous rounds'} were not recorded yet (will retry next round): {e}", file=sys.stderr, flush=True)
+            raise
+    
+    async def _resolve_transaction_statuses(self, tx_hashes: set) -> Dict[str, str]:
+        """
+        Статусы нескольких отправленных транзакций. Сначала одна страница последних
+        транзакций кошелька закрывает все найденные в ней хеши, оставшиеся
+        проверяются по одному параллельно (не больше TON_CONFIRMATION_CONCURRENCY).
+        """
+        statuses: Dict[str, str] = {}
+        remaining = set(tx_hashes)
+        if len(remaining) > 1 and self.api_key and self.wallet_address:
+            try:
+                page = await self._providers.call(
+                    ["tonapi"], lambda _: self._fetch_tonapi_transactions(self.wallet_address.strip(), 0)
+                )
+                seen = set()
+                for chain_tx in page:
+                    seen.add(chain_tx.get("hash"))
+                    seen.add((chain_tx.get("in_msg") or {}).get("hash"))
+                for tx_hash in remaining & seen:
+                    statuses[tx_hash] = "completed"
+                remaining -= seen
+            except Exception as e:
+                print(f"⚠️ Failed to resolve withdrawals from wallet transactions page: {e}", file=sys.stderr, flush=True)
+        
+        semaphore = asyncio.Semaphore(TON_CONFIRMATION_CONCURRENCY)
+        
+        async def check(tx_hash: str):
+            async with semaphore:
+                statuses[tx_hash] = await self.check_transaction_status(tx_hash)
+        
+        await asyncio.gather(*(check(tx_hash) for tx_hash in remaining))
+        return statuses
+    
+    async def update_pending_transactions(self, db: AsyncSession):
+        """
+        Обновляет статусы pending транзакций через tonapi.
+        Вызывается периодически (например, каждые 30 секунд), но проверяются только
+        строки, у которых наступил next_poll_at: пока транзакция не найдена,
+        пауза до следующей проверки растет экспоненциально.
+        """
+        now = datetime.utcnow()
         pending_txs = (
-            db.query(models.TonTransaction)
-            .filter(models.TonTransaction.status == "pending")
-            .filter(models.TonTransaction.tx_hash.isnot(None))
-            .all()
-        )
+            await db.scalars(
+                select(models.TonTransaction)
+                .where(models.TonTransaction.status == "pending")
+                .where(models.TonTransaction.tx_hash.isnot(None))
+                .where(or_(models.TonTransaction.next_poll_at.is_(None), models.TonTransaction.next_poll_at <= now))
+            )
+        ).all()
+        if not pending_txs:
+            return
         
+        # Выводы одного пакета имеют общий tx_hash - статус запрашивается один раз на пакет
+        statuses = await self._resolve_transaction_statuses({tx.tx_hash for tx in pending_txs})
         for tx in pending_txs:
             try:
-                new_status = await self.check_transaction_status(tx.tx_hash)
-                if new_status == "completed" and tx.status != "completed":
+                new_status = statuses.get(tx.tx_hash, "pending")
+                if new_status == "pending":
+                    tx.poll_attempts = (tx.poll_attempts or 0) + 1
+                    delay = min(CONFIRMATION_POLL_BASE_SECONDS * 2 ** (tx.poll_attempts - 1), CONFIRMATION_POLL_MAX_SECONDS)
+                    tx.next_poll_at = now + timedelta(seconds=delay)
+                elif new_status == "completed" and tx.status != "completed":
                     tx.status = "completed"
-                    db.commit()
+                    await db.commit()
                 elif new_status == "failed" and tx.status != "failed":
                     tx.status = "failed"
+                    # Сообщение не исполнилось (или просрочено) - seqno кошелька мог не сдвинуться
+                    await self._seqno.invalidate()
                     # Возвращаем средства пользователю при ошибке
-                    user = db.query(models.User).filter(models.User.id == tx.user_id).first()
+                    user = await db.scalar(select(models.User).where(models.User.id == tx.user_id))
                     if user:
-                        balance = db.query(models.UserBalance).filter(
+                        balance = await db.scalar(select(models.UserBalance).where(
                             models.UserBalance.user_id == user.id
-                        ).first()
+                        ))
                         if balance:
-                            balance.ton_active_balance += tx.amount_nano
-                    db.commit()
+                            apply_balance_delta(db, balance, tx.amount_nano, reason="withdrawal_failed_refund", ref_id=tx.id)
+                    await db.commit()
             except Exception as e:
                 # Логируем ошибку, но продолжаем обработку других транзакций
                 print(f"Error updating tx {tx.id}: {e}")
+        # Новые сроки проверки еще не подтвержденных транзакций
+        await db.commit()
 
 
 ton_service_singleton: Optional[TonService] = None
@@ -0,0 +1,327 @@
+"""
+Постоянный процесс подписи TON-переводов (ton_sender.js --daemon).
+
+Раньше на каждый вывод запускался новый node: поиск путей, иногда npm install,
+загрузка @ton/ton и вывод ключей из мнемоники - сотни миллисекунд до подписи.
+Теперь процесс запускается один раз, а запросы и ответы идут JSON-строками
+через stdin/stdout:
+
+    -> {"id": "<uuid>", "op": "send", "seqno": 12, "messages": [{"to": "...", "amount": "...", "comment": "..."}]}
+    <- {"id": "<uuid>", "ok": true, "seqno": 12, "txHash": "...", "messages": 1}
+    -> {"id": "<uuid>", "op": "ping"}
+    <- {"id": "<uuid>", "ok": true, "address": "..."}
+
+Ответ сопоставляется с запросом по id, поэтому ping не ждет идущую отправку.
+Watchdog раз в NODE_SIGNER_HEALTH_INTERVAL пингует процесс и перезапускает его,
+если он завершился или не ответил; ожидающие запросы упавшего процесса сразу
+получают ошибку.
+"""
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import urllib.request
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+# Ожидание строки готовности после запуска (загрузка модулей, ключи из мнемоники)
+NODE_SIGNER_START_TIMEOUT = 60
+# Ожидание ответа на отправку (getSeqno + broadcast через toncenter) и на ping
+NODE_SIGNER_SEND_TIMEOUT = 120
+NODE_SIGNER_PING_TIMEOUT = 10
+# Период проверки здоровья и минимальная пауза между перезапусками
+NODE_SIGNER_HEALTH_INTERVAL = int(os.getenv("NODE_SIGNER_HEALTH_INTERVAL", "30"))
+NODE_SIGNER_RESTART_DELAY = 5
+
+
+class NodeSigner:
+    def __init__(self):
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        # id запроса -> (процесс, которому он отправлен, future ответа)
+        self._pending: Dict[str, Tuple[asyncio.subprocess.Process, asyncio.Future]] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._watchdog: Optional[asyncio.Task] = None
+        self._start_lock = asyncio.Lock()
+        self._launch: Optional[Tuple[List[str], dict, str]] = None
+        self._last_start = 0.0
+        self._closed = False
+
+    @property
+    def running(self) -> bool:
+        return self._proc is not None and self._proc.returncode is None
+
+    async def send(self, messages: List[dict], seqno: Optional[int] = None) -> str:
+        """
+        Подписывает и отправляет переводы одним внешним сообщением. Returns: хеш сообщения.
+        Без seqno процесс читает его из сети сам.
+        """
+        payload = {"messages": messages}
+        if seqno is not None:
+            payload["seqno"] = seqno
+        data = await self.request("send", NODE_SIGNER_SEND_TIMEOUT, **payload)
+        tx_hash = data.get("txHash") or data.get("hash") or data.get("tx_hash")
+        if not tx_hash:
+            raise Exception(f"Node sender returned no tx_hash. Raw: {data}")
+        return tx_hash
+
+    async def request(self, op: str, timeout: float, **payload) -> dict:
+        """Отправляет запрос процессу (запускает его при необходимости) и ждет ответ с тем же id."""
+        await self._ensure_started()
+        proc = self._proc
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (proc, future)
+        try:
+            proc.stdin.write((json.dumps({"id": request_id, "op": op, **payload}) + "\n").encode())
+            await proc.stdin.drain()
+            data = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f"Node signer did not answer {op} request {request_id} in {timeout}s")
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise Exception(f"Node signer is not running: {e}")
+        finally:
+            self._pending.pop(request_id, None)
+        if not data.get("ok"):
+            raise Exception(f"Node sender error: {data.get('error') or data}")
+        return data
+
+    async def health_check(self) -> bool:
+        """True, если процесс жив и отвечает на ping."""
+        if not self.running:
+            return False
+        try:
+            await self.request("ping", NODE_SIGNER_PING_TIMEOUT)
+            return True
+        except Exception as e:
+            print(f"⚠️ Node signer health check failed: {e}", file=sys.stderr, flush=True)
+            return False
+
+    async def _ensure_started(self):
+        if self._closed:
+            raise Exception("Node signer is closed")
+        if self.running:
+            return
+        async with self._start_lock:
+            if self.running:
+                return
+            loop = asyncio.get_running_loop()
+            delay = self._last_start + NODE_SIGNER_RESTART_DELAY - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last_start = loop.time()
+            await self._start()
+
+    async def _start(self):
+        if self._launch is None:
+            self._launch = await self._prepare()
+        cmd, env, workdir = self._launch
+        await self._stop_process()
+
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            cwd=workdir,
+        )
+        ready = asyncio.get_running_loop().create_future()
+        self._proc = proc
+        self._tasks = [
+            asyncio.create_task(self._read_stdout(proc, ready)),
+            asyncio.create_task(self._read_stderr(proc)),
+        ]
+        try:
+            address = await asyncio.wait_for(asyncio.shield(ready), NODE_SIGNER_START_TIMEOUT)
+        except Exception as e:
+            await self._stop_process()
+            raise Exception(f"Node signer failed to start: {e}")
+        print(f"✅ Node signer started (pid={proc.pid}, wallet={address})", file=sys.stderr, flush=True)
+
+        if self._watchdog is None or self._watchdog.done():
+            self._watchdog = asyncio.create_task(self._watch())
+
+    async def _read_stdout(self, proc: asyncio.subprocess.Process, ready: asyncio.Future):
+        """Разбирает ответы процесса и будит ожидающие запросы по id."""
+        try:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    print(f"⚠️ Node signer: unexpected output: {line.decode(errors='replace').strip()}", file=sys.stderr, flush=True)
+                    continue
+                if data.get("ready"):
+                    if not ready.done():
+                        ready.set_result(data.get("address"))
+                    continue
+                entry = self._pending.get(data.get("id"))
+                if entry and not entry[1].done():
+                    entry[1].set_result(data)
+        finally:
+            returncode = await proc.wait()
+            error = Exception(f"Node signer exited (code {returncode})")
+            if not ready.done():
+                ready.set_exception(error)
+            for request_id, (owner, future) in list(self._pending.items()):
+                if owner is proc and not future.done():
+                    future.set_exception(error)
+            if not self._closed:
+                print(f"⚠️ Node signer (pid={proc.pid}) exited with code {returncode}", file=sys.stderr, flush=True)
+
+    async def _read_stderr(self, proc: asyncio.subprocess.Process):
+        while True:
+            line = await proc.stderr.readline()
+            if not line:
+                return
+            print(f"[NODE SIGNER] {line.decode(errors='replace').rstrip()}", file=sys.stderr, flush=True)
+
+    async def _watch(self):
+        """Watchdog: перезапускает процесс, если он упал или завис."""
+        while not self._closed:
+            await asyncio.sleep(NODE_SIGNER_HEALTH_INTERVAL)
+            if self._closed or await self.health_check():
+                continue
+            print(f"⚠️ Node signer is not healthy, restarting...", file=sys.stderr, flush=True)
+            try:
+                await self._stop_process()
+                await self._ensure_started()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Node signer restart failed: {e}", file=sys.stderr, flush=True)
+
+    async def _stop_process(self):
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        tasks, self._tasks = self._tasks, []
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def close(self):
+        """Останавливает процесс (при остановке приложения): закрытый stdin - сигнал завершиться."""
+        self._closed = True
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            await asyncio.gather(self._watchdog, return_exceptions=True)
+            self._watchdog = None
+        proc = self._proc
+        if proc is not None and proc.returncode is None:
+            proc.stdin.close()
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+        await self._stop_process()
+
+    async def _prepare(self) -> Tuple[List[str], dict, str]:
+        """
+        Находит ton_sender.js и node (при необходимости скачивает node и делает
+        npm install). Выполняется один раз, результат используется при перезапусках.
+        """
+        base_dir = os.path.dirname(__file__)
+        script_candidates = [
+            os.path.normpath(os.path.join(base_dir, "..", "ton_sender.js")),            # /app/ton_sender.js (backend root)
+            os.path.normpath(os.path.join(base_dir, "ton_sender.js")),                  # /app/app/ton_sender.js (same dir)
+            os.path.normpath(os.path.join(base_dir, "..", "backend", "ton_sender.js")), # /app/backend/ton_sender.js (if repo root used)
+        ]
+        script_path = next((p for p in script_candidates if os.path.exists(p)), None)
+        if not script_path:
+            raise Exception(f"Node sender script not found. Tried: {script_candidates}")
+        workdir = os.path.dirname(script_path)
+        
+        node_bin = shutil.which("node") or shutil.which("nodejs")
+        if not node_bin:
+            # Автозагрузка node в /tmp, если недоступен в PATH (Railway buildpacks могли не подтянуть)
+            node_bin = await _ensure_node_binary()
+            if not node_bin:
+                raise Exception("Node binary not found in PATH and download failed")
+        npm_candidate = os.path.join(os.path.dirname(node_bin), "npm")
+        npm_bin = npm_candidate if os.path.exists(npm_candidate) else shutil.which("npm")
+        print(f"🔍 node_bin={node_bin}, npm_bin={npm_bin}", file=sys.stderr, flush=True)
+        
+        cmd = [node_bin, script_path, "--daemon"]
+        
+        env = os.environ.copy()
+        # Важно: добавить путь к скачанному node/npm в PATH, иначе shebang "/usr/bin/env node" внутри npm ломается
+        node_dir = os.path.dirname(node_bin)
+        env["PATH"] = f"{node_dir}:{env.get('PATH', '')}"
+        # Обеспечиваем поиск модулей рядом со скриптом и в backend/node_modules
+        node_modules_candidates = [
+            os.path.join(workdir, "node_modules"),
+            os.path.join(workdir, "backend", "node_modules"),
+            os.path.join(os.path.dirname(workdir), "backend", "node_modules"),
+            os.path.join(os.path.dirname(workdir), "node_modules"),
+        ]
+        found_modules = [p for p in node_modules_candidates if os.path.isdir(p)]
+        if found_modules:
+            existing_np = env.get("NODE_PATH", "")
+            env["NODE_PATH"] = ":".join(found_modules + ([existing_np] if existing_np else []))
+        else:
+            print(f"⚠️ node_modules not found; will try npm install if npm is available", file=sys.stderr, flush=True)
+            # Попытка npm install, если есть package.json
+            pkg_dirs = [
+                workdir,
+                os.path.join(workdir, "backend"),
+                os.path.join(os.path.dirname(workdir), "backend"),
+            ]
+            pkg_dir = next((d for d in pkg_dirs if os.path.exists(os.path.join(d, "package.json"))), None)
+            if pkg_dir and npm_bin:
+                try:
+                    env["npm_config_registry"] = env.get("npm_config_registry") or "https://registry.npmjs.org/"
+                    print(f"🔧 Running npm install in {pkg_dir} ...", file=sys.stderr, flush=True)
+                    proc_npm = await asyncio.create_subprocess_exec(
+                        npm_bin, "install",
+                        cwd=pkg_dir,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                        env=env,
+                    )
+                    out_npm, err_npm = await proc_npm.communicate()
+                    if proc_npm.returncode != 0:
+                        print(f"⚠️ npm install failed ({proc_npm.returncode}): {err_npm.decode()}", file=sys.stderr, flush=True)
+                    else:
+                        print(f"✅ npm install completed", file=sys.stderr, flush=True)
+                    # После попытки npm install — обновляем поиск node_modules даже если ошибка
+                    node_modules_candidates.insert(0, os.path.join(pkg_dir, "node_modules"))
+                    found_modules = [p for p in node_modules_candidates if os.path.isdir(p)]
+                    if found_modules:
+                        existing_np = env.get("NODE_PATH", "")
+                        env["NODE_PATH"] = ":".join(found_modules + ([existing_np] if existing_np else []))
+                except Exception as npm_err:
+                    print(f"⚠️ npm install error: {npm_err}", file=sys.stderr, flush=True)
+        return cmd, env, workdir
+
+
+async def _ensure_node_binary() -> Optional[str]:
+    """
+    Гарантирует наличие бинаря node, скачивая его в /tmp, если не найден.
+    Возвращает путь к бинарю или None при ошибке.
+    """
+    cached_path = "/tmp/node-v18.19.0-linux-x64/bin/node"
+    if os.path.exists(cached_path):
+        return cached_path
+
+    url = "https://nodejs.org/dist/v18.19.0/node-v18.19.0-linux-x64.tar.xz"
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive_path = os.path.join(tmpdir, "node.tar.xz")
+            print(f"⬇️ Downloading Node.js from {url} ...", file=sys.stderr, flush=True)
+            urllib.request.urlretrieve(url, archive_path)
+
+            print(f"📦 Extracting Node.js to /tmp ...", file=sys.stderr, flush=True)
+            with tarfile.open(archive_path) as tar:
+                tar.extractall("/tmp")
+
+        if os.path.exists(cached_path):
+            os.chmod(cached_path, 0o755)
+            return cached_path
+    except Exception as e:
+        print(f"⚠️ Failed to download/extract node: {e}", file=sys.stderr, flush=True)
+        return None
@@ -0,0 +1,193 @@
+"""
+Очередь валидации заявок (комментарии и подписки в статусе IN_PROGRESS).
+
+Раньше каждый процесс API раз в 5 минут сам перебирал все заявки IN_PROGRESS,
+и при нескольких воркерах uvicorn одна заявка могла валидироваться (и оплачиваться)
+несколько раз. Теперь на каждую заявку есть строка validation_jobs, и воркер
+забирает готовые строки так:
+
+    SELECT ... FROM validation_jobs
+    WHERE run_at <= now() AND (locked_until IS NULL OR locked_until < now())
+    ORDER BY run_at LIMIT :batch
+    FOR UPDATE SKIP LOCKED
+
+и записывает себе аренду (locked_by, locked_until). Другие воркеры пропускают
+заблокированные и арендованные строки, поэтому воркеры можно запускать в любом
+числе процессов и на разных хостах. Пока проверка идет, heartbeat продлевает
+аренду; если воркер упал, аренда истекает и задание забирает другой.
+
+После проверки: заявка перестала быть IN_PROGRESS - строка удаляется, иначе
+переносится на VALIDATION_INTERVAL_SECONDS (при ошибке - с растущей паузой).
+"""
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+from app.database import AsyncSessionLocal
+
+# Как часто повторять проверку заявки, пока комментарий/подписка не найдены
+VALIDATION_INTERVAL_SECONDS = int(os.getenv("VALIDATION_INTERVAL_SECONDS", "300"))
+# Аренда задания и период heartbeat
+VALIDATION_LEASE_SECONDS = int(os.getenv("VALIDATION_LEASE_SECONDS", "120"))
+VALIDATION_HEARTBEAT_SECONDS = max(VALIDATION_LEASE_SECONDS // 3, 1)
+# Сколько заданий воркер забирает за раз и как часто опрашивает очередь
+VALIDATION_BATCH_SIZE = int(os.getenv("VALIDATION_BATCH_SIZE", "50"))
+VALIDATION_POLL_SECONDS = int(os.getenv("VALIDATION_POLL_SECONDS", "5"))
+# Как часто освобождать брошенные заявки (не подтверждены за RESERVATION_TTL_HOURS)
+RESERVATION_EXPIRY_SECONDS = 300
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def enqueue_validation(db: AsyncSession, user_task_id: int, delay_seconds: int = VALIDATION_INTERVAL_SECONDS):
+    """Ставит заявку в очередь валидации (commit не делает - вместе с созданием заявки)."""
+    db.add(models.ValidationJob(
+        user_task_id=user_task_id,
+        run_at=datetime.utcnow() + timedelta(seconds=delay_seconds),
+        attempts=0
+    ))
+
+
+async def claim_jobs(db: AsyncSession, worker_id: str = WORKER_ID, limit: int = VALIDATION_BATCH_SIZE) -> List[int]:
+    """Забирает готовые задания под аренду worker_id. Returns: id заданий."""
+    now = datetime.utcnow()
+    job_ids = (await db.scalars(
+        select(models.ValidationJob.id)
+        .where(
+            models.ValidationJob.run_at <= now,
+            or_(models.ValidationJob.locked_until.is_(None), models.ValidationJob.locked_until < now)
+        )
+        .order_by(models.ValidationJob.run_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )).all()
+    if job_ids:
+        await db.execute(
+            update(models.ValidationJob)
+            .where(models.ValidationJob.id.in_(job_ids))
+            .values(locked_by=worker_id, locked_until=now + timedelta(seconds=VALIDATION_LEASE_SECONDS))
+            .execution_options(synchronize_session=False)
+        )
+    await db.commit()
+    return list(job_ids)
+
+
+async def extend_leases(db: AsyncSession, job_ids: List[int], worker_id: str = WORKER_ID):
+    """Heartbeat: продлевает аренду заданий, которые воркер еще держит."""
+    await db.execute(
+        update(models.ValidationJob)
+        .where(models.ValidationJob.id.in_(job_ids), models.ValidationJob.locked_by == worker_id)
+        .values(locked_until=datetime.utcnow() + timedelta(seconds=VALIDATION_LEASE_SECONDS))
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+
+async def _heartbeat(job_ids: List[int], worker_id: str):
+    while True:
+        await asyncio.sleep(VALIDATION_HEARTBEAT_SECONDS)
+        try:
+            async with AsyncSessionLocal() as db:
+                await extend_leases(db, job_ids, worker_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[VALIDATION JOBS] Heartbeat error: {e}")
+
+
+async def run_job(db: AsyncSession, job_id: int, worker_id: str = WORKER_ID):
+    """Проверяет заявку задания и удаляет/переносит задание. Аренда снимается в любом случае."""
+    from app.comment_validator import validate_comment_task, validate_subscription_task
+
+    job = await db.get(models.ValidationJob, job_id)
+    if job is None or job.locked_by != worker_id:
+        # Аренда истекла и задание забрал другой воркер
+        return
+    user_task_id = job.user_task_id
+
+    error: Optional[str] = None
+    try:
+        task_type = await db.scalar(
+            select(models.Task.task_type)
+            .join(models.UserTask, models.UserTask.task_id == models.Task.id)
+            .where(models.UserTask.id == user_task_id)
+        )
+        if task_type == models.TaskType.COMMENT:
+            await validate_comment_task(user_task_id, db)
+        elif task_type == models.TaskType.SUBSCRIPTION:
+            await validate_subscription_task(user_task_id, db)
+    except Exception as e:
+        await db.rollback()
+        error = str(e)
+        print(f"[VALIDATION JOBS] Error validating user_task {user_task_id}: {e}")
+
+    status = await db.scalar(select(models.UserTask.status).where(models.UserTask.id == user_task_id))
+    if status != models.UserTaskStatus.IN_PROGRESS:
+        await db.execute(delete(models.ValidationJob).where(models.ValidationJob.id == job_id))
+    else:
+        attempts = (job.attempts or 0) + 1
+        # При ошибке - пауза растет (до 8 интервалов), иначе обычный интервал
+        delay = VALIDATION_INTERVAL_SECONDS * (min(2 ** (attempts - 1), 8) if error else 1)
+        await db.execute(
+            update(models.ValidationJob)
+            .where(models.ValidationJob.id == job_id, models.ValidationJob.locked_by == worker_id)
+            .values(
+                run_at=datetime.utcnow() + timedelta(seconds=delay),
+                attempts=attempts,
+                locked_by=None,
+                locked_until=None,
+                last_error=error
+            )
+            .execution_options(synchronize_session=False)
+        )
+    await db.commit()
+
+
+async def run_once(worker_id: str = WORKER_ID) -> int:
+    """Забирает и обрабатывает одну пачку заданий. Returns: количество заданий."""
+    async with AsyncSessionLocal() as db:
+        job_ids = await claim_jobs(db, worker_id)
+    if not job_ids:
+        return 0
+
+    heartbeat = asyncio.create_task(_heartbeat(job_ids, worker_id))
+    try:
+        for job_id in job_ids:
+            async with AsyncSessionLocal() as db:
+                await run_job(db, job_id, worker_id)
+    finally:
+        heartbeat.cancel()
+    return len(job_ids)
+
+
+async def run_validation_worker():
+    """
+    Фоновый воркер валидации (можно запускать в каждом процессе - задания не дублируются).
+    Заодно раз в RESERVATION_EXPIRY_SECONDS освобождает брошенные заявки.
+    """
+    from app.slot_reservations import expire_abandoned_reservations
+
+    print(f"[VALIDATION JOBS] Worker {WORKER_ID} started")
+    last_expiry = 0.0
+    while True:
+        try:
+            loop_time = asyncio.get_running_loop().time()
+            if loop_time - last_expiry > RESERVATION_EXPIRY_SECONDS:
+                async with AsyncSessionLocal() as db:
+                    await expire_abandoned_reservations(db)
+                last_expiry = loop_time
+
+            if not await run_once():
+                await asyncio.sleep(VALIDATION_POLL_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[VALIDATION JOBS] Error in worker loop: {e}")
+            await asyncio.sleep(60)
@@ -0,0 +1,107 @@
+"""
+Локальный счетчик seqno сервисного кошелька.
+
+Раньше перед каждой отправкой seqno читался из сети: tonapi.io перебирал
+форматы адреса и endpoint'ы, и только потом можно было подписывать. Теперь
+seqno для следующей отправки хранится в wallet_seqnos и выдается одним
+условным UPDATE:
+
+    async with seqno_manager.reserve() as seqno:
+        ...подпись и отправка...     # исключение - следующая отправка сверится с сетью
+
+    UPDATE wallet_seqnos SET seqno = seqno + 1
+    WHERE wallet_address = :wallet AND NOT resync_required
+    RETURNING seqno
+
+Выдача - короткая транзакция, закоммиченная до отправки: ни блокировка строки,
+ни соединение пула не держатся на время сетевого запроса, а два процесса API
+не получают один seqno. После успешной отправки следующий seqno выдается сразу,
+без ожидания подтверждения в сети.
+
+Из сети seqno перечитывается, только когда строки еще нет, после ошибки
+отправки и после invalidate() - опрос подтверждений сообщил, что отправленное
+сообщение не исполнилось или просрочено. Флаг resync_required хранится в
+строке, поэтому seqno перечитывает тот процесс, который отправляет следующим.
+"""
+import sys
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from app import models
+from app.database import AsyncSessionLocal
+
+
+class SeqnoManager:
+    def __init__(self, wallet_address: str, fetch_chain_seqno: Callable[[], Awaitable[int]]):
+        self.wallet_address = wallet_address
+        self._fetch_chain_seqno = fetch_chain_seqno
+
+    @asynccontextmanager
+    async def reserve(self) -> AsyncIterator[int]:
+        """Seqno для отправки (вызывать под локом отправки). Исключение в блоке - seqno перечитается из сети."""
+        seqno = await self._allocate()
+        try:
+            yield seqno
+        except Exception:
+            # Сообщение могло как уйти в сеть, так и нет
+            try:
+                await self.invalidate()
+            except Exception as e:
+                print(f"⚠️ Failed to mark wallet seqno for resync: {e}", file=sys.stderr, flush=True)
+            raise
+
+    async def invalidate(self):
+        """Отправка не удалась, сообщение не исполнилось или просрочено - следующая отправка перечитает seqno из сети."""
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(models.WalletSeqno)
+                .where(models.WalletSeqno.wallet_address == self.wallet_address)
+                .values(resync_required=True)
+            )
+            await db.commit()
+
+    async def _allocate(self) -> int:
+        async with AsyncSessionLocal() as db:
+            next_seqno = await db.scalar(
+                update(models.WalletSeqno)
+                .where(
+                    models.WalletSeqno.wallet_address == self.wallet_address,
+                    models.WalletSeqno.resync_required.is_(False),
+                )
+                .values(seqno=models.WalletSeqno.seqno + 1)
+                .returning(models.WalletSeqno.seqno)
+            )
+            await db.commit()
+        if next_seqno is not None:
+            return next_seqno - 1
+        return await self._resync()
+
+    async def _resync(self) -> int:
+        """Seqno из сети; в строку записывается seqno + 1 для следующей отправки."""
+        chain_seqno = await self._fetch_chain_seqno()
+        async with AsyncSessionLocal() as db:
+            row = await db.get(models.WalletSeqno, self.wallet_address, with_for_update=True)
+            if row is None:
+                previous = None
+                db.add(models.WalletSeqno(wallet_address=self.wallet_address, seqno=chain_seqno + 1, synced_at=datetime.utcnow()))
+            elif row.resync_required:
+                previous = row.seqno
+                row.seqno = chain_seqno + 1
+                row.resync_required = False
+                row.synced_at = datetime.utcnow()
+            else:
+                # Другой процесс перечитал seqno, пока мы ходили в сеть
+                await db.rollback()
+                return await self._allocate()
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Строку одновременно создал другой процесс
+                await db.rollback()
+                return await self._allocate()
+        print(f"🔄 Wallet seqno resynced from chain: {chain_seqno} (was {previous})", file=sys.stderr, flush=True)
+        return chain_seqno
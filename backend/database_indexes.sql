@@ -1,6 +1,50 @@
 -- Критичные индексы для производительности
 -- Выполнить после создания всех таблиц
 
+-- Новые колонки существующих таблиц (create_all их не добавляет)
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS reserved_slots INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE user_tasks ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE ton_transactions ADD COLUMN IF NOT EXISTS batch_id VARCHAR(32);
+ALTER TABLE ton_transactions ADD COLUMN IF NOT EXISTS message_index INTEGER;
+ALTER TABLE ton_transactions ADD COLUMN IF NOT EXISTS next_poll_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE ton_transactions ADD COLUMN IF NOT EXISTS poll_attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE ton_transactions ADD COLUMN IF NOT EXISTS send_attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE ton_transactions ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE ton_transactions ADD COLUMN IF NOT EXISTS last_error_class VARCHAR(100);
+ALTER TABLE wallet_seqnos ADD COLUMN IF NOT EXISTS resync_required BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE telegram_update_offsets ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(32);
+ALTER TABLE telegram_update_offsets ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITH TIME ZONE;
+ALTER TABLE ton_transactions ADD COLUMN IF NOT EXISTS to_address_canonical VARCHAR(80);
+ALTER TABLE deposits ADD COLUMN IF NOT EXISTS from_address_canonical VARCHAR(80);
+
+-- Канонические адреса старых строк, записанных в raw-форме (user-friendly адреса
+-- разбираются только в приложении - app/ton_address.py - и остаются NULL)
+UPDATE ton_transactions SET to_address_canonical = lower(to_address)
+WHERE to_address_canonical IS NULL AND to_address ~ '^-?[0-9]+:[0-9a-fA-F]{64}$';
+UPDATE deposits SET from_address_canonical = lower(from_address)
+WHERE from_address_canonical IS NULL AND from_address ~ '^-?[0-9]+:[0-9a-fA-F]{64}$';
+
+-- Перепроверки заданий, подтвержденных до появления next_check_at (в пределах окна)
+UPDATE user_tasks ut SET next_check_at = now()
+FROM tasks t
+WHERE t.id = ut.task_id
+  AND ut.status = 'completed'
+  AND ut.next_check_at IS NULL
+  AND (
+    (t.task_type = 'comment' AND ut.validated_at > now() - interval '1 hour')
+    OR (t.task_type = 'subscription' AND ut.validated_at > now() - interval '7 days')
+  );
+
+-- Задания на валидацию для заявок IN_PROGRESS, созданных до появления validation_jobs
+-- (выполнить после create_all, создающего таблицу)
+INSERT INTO validation_jobs (user_task_id, run_at, attempts)
+SELECT ut.id, now(), 0
+FROM user_tasks ut
+JOIN tasks t ON t.id = ut.task_id
+WHERE ut.status = 'in_progress'
+  AND t.task_type IN ('comment', 'subscription')
+ON CONFLICT (user_task_id) DO NOTHING;
+
 -- Пользователи
 CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
 CREATE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code) WHERE referral_code IS NOT NULL;
@@ -22,10 +66,16 @@ CREATE INDEX IF NOT EXISTS idx_tasks_status_type ON tasks(status, task_type) WHE
 -- Транзакции TON
 CREATE INDEX IF NOT EXISTS idx_ton_transactions_user_id ON ton_transactions(user_id);
 CREATE INDEX IF NOT EXISTS idx_ton_transactions_status ON ton_transactions(status) WHERE status = 'pending';
-CREATE UNIQUE INDEX IF NOT EXISTS idx_ton_transactions_tx_hash ON ton_transactions(tx_hash) WHERE tx_hash IS NOT NULL;
+-- tx_hash не уникален: выводы одного пакета отправляются одним внешним сообщением
+DROP INDEX IF EXISTS idx_ton_transactions_tx_hash;
+CREATE INDEX IF NOT EXISTS idx_ton_transactions_tx_hash_nonunique ON ton_transactions(tx_hash) WHERE tx_hash IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_ton_transactions_batch_id ON ton_transactions(batch_id) WHERE batch_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_ton_transactions_next_poll_at ON ton_transactions(next_poll_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS ix_ton_transactions_next_attempt_at ON ton_transactions(next_attempt_at) WHERE status = 'pending' AND tx_hash IS NULL;
 CREATE UNIQUE INDEX IF NOT EXISTS idx_ton_transactions_idempotency_key ON ton_transactions(idempotency_key);
 CREATE INDEX IF NOT EXISTS idx_ton_transactions_created_at ON ton_transactions(created_at);
 CREATE INDEX IF NOT EXISTS idx_ton_transactions_user_status ON ton_transactions(user_id, status);
+CREATE INDEX IF NOT EXISTS ix_ton_transactions_to_address_canonical ON ton_transactions(to_address_canonical);
 
 -- Депозиты
 CREATE UNIQUE INDEX IF NOT EXISTS idx_deposits_tx_hash ON deposits(tx_hash);
@@ -33,15 +83,37 @@ CREATE INDEX IF NOT EXISTS idx_deposits_user_id ON deposits(user_id) WHERE user_
 CREATE INDEX IF NOT EXISTS idx_deposits_status ON deposits(status) WHERE status = 'pending';
 CREATE INDEX IF NOT EXISTS idx_deposits_created_at ON deposits(created_at);
 CREATE INDEX IF NOT EXISTS idx_deposits_processed_at ON deposits(processed_at) WHERE processed_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_deposits_from_address_canonical ON deposits(from_address_canonical);
+
+-- Журнал балансов (инкрементальная сверка читает записи после watermark)
+CREATE INDEX IF NOT EXISTS ix_balance_journal_user_id_id ON balance_journal(user_id, id);
 
 -- Выполнения заданий
 CREATE INDEX IF NOT EXISTS idx_user_tasks_user_id ON user_tasks(user_id);
 CREATE INDEX IF NOT EXISTS idx_user_tasks_task_id ON user_tasks(task_id);
 CREATE INDEX IF NOT EXISTS idx_user_tasks_status ON user_tasks(status);
 CREATE INDEX IF NOT EXISTS idx_user_tasks_escrow_ends_at ON user_tasks(escrow_ends_at) WHERE status = 'in_progress';
+CREATE INDEX IF NOT EXISTS idx_user_tasks_escrow_started_at ON user_tasks(escrow_started_at) WHERE status = 'in_progress';
 CREATE INDEX IF NOT EXISTS idx_user_tasks_user_status ON user_tasks(user_id, status);
+-- Лента: исключение заданий, которые пользователь уже брал
+CREATE INDEX IF NOT EXISTS ix_user_tasks_user_id_task_id ON user_tasks(user_id, task_id);
+-- Очередь валидации заявок (воркеры забирают готовые задания через FOR UPDATE SKIP LOCKED)
+CREATE INDEX IF NOT EXISTS ix_validation_jobs_run_at ON validation_jobs(run_at);
+-- Планировщик перепроверок (строки вне окна перепроверки имеют NULL и в индекс не попадают)
+CREATE INDEX IF NOT EXISTS ix_user_tasks_next_check_at ON user_tasks(next_check_at) WHERE next_check_at IS NOT NULL;
 CREATE INDEX IF NOT EXISTS idx_user_tasks_created_at ON user_tasks(created_at);
 
+-- Комментарии из групп обсуждений (проверка комментария - один поиск по индексу)
+CREATE INDEX IF NOT EXISTS ix_discussion_messages_chat_reply_user ON discussion_messages(chat_id, reply_to_message_id, from_user_id);
+CREATE INDEX IF NOT EXISTS ix_discussion_messages_username_reply_user ON discussion_messages(chat_username, reply_to_message_id, from_user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_discussion_messages_source ON discussion_messages(source_chat_id, message_id);
+CREATE INDEX IF NOT EXISTS ix_discussion_messages_created_at ON discussion_messages(created_at);
+
+-- Выходы из каналов (chat_member): возврат эскроу по событию вместо ежедневного get_chat_member
+CREATE INDEX IF NOT EXISTS ix_channel_member_events_chat_user ON channel_member_events(chat_id, user_telegram_id);
+CREATE INDEX IF NOT EXISTS ix_channel_member_events_processed_at ON channel_member_events(processed_at) WHERE processed_at IS NULL;
+CREATE INDEX IF NOT EXISTS ix_channel_member_events_created_at ON channel_member_events(created_at);
+
 -- Рефералы
 CREATE INDEX IF NOT EXISTS idx_referrals_referrer_id ON referrals(referrer_id);
 CREATE INDEX IF NOT EXISTS idx_referrals_referred_id ON referrals(referred_id);
@@ -16,6 +16,7 @@ import os
 from decimal import Decimal
 from app.database import SessionLocal, engine
 from app import models
+from app.balance_ledger import apply_balance_delta
 from sqlalchemy import func, create_engine
 from sqlalchemy.orm import sessionmaker
 
@@ -117,7 +118,7 @@ def fix_user_balance(telegram_id: int, database_url: str = None):
         
         # 7. Обновляем баланс
         print(f"\n🔄 Обновляю баланс...")
-        balance.ton_active_balance = correct_balance_nano
+        apply_balance_delta(db, balance, correct_balance_nano - current_balance_nano, reason="recalculate")
         db.commit()
         db.refresh(balance)
         
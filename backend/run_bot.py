@@ -14,6 +14,7 @@ load_dotenv()
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from app.telegram_bot import setup_bot, TELEGRAM_BOT_TOKEN
+from app.telegram_webhook import webhook_enabled
 
 if __name__ == "__main__":
     if not TELEGRAM_BOT_TOKEN:
@@ -21,6 +22,11 @@ if __name__ == "__main__":
         print("Установите переменную окружения TELEGRAM_BOT_TOKEN")
         sys.exit(1)
     
+    if webhook_enabled():
+        # Polling снял бы webhook и конфликтовал с API
+        print("ℹ️ Включен режим webhook (TELEGRAM_WEBHOOK_URL): бот обслуживается API, polling не нужен")
+        sys.exit(0)
+    
     print("🤖 Запуск Telegram бота...")
     print(f"✅ Токен найден: {TELEGRAM_BOT_TOKEN[:10]}...")
     
@@ -0,0 +1,54 @@
+"""
+Общие фикстуры тестов.
+
+Тесты идут на временной SQLite базе (DATABASE_URL подменяется до импорта app),
+без Redis и без сети. Нужен только pytest; запуск из backend/:
+
+    python -m pytest -q
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+_DB_DIR = tempfile.mkdtemp(prefix="blackmirrowmarket-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_DB_DIR}/test.db"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+# Кэш баланса - только локальный
+os.environ["REDIS_URL"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from app.database import AsyncSessionLocal, Base, async_engine, engine
+
+
+@pytest.fixture(autouse=True)
+def database():
+    """Чистая схема на каждый тест."""
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def run():
+    """
+    Выполняет корутину в новом event loop. Соединения пула aiosqlite привязаны
+    к loop, поэтому в конце пул закрывается.
+    """
+    def runner(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await async_engine.dispose()
+        return asyncio.run(main())
+    return runner
+
+
+@pytest.fixture
+def session():
+    """Фабрика асинхронных сессий (как в приложении)."""
+    return AsyncSessionLocal
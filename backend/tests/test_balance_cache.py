@@ -0,0 +1,60 @@
+import time
+from decimal import Decimal
+
+from app import models
+from app.database_optimizations import balance_cache
+
+
+class FakeRedis:
+    """Async Redis: только pipeline() с incr/expire/delete."""
+
+    def __init__(self):
+        self.versions = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.ops = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def incr(self, key):
+        self.ops.append(key)
+
+    def expire(self, key, seconds):
+        pass
+
+    def delete(self, key):
+        pass
+
+    async def execute(self):
+        for key in self.ops:
+            self.redis.versions[key] = self.redis.versions.get(key, 0) + 1
+
+
+def test_commit_awaits_version_bump_while_breaker_is_open(run, session, monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(balance_cache, "client", redis)
+    # После недавней ошибки Redis чтения идут мимо него, но инвалидация - нет
+    monkeypatch.setattr(balance_cache, "_redis_down_until", time.monotonic() + 60)
+
+    async def scenario():
+        async with session() as db:
+            user = models.User(telegram_id=3000, username="cached")
+            db.add(user)
+            await db.flush()
+            db.add(models.UserBalance(user_id=user.id, ton_active_balance=Decimal(0), ton_escrow_balance=Decimal(0)))
+            await db.commit()
+            # Версия уже увеличена к возврату из commit
+            return user.id, dict(redis.versions)
+
+    user_id, versions = run(scenario())
+    assert versions == {f"balance:ver:{user_id}": 1}
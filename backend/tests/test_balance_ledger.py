@@ -0,0 +1,123 @@
+from decimal import Decimal
+
+from sqlalchemy import event, func, select, update
+
+from app import models
+from app.balance_ledger import BalanceChangeSet, apply_balance_delta, lock_balances, reconcile_balance
+from app.database import async_engine
+
+
+async def create_users(session, count: int, active: int = 0) -> list:
+    async with session() as db:
+        user_ids = []
+        for i in range(count):
+            user = models.User(telegram_id=2000 + i, username=f"user{i}")
+            db.add(user)
+            await db.flush()
+            db.add(models.UserBalance(user_id=user.id, ton_active_balance=Decimal(active), ton_escrow_balance=Decimal(0)))
+            user_ids.append(user.id)
+        await db.commit()
+        return user_ids
+
+
+class BalanceLockQueries:
+    """Параметры запросов SELECT ... FROM user_balances, выполненных в блоке with."""
+
+    def __init__(self):
+        self.params = []
+
+    def _capture(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "FROM user_balances" in statement:
+            assert "ORDER BY user_balances.user_id" in statement
+            self.params.append(list(parameters))
+
+    def __enter__(self):
+        event.listen(async_engine.sync_engine, "before_cursor_execute", self._capture)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(async_engine.sync_engine, "before_cursor_execute", self._capture)
+
+
+def test_change_set_locks_balances_in_user_id_order(run, session):
+    async def scenario():
+        first, second, third = await create_users(session, 3, active=10**9)
+        changes = BalanceChangeSet()
+        changes.add(third, -100, reason="transfer", ref_id="t1")
+        changes.add(first, 60, reason="transfer", ref_id="t1")
+        changes.add(second, 40, "escrow", reason="transfer", ref_id="t1")
+        assert changes.user_ids == [first, second, third]
+        with BalanceLockQueries() as queries:
+            async with session() as db:
+                balances = await changes.apply(db)
+                await db.commit()
+        async with session() as db:
+            stored = {b.user_id: b for b in (await db.scalars(select(models.UserBalance))).all()}
+            journal = await db.scalar(select(func.count(models.BalanceJournal.id)))
+        return (first, second, third), balances, queries.params, stored, journal
+
+    (first, second, third), balances, params, stored, journal = run(scenario())
+    assert params == [[first, second, third]]
+    assert sorted(balances) == [first, second, third]
+    assert stored[first].ton_active_balance == 10**9 + 60
+    assert stored[second].ton_escrow_balance == 40
+    assert stored[third].ton_active_balance == 10**9 - 100
+    assert journal == 3
+
+
+def test_change_set_skips_users_without_balance(run, session):
+    async def scenario():
+        (user_id,) = await create_users(session, 1)
+        changes = BalanceChangeSet().add(user_id, 5, reason="bonus").add(user_id + 100, 5, reason="bonus")
+        async with session() as db:
+            balances = await changes.apply(db)
+            await db.commit()
+        return user_id, balances
+
+    user_id, balances = run(scenario())
+    assert list(balances) == [user_id]
+
+
+def test_lock_balances_empty(run, session):
+    async def scenario():
+        async with session() as db:
+            return await lock_balances(db, [])
+
+    assert run(scenario()) == {}
+
+
+def test_reconcile_balance_follows_journal(run, session):
+    async def scenario():
+        (user_id,) = await create_users(session, 1, active=500)
+        results = []
+        async with session() as db:
+            balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user_id))
+            # Первая сверка: баланс до появления журнала записывается как "opening"
+            results.append(await reconcile_balance(db, balance))
+            await db.commit()
+            # Ничего не менялось - сверять нечего
+            results.append(await reconcile_balance(db, balance))
+            # Изменение через журнал сходится
+            apply_balance_delta(db, balance, 250, reason="deposit", ref_id="h1")
+            await db.commit()
+            results.append(await reconcile_balance(db, balance))
+            await db.commit()
+        # Изменение в обход журнала исправляется в пользу журнала
+        async with session() as db:
+            await db.execute(update(models.UserBalance).where(models.UserBalance.user_id == user_id).values(ton_active_balance=10**6))
+            await db.commit()
+        async with session() as db:
+            balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == user_id))
+            results.append(await reconcile_balance(db, balance))
+            await db.commit()
+            snapshot = await db.get(models.BalanceSnapshot, user_id)
+            last_journal_id = await db.scalar(select(func.max(models.BalanceJournal.id)))
+            reasons = (await db.scalars(select(models.BalanceJournal.reason).order_by(models.BalanceJournal.id))).all()
+        return results, balance, snapshot, last_journal_id, reasons
+
+    results, balance, snapshot, last_journal_id, reasons = run(scenario())
+    assert results == [False, False, False, True]
+    assert balance.ton_active_balance == 750
+    assert snapshot.ton_active_balance == 750
+    assert snapshot.last_journal_id == last_journal_id
+    assert reasons == ["opening", "deposit"]
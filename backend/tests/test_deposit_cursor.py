@@ -0,0 +1,159 @@
+import base64
+from contextlib import asynccontextmanager
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import func, select
+
+from app import models, ton_service
+from app.ton_address import parse_address
+from app.ton_service import TonService
+
+WALLET = "EQDvLRJ943uUK6rQYUXlSwxhmh8iMnsuu8--x49VZK_jnSsa"
+SENDER = "EQDZKYoQ0bBzWDfcS9hdrGQbDzzvJ6R-XVOlTy8_Wy_P-l3-"
+TELEGRAM_ID = 123456789
+TON = 10**9
+
+
+@pytest.fixture(autouse=True)
+def scan_limits(monkeypatch):
+    monkeypatch.setattr(ton_service, "DEPOSIT_SCAN_PAGE_SIZE", 3)
+    monkeypatch.setattr(ton_service, "DEPOSIT_SCAN_MAX_PAGES", 2)
+    monkeypatch.setenv("TONAPI_KEY", "test")
+    monkeypatch.setenv("TON_WALLET_ADDRESS", WALLET)
+
+
+class Response:
+    def __init__(self, data):
+        self.status = 200
+        self.data = data
+
+    async def json(self):
+        return self.data
+
+    async def text(self):
+        return ""
+
+
+class FakeChain:
+    """Транзакции кошелька и HTTP API tonapi.io / toncenter.com над ними."""
+
+    def __init__(self):
+        self.transactions = []  # от старых к новым
+        self.requests = []
+
+    def add(self, lt: int, source: str = SENDER, comment: str = f"tg:{TELEGRAM_ID}"):
+        self.transactions.append({"lt": lt, "hash": f"{lt:064x}", "source": source, "comment": comment})
+
+    @asynccontextmanager
+    async def get(self, url, headers=None, params=None, **kwargs):
+        params = dict(params or {})
+        self.requests.append((url, params))
+        if "tonapi.io" in url:
+            yield Response({"transactions": self._tonapi_page(params)})
+        else:
+            yield Response({"ok": True, "result": self._toncenter_page(params)})
+
+    def _tonapi_page(self, params):
+        txs = [tx for tx in self.transactions if tx["lt"] > params.get("after_lt", 0)]
+        if params.get("sort_order") != "asc":
+            txs = txs[::-1]
+        return [
+            {"hash": tx["hash"], "lt": tx["lt"], "in_msg": {
+                "value": TON, "source": {"address": tx["source"]}, "decoded_body": {"text": tx["comment"]},
+            }}
+            for tx in txs[:params["limit"]]
+        ]
+
+    def _toncenter_page(self, params):
+        txs = self.transactions[::-1]
+        if "lt" in params:
+            txs = [tx for tx in txs if tx["lt"] <= int(params["lt"])]
+        return [
+            {"transaction_id": {"lt": str(tx["lt"]), "hash": base64.b64encode(bytes.fromhex(tx["hash"])).decode()},
+             "in_msg": {"value": str(TON), "source": tx["source"], "message": base64.b64encode(tx["comment"].encode()).decode()}}
+            for tx in txs[:params["limit"]]
+        ]
+
+
+def make_service(chain: FakeChain) -> TonService:
+    service = TonService()
+
+    @asynccontextmanager
+    async def session(provider, timeout):
+        yield chain
+
+    service._session = session
+    return service
+
+
+async def scan(session, service):
+    async with session() as db:
+        await service.check_incoming_deposits(db)
+    async with session() as db:
+        cursor = await db.scalar(select(models.ChainCursor))
+        deposits = await db.scalar(select(func.count(models.Deposit.id)))
+        balance = await db.scalar(select(models.UserBalance.ton_active_balance))
+    return cursor.last_lt, deposits, balance
+
+
+def test_tonapi_cursor_pages_without_gaps(run, session, monkeypatch):
+    monkeypatch.setattr(ton_service, "DEPOSIT_PROVIDERS", ["tonapi"])
+    chain = FakeChain()
+    service = make_service(chain)
+
+    async def scenario():
+        async with session() as db:
+            user = models.User(telegram_id=TELEGRAM_ID, username="u")
+            db.add(user)
+            await db.flush()
+            db.add(models.UserBalance(user_id=user.id, ton_active_balance=Decimal(0)))
+            await db.commit()
+        results = []
+        for lt in range(1, 6):
+            chain.add(lt)
+        # Первый запуск - только последняя страница
+        results.append(await scan(session, service))
+        results.append(await scan(session, service))
+        # Всплеск больше лимита страниц: 8 депозитов и перевод с нашего кошелька (в raw форме)
+        for lt in range(6, 14):
+            chain.add(lt)
+        chain.add(14, source=parse_address(WALLET).raw, comment="")
+        results.append(await scan(session, service))
+        results.append(await scan(session, service))
+        results.append(await scan(session, service))
+        return results
+
+    results = run(scenario())
+    assert results == [
+        (5, 3, 3 * TON),
+        (5, 3, 3 * TON),
+        # Лимит 2 страницы по 3: курсор - на последней прочитанной, без разрыва
+        (11, 9, 9 * TON),
+        (14, 11, 11 * TON),
+        (14, 11, 11 * TON),
+    ]
+    pages = [params for url, params in chain.requests if "tonapi.io" in url and params.get("limit") != 1]
+    assert [p.get("after_lt") for p in pages if p.get("sort_order") == "asc"] == [5, 5, 8, 11, 14, 14]
+
+
+def test_toncenter_page_limit_keeps_cursor(run):
+    chain = FakeChain()
+    service = make_service(chain)
+    for lt in range(1, 12):
+        chain.add(lt)
+
+    async def scenario():
+        # Курсор на 2: после него 9 транзакций, а за проход читается 2 страницы по 3
+        # (следующая страница начинается с последней транзакции предыдущей)
+        partial = await service._scan_deposits("toncenter", WALLET, after_lt=2)
+        chain.transactions = chain.transactions[:6]
+        full = await service._scan_deposits("toncenter", WALLET, after_lt=2)
+        return partial, full
+
+    (partial_deposits, partial_newest), (full_deposits, full_newest) = run(scenario())
+    assert partial_newest == (0, None)
+    # Прочитанные депозиты записываются, курсор не сдвигается
+    assert [d["lt"] for d in partial_deposits] == [11, 10, 9, 8, 7]
+    assert full_newest == (6, f"{6:064x}")
+    assert [d["lt"] for d in full_deposits] == [6, 5, 4, 3]
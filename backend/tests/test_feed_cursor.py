@@ -0,0 +1,44 @@
+from decimal import Decimal
+
+import pytest
+from fastapi import HTTPException
+
+from app.routers.tasks import decode_feed_cursor, encode_feed_cursor
+
+
+@pytest.mark.parametrize("price, task_id", [
+    (Decimal("0"), 1),
+    (Decimal("1000000000"), 42),
+    (Decimal("123456789.000000001"), 2**40),
+])
+def test_cursor_round_trip(price, task_id):
+    cursor = encode_feed_cursor(price, task_id)
+    # Курсор уходит в заголовок и query string: без "=" и символов "+" / "/"
+    assert not set(cursor) & {"=", "+", "/"}
+    assert decode_feed_cursor(cursor) == (price, task_id)
+
+
+@pytest.mark.parametrize("cursor", ["", "not-a-cursor", "eyJwIjogIjEifQ"])
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_feed_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("descending, expected", [(True, [3, 1, 2, 4]), (False, [4, 2, 1, 3])])
+def test_index_pages_follow_cursor_in_both_orders(descending, expected):
+    from types import SimpleNamespace
+    from app.task_index import TaskTargetingIndex
+
+    index = TaskTargetingIndex()
+    for task_id, price in [(1, 5), (2, 3), (3, 5), (4, 1)]:
+        index.tasks[task_id] = SimpleNamespace(price_per_slot_ton=Decimal(price))
+    seen, after = [], None
+    while True:
+        page = index.page({1, 2, 3, 4}, after, 2, descending=descending)
+        if not page:
+            break
+        seen.extend(page)
+        last = page[-1]
+        after = decode_feed_cursor(encode_feed_cursor(index.tasks[last].price_per_slot_ton, last))
+    assert seen == expected
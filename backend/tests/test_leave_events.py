@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import select
+
+from app import comment_validator, models
+from app.comment_validator import process_leave_events
+
+CHANNEL_ID = -1001234
+
+
+async def create_subscriptions(session, telegram_ids) -> None:
+    """Подтвержденные подписки на канал в окне перепроверки и события выхода из него."""
+    now = datetime.utcnow()
+    async with session() as db:
+        creator = models.User(telegram_id=1, username="creator")
+        db.add(creator)
+        await db.flush()
+        task = models.Task(
+            creator_id=creator.id,
+            title="Подписка",
+            description="",
+            task_type=models.TaskType.SUBSCRIPTION,
+            telegram_channel_id=str(CHANNEL_ID),
+            price_per_slot_ton=Decimal(10**8),
+            total_slots=10,
+            completed_slots=len(telegram_ids),
+        )
+        db.add(task)
+        for telegram_id in telegram_ids:
+            user = models.User(telegram_id=telegram_id, username=f"user{telegram_id}")
+            db.add(user)
+            await db.flush()
+            db.add(models.UserTask(
+                user_id=user.id,
+                task_id=task.id,
+                status=models.UserTaskStatus.COMPLETED,
+                reward_ton=Decimal(10**8),
+                validated_at=now - timedelta(hours=1),
+                next_check_at=now + timedelta(hours=1),
+            ))
+            db.add(models.ChannelMemberEvent(
+                chat_id=CHANNEL_ID,
+                user_telegram_id=telegram_id,
+                old_status="member",
+                new_status="left",
+                event_at=now,
+            ))
+        await db.commit()
+
+
+def test_rollback_during_processing_does_not_break_remaining_events(run, session, monkeypatch):
+    checked = []
+
+    async def failing_check(user_task_id, db, subscription_exists):
+        # Ошибка возврата эскроу: rollback сбрасывает состояние объектов сессии
+        checked.append(user_task_id)
+        await db.rollback()
+
+    monkeypatch.setattr(comment_validator, "check_subscription_periodically", failing_check)
+
+    async def scenario():
+        await create_subscriptions(session, [501, 502, 503])
+        async with session() as db:
+            cancelled = await process_leave_events(db)
+        async with session() as db:
+            events = (await db.scalars(
+select(models.ChannelMemberEvent.processed_at))).all()
+        return cancelled, events
+
+    cancelled, processed_at = run(scenario())
+    assert cancelled == 3
+    assert len(checked) == 3
+    assert all(value is not None for value in processed_at)
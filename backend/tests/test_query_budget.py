@@ -0,0 +1,74 @@
+from decimal import Decimal
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from app import models, query_budget
+from app.database import async_engine
+from app.routers import tasks
+from app.task_index import TaskTargetingIndex
+
+VIEWER = 4000
+
+
+@pytest.fixture
+def feed_app(monkeypatch):
+    """Лента заданий за middleware бюджета в режиме strict и с пустым индексом таргетинга."""
+    monkeypatch.setattr(query_budget, "QUERY_BUDGET_MODE", "strict")
+    monkeypatch.setattr(tasks, "task_index", TaskTargetingIndex())
+    query_budget.install(async_engine)
+    app = FastAPI()
+    app.add_middleware(BaseHTTPMiddleware, dispatch=query_budget.query_budget_middleware)
+    app.include_router(tasks.router, prefix="/api/tasks")
+    return app
+
+
+async def create_feed(session, task_count: int):
+    async with session() as db:
+        creator = models.User(telegram_id=4001, username="creator")
+        viewer = models.User(telegram_id=VIEWER, username="viewer")
+        db.add_all([creator, viewer])
+        await db.flush()
+        db.add(models.UserBalance(user_id=viewer.id, ton_active_balance=Decimal(0), ton_escrow_balance=Decimal(0)))
+        for i in range(task_count):
+            db.add(models.Task(
+                creator_id=creator.id,
+                title=f"Задание {i}",
+                description="",
+                task_type=models.TaskType.SUBSCRIPTION,
+                price_per_slot_ton=Decimal((i + 1) * 10**8),
+                total_slots=5,
+                completed_slots=0,
+            ))
+        await db.commit()
+
+
+async def get_feed(app, **params):
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        return await client.get("/api/tasks/", params={"telegram_id": VIEWER, **params})
+
+
+def test_feed_stays_within_budget(run, session, feed_app):
+    async def scenario():
+        await create_feed(session, task_count=30)
+        first = await get_feed(feed_app, limit=10)
+        second = await get_feed(feed_app, limit=10, cursor=first.headers["X-Next-Cursor"])
+        return first, second
+
+    first, second = run(scenario())
+    assert first.status_code == second.status_code == 200
+    assert len(first.json()) == len(second.json()) == 10
+    assert first.headers["X-Total-Count"] == "30"
+
+
+def test_budget_overrun_raises_in_strict_mode(run, session, feed_app, monkeypatch):
+    monkeypatch.setattr(tasks.get_tasks, "__query_budget__", 2)
+
+    async def scenario():
+        await create_feed(session, task_count=3)
+        await get_feed(feed_app)
+
+    with pytest.raises(query_budget.QueryBudgetExceeded, match=r"GET /api/tasks/: \d+ SQL queries, budget 2"):
+        run(scenario())
@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta
+
+from app import models, recheck_scheduler
+from app.recheck_scheduler import next_check_time
+
+
+def test_comment_rechecks_back_off_within_window(monkeypatch):
+    monkeypatch.setitem(
+        recheck_scheduler.RECHECK_SCHEDULE,
+        models.TaskType.COMMENT,
+        (recheck_scheduler.COMMENT_RECHECK_INTERVAL, recheck_scheduler.COMMENT_RECHECK_WINDOW),
+    )
+    validated_at = datetime(2026, 1, 1, 12, 0)
+
+    checks = []
+    due_at = next_check_time(models.TaskType.COMMENT, validated_at, validated_at)
+    while due_at is not None:
+        checks.append(int((due_at - validated_at).total_seconds() // 60))
+        # Проверка выполняется чуть позже срока
+        due_at = next_check_time(models.TaskType.COMMENT, validated_at, due_at + timedelta(seconds=3))
+
+    assert checks == [5, 10, 20, 40]
+
+
+def test_subscription_rechecks_keep_daily_interval():
+    validated_at = datetime(2026, 1, 1, 12, 0)
+    now = validated_at + timedelta(days=3)
+    assert next_check_time(models.TaskType.SUBSCRIPTION, validated_at, now) == now + timedelta(days=1)
@@ -0,0 +1,141 @@
+import asyncio
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import select
+
+from app import models
+from app.slot_reservations import (
+    complete_reservation,
+    consume_slot,
+    expire_abandoned_reservations,
+    reserve_slot,
+    revoke_completed_slot,
+)
+
+
+async def create_task(session, total_slots: int) -> int:
+    async with session() as db:
+        user = models.User(telegram_id=1001, username="creator")
+        db.add(user)
+        await db.flush()
+        task = models.Task(
+            creator_id=user.id,
+            title="Подписка",
+            description="",
+            task_type=models.TaskType.SUBSCRIPTION,
+            price_per_slot_ton=Decimal(10**8),
+            total_slots=total_slots,
+            completed_slots=0,
+        )
+        db.add(task)
+        await db.commit()
+        return task.id
+
+
+async def take_slot(session, task_id: int, operation) -> bool:
+    async with session() as db:
+        task = await db.get(models.Task, task_id)
+        ok = await operation(db, task)
+        await db.commit()
+        return ok
+
+
+async def load_task(session, task_id: int) -> models.Task:
+    async with session() as db:
+        return await db.get(models.Task, task_id)
+
+
+def test_concurrent_reserve_never_oversells(run, session):
+    async def scenario():
+        task_id = await create_task(session, total_slots=3)
+        results = await asyncio.gather(*(take_slot(session, task_id, reserve_slot) for _ in range(10)))
+        return results, await load_task(session, task_id)
+
+    results, task = run(scenario())
+    assert results.count(True) == 3
+    assert task.reserved_slots == 3
+    assert task.completed_slots == 0
+
+
+def test_reserve_and_consume_share_capacity(run, session):
+    async def scenario():
+        task_id = await create_task(session, total_slots=4)
+        operations = [reserve_slot, consume_slot] * 5
+        results = await asyncio.gather(*(take_slot(session, task_id, op) for op in operations))
+        return results, await load_task(session, task_id)
+
+    results, task = run(scenario())
+    assert results.count(True) == 4
+    assert task.completed_slots + task.reserved_slots == 4
+
+
+def test_reserve_fails_for_inactive_task(run, session):
+    async def scenario():
+        task_id = await create_task(session, total_slots=3)
+        async with session() as db:
+            task = await db.get(models.Task, task_id)
+            task.status = models.TaskStatus.PAUSED
+            await db.commit()
+        return await take_slot(session, task_id, reserve_slot)
+
+    assert run(scenario()) is False
+
+
+def test_complete_then_revoke_frees_slot(run, session):
+    async def scenario():
+        task_id = await create_task(session, total_slots=1)
+        assert await take_slot(session, task_id, reserve_slot)
+        assert await take_slot(session, task_id, complete_reservation)
+        assert not await take_slot(session, task_id, reserve_slot)
+        assert await take_slot(session, task_id, revoke_completed_slot)
+        # Счетчик не уходит в минус
+        assert not await take_slot(session, task_id, revoke_completed_slot)
+        return await load_task(session, task_id)
+
+    task = run(scenario())
+    assert task.completed_slots == 0
+    assert task.reserved_slots == 0
+
+
+async def create_claim(session, task_id: int, telegram_id: int, started_ago: timedelta) -> int:
+    """Заявка IN_PROGRESS с наградой в эскроу исполнителя и занятым слотом."""
+    async with session() as db:
+        user = models.User(telegram_id=telegram_id, username=f"worker{telegram_id}")
+        db.add(user)
+        await db.flush()
+        db.add(models.UserBalance(user_id=user.id, ton_active_balance=Decimal(0), ton_escrow_balance=Decimal(10**8)))
+        started_at = datetime.utcnow() - started_ago
+        user_task = models.UserTask(
+            user_id=user.id,
+            task_id=task_id,
+            reward_ton=Decimal(10**8),
+            status=models.UserTaskStatus.IN_PROGRESS,
+            escrow_started_at=started_at,
+            escrow_ends_at=started_at + timedelta(days=7),
+        )
+        db.add(user_task)
+        assert await reserve_slot(db, await db.get(models.Task, task_id))
+        await db.commit()
+        return user_task.id
+
+
+def test_unconfirmed_claims_expire_long_before_escrow_ends(run, session):
+    async def scenario():
+        task_id = await create_task(session, total_slots=2)
+        stale = await create_claim(session, task_id, 2001, started_ago=timedelta(hours=3))
+        fresh = await create_claim(session, task_id, 2002, started_ago=timedelta(minutes=30))
+        async with session() as db:
+            expired = await expire_abandoned_reservations(db)
+        async with session() as db:
+            claims = {user_task_id: await db.get(models.UserTask, user_task_id) for user_task_id in (stale, fresh)}
+            balance = await db.scalar(select(models.UserBalance).where(models.UserBalance.user_id == claims[stale].user_id))
+            return expired, claims[stale], claims[fresh], balance, await db.get(models.Task, task_id)
+
+    expired, stale, fresh, balance, task = run(scenario())
+    assert expired == 1
+    assert stale.status == models.UserTaskStatus.FAILED
+    assert fresh.status == models.UserTaskStatus.IN_PROGRESS
+    # Эскроу вернулся исполнителю, слот снова доступен
+    assert (balance.ton_active_balance, balance.ton_escrow_balance) == (10**8, 0)
+    assert task.reserved_slots == 1
@@ -0,0 +1,46 @@
+import pytest
+
+from app.ton_address import canonical_address, parse_address, same_address
+
+# В url-safe записи есть "-" и "_" - проверяется и стандартный base64
+WALLET = "EQDvLRJ943uUK6rQYUXlSwxhmh8iMnsuu8--x49VZK_jnSsa"
+OTHER = "EQDZKYoQ0bBzWDfcS9hdrGQbDzzvJ6R-XVOlTy8_Wy_P-l3-"
+
+
+def forms(address: str) -> list:
+    parsed = parse_address(address)
+    bounceable = parsed.friendly(bounceable=True)
+    return [
+        bounceable,
+        parsed.friendly(bounceable=False),
+        parsed.raw,
+        parsed.raw.upper(),
+        # Стандартный base64 вместо url-safe
+        bounceable.replace("-", "+").replace("_", "/"),
+        f"  {bounceable}\n",
+    ]
+
+
+def test_forms_of_one_address_parse_to_the_same_key():
+    keys = {parse_address(form) for form in forms(WALLET)}
+    assert len(keys) == 1
+    assert forms(WALLET)[0].startswith("EQ")
+    assert forms(WALLET)[1].startswith("UQ")
+    assert canonical_address(forms(WALLET)[1]) == "0:" + parse_address(WALLET).hash_part.hex()
+
+
+@pytest.mark.parametrize("form", forms(WALLET))
+def test_same_address_across_forms(form):
+    assert same_address(WALLET, form)
+    assert not same_address(OTHER, form)
+
+
+def test_invalid_addresses():
+    with pytest.raises(ValueError):
+        parse_address("EQwallet")
+    assert canonical_address("EQwallet") is None
+    assert canonical_address(None) is None
+    # Неразбираемые адреса сравниваются как строки
+    assert same_address("EQwallet", "EQwallet")
+    assert not same_address("EQwallet", WALLET)
+    assert not same_address(None, WALLET)
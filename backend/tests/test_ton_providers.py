@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from app import ton_providers
+from app.ton_providers import ProviderRegistry, ProvidersUnavailable
+
+OPEN_SECONDS = 0.05
+
+
+@pytest.fixture(autouse=True)
+def short_circuit(monkeypatch):
+    monkeypatch.setattr(ton_providers, "CIRCUIT_OPEN_SECONDS", OPEN_SECONDS)
+
+
+class Providers:
+    """fn для registry.call(): провайдеры из down падают, остальные отвечают своим именем."""
+
+    def __init__(self, *down: str):
+        self.down = set(down)
+        self.calls = []
+
+    async def __call__(self, name: str) -> str:
+        self.calls.append(name)
+        if name in self.down:
+            raise Exception(f"{name} timeout")
+        return name
+
+
+def test_slower_or_failing_provider_is_demoted(run):
+    registry = ProviderRegistry(["tonapi", "toncenter"])
+    providers = Providers("tonapi")
+
+    async def scenario():
+        return [await registry.call(["tonapi", "toncenter"], providers) for _ in range(4)]
+
+    assert run(scenario()) == ["toncenter"] * 4
+    # После первой ошибки tonapi оценивается хуже и идет вторым
+    assert providers.calls == ["tonapi", "toncenter", "toncenter", "toncenter", "toncenter"]
+
+
+def test_open_circuit_is_not_called_even_as_fallback(run):
+    registry = ProviderRegistry(["tonapi", "toncenter"])
+    providers = Providers("tonapi")
+
+    async def scenario():
+        for _ in range(ton_providers.CIRCUIT_FAILURE_THRESHOLD):
+            with pytest.raises(Exception):
+                await registry.call(["tonapi"], providers)
+        providers.calls.clear()
+        providers.down = {"toncenter"}
+        with pytest.raises(Exception, match="toncenter timeout"):
+            await registry.call(["tonapi", "toncenter"], providers)
+
+    run(scenario())
+    assert providers.calls == ["toncenter"]
+
+
+def test_half_open_probe_failure_reopens_with_longer_pause(run):
+    registry = ProviderRegistry(["tonapi"])
+    providers = Providers("tonapi")
+
+    async def scenario():
+        for _ in range(ton_providers.CIRCUIT_FAILURE_THRESHOLD):
+            with pytest.raises(Exception):
+                await registry.call(["tonapi"], providers)
+        with pytest.raises(ProvidersUnavailable):
+            await registry.call(["tonapi"], providers)
+        await asyncio.sleep(OPEN_SECONDS * 1.5)
+        # Пауза прошла: один пробный вызов, ошибка снова размыкает цепь
+        with pytest.raises(Exception, match="tonapi timeout"):
+            await registry.call(["tonapi"], providers)
+        with pytest.raises(ProvidersUnavailable):
+            await registry.call(["tonapi"], providers)
+
+    run(scenario())
+    assert providers.calls == ["tonapi"] * (ton_providers.CIRCUIT_FAILURE_THRESHOLD + 1)
+    assert registry.health("tonapi").open_seconds == OPEN_SECONDS * 4
+
+
+def test_half_open_probe_success_closes_circuit(run):
+    registry = ProviderRegistry(["tonapi"])
+    providers = Providers("tonapi")
+
+    async def scenario():
+        for _ in range(ton_providers.CIRCUIT_FAILURE_THRESHOLD):
+            with pytest.raises(Exception):
+                await registry.call(["tonapi"], providers)
+        await asyncio.sleep(OPEN_SECONDS * 1.5)
+        providers.down.clear()
+        return [await registry.call(["tonapi"], providers) for _ in range(3)]
+
+    assert run(scenario()) == ["tonapi"] * 3
+    health = registry.health("tonapi")
+    assert health.consecutive_failures == 0
+    assert health.open_seconds == OPEN_SECONDS
+
+
+def test_all_circuits_open(run):
+    registry = ProviderRegistry(["tonapi", "toncenter"])
+    providers = Providers("tonapi", "toncenter")
+
+    async def scenario():
+        for _ in range(ton_providers.CIRCUIT_FAILURE_THRESHOLD):
+            with pytest.raises(Exception, match="timeout"):
+                await registry.call(["tonapi", "toncenter"], providers)
+        with pytest.raises(ProvidersUnavailable):
+            await registry.call(["tonapi", "toncenter"], providers)
+
+    run(scenario())
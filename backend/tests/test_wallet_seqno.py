@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from app import models
+from app.wallet_seqno import SeqnoManager
+
+WALLET = "EQwallet"
+
+
+class Chain:
+    """seqno кошелька в сети; reads - сколько раз его читали."""
+
+    def __init__(self, seqno: int):
+        self.seqno = seqno
+        self.reads = 0
+
+    async def fetch(self) -> int:
+        self.reads += 1
+        return self.seqno
+
+
+async def send(manager: SeqnoManager, fail: bool = False) -> int:
+    async with manager.reserve() as seqno:
+        if fail:
+            raise Exception("rejected by node")
+        return seqno
+
+
+async def stored_row(session) -> models.WalletSeqno:
+    async with session() as db:
+        return await db.get(models.WalletSeqno, WALLET)
+
+
+def test_consecutive_sends_are_allocated_locally(run, session):
+    chain = Chain(seqno=7)
+    manager = SeqnoManager(WALLET, chain.fetch)
+
+    async def scenario():
+        used = [await send(manager) for _ in range(3)]
+        return used, await stored_row(session)
+
+    used, row = run(scenario())
+    assert used == [7, 8, 9]
+    # Из сети - только при создании строки
+    assert chain.reads == 1
+    assert (row.seqno, row.resync_required) == (10, False)
+
+
+def test_processes_share_the_counter(run, session):
+    chain = Chain(seqno=1)
+    managers = [SeqnoManager(WALLET, chain.fetch) for _ in range(2)]
+
+    async def scenario():
+        await send(managers[0])
+        return await asyncio.gather(*(send(managers[i % 2]) for i in range(6)))
+
+    assert sorted(run(scenario())) == [2, 3, 4, 5, 6, 7]
+    assert chain.reads == 1
+
+
+def test_failed_send_resyncs_from_chain(run, session):
+    chain = Chain(seqno=3)
+    manager = SeqnoManager(WALLET, chain.fetch)
+
+    async def scenario():
+        first = await send(manager)
+        chain.seqno = 4  # первое сообщение применилось
+        with pytest.raises(Exception, match="rejected"):
+            await send(manager, fail=True)
+        row = await stored_row(session)
+        return first, row.resync_required, await send(manager), await send(manager)
+
+    assert run(scenario()) == (3, True, 4, 5)
+    assert chain.reads == 2
+
+
+def test_invalidate_resyncs_from_chain(run, session):
+    chain = Chain(seqno=10)
+    manager = SeqnoManager(WALLET, chain.fetch)
+
+    async def scenario():
+        used = [await send(manager) for _ in range(3)]
+        # Опрос подтверждений: сообщение 11 не исполнилось, 12 следом тоже
+        chain.seqno = 11
+        await SeqnoManager(WALLET, chain.fetch).invalidate()
+        return used, await send(manager)
+
+    used, after = run(scenario())
+    assert used == [10, 11, 12]
+    assert after == 11
+    assert chain.reads == 2
@@ -0,0 +1,88 @@
+from decimal import Decimal
+
+import pytest
+
+from app import models, ton_service
+from app.ton_service import TonService
+
+TON = 10**9
+
+
+@pytest.fixture(autouse=True)
+def batch_limits(monkeypatch):
+    monkeypatch.setattr(ton_service, "TON_WITHDRAWAL_BATCH_SIZE", 4)
+    monkeypatch.setattr(ton_service, "TON_WITHDRAWAL_BATCH_MAX_NANO", 5 * TON)
+
+
+def plan(*amounts_ton):
+    txs = [models.TonTransaction(id=i, amount_nano=Decimal(amount * TON)) for i, amount in enumerate(amounts_ton, 1)]
+    return [[tx.id for tx in batch] for batch in TonService._plan_withdrawal_batches(txs)]
+
+
+def test_batches_respect_size_and_value_limits():
+    # 4 перевода на пакет; 1+3 влезают в 5 TON, 9 TON - отдельным пакетом
+    assert plan(1, 1, 1, 1, 1, 3, 9, 1) == [[1, 2, 3, 4], [5, 6], [7], [8]]
+
+
+def test_batches_keep_queue_order():
+    assert plan(2, 4, 1, 1) == [[1], [2, 3], [4]]
+
+
+def test_value_limit_is_inclusive():
+    assert plan(2, 3, 5) == [[1, 2], [3]]
+
+
+def test_no_withdrawals():
+    assert plan() == []
+
+
+def test_recording_failure_after_send_does_not_resend(run, session, monkeypatch):
+    from sqlalchemy import select
+    from app import balance_ledger
+
+    monkeypatch.setattr(ton_service, "TON_WITHDRAWAL_BATCHING", True)
+    service = TonService()
+    sent = []
+
+    async def send_batch(transfers):
+        sent.append(len(transfers))
+        return f"hash{len(sent)}"
+
+    service._send_batch = send_batch
+    lock_balances = balance_ledger.lock_balances
+    failures = {"left": 1}
+
+    async def flaky_lock_balances(db, user_ids):
+        if failures["left"]:
+            failures["left"] -= 1
+            raise Exception("database is unavailable")
+        return await lock_balances(db, user_ids)
+
+    monkeypatch.setattr(balance_ledger, "lock_balances", flaky_lock_balances)
+
+    async def scenario():
+        async with session() as db:
+            user = models.User(telegram_id=3001, username="u")
+            db.add(user)
+            await db.flush()
+            db.add(models.UserBalance(user_id=user.id, ton_active_balance=Decimal(10 * TON)))
+            for i in range(3):
+                db.add(models.TonTransaction(user_id=user.id, to_address="EQ", amount_nano=Decimal(TON), status="pending", idempotency_key=f"w{i}"))
+            await db.commit()
+        async with session() as db:
+            with pytest.raises(Exception, match="unavailable"):
+                await service.process_pending_withdrawals(db)
+        async with session() as db:
+            after_failure = [tx.status for tx in (await db.scalars(select(models.TonTransaction))).all()]
+            await service.process_pending_withdrawals(db)
+        async with session() as db:
+            txs = (await db.scalars(select(models.TonTransaction))).all()
+            balance = await db.scalar(select(models.UserBalance.ton_active_balance))
+        return after_failure, txs, balance
+
+    after_failure, txs, balance = run(scenario())
+    assert after_failure == ["sent_unrecorded"] * 3
+    # Пакет отправлен один раз, средства списаны на следующем проходе
+    assert sent == [3]
+    assert {(tx.status, tx.tx_hash) for tx in txs} == {("pending", "hash1")}
+    assert balance == 7 * TON
@@ -1,9 +1,29 @@
 #!/usr/bin/env node
 // Node-based TON sender using @ton/ton (supports wallet v5r1).
 // Updated for @ton/ton 16.x API (no getWalletSeqno; use client.open(wallet).getSeqno()).
+//
+// One-shot mode:  node ton_sender.js --to <addr> --amount <nano> [--comment <text>]
+//                 node ton_sender.js --messages '[{"to": "...", "amount": "...", "comment": "..."}, ...]'
+// Daemon mode:    node ton_sender.js --daemon
+//   Keys and the wallet are loaded once; requests are JSON lines on stdin,
+//   replies are JSON lines on stdout carrying the request id:
+//     {"id": "...", "op": "send", "seqno": 1, "messages": [...]} -> {"id": "...", "ok": true, "seqno": 1, "txHash": "...", "messages": 1}
+//     {"id": "...", "op": "ping"}                               -> {"id": "...", "ok": true, "address": "..."}
+//   "seqno" is allocated by the caller; without it the seqno is read from the chain.
+//   A {"ready": true} line is printed once the wallet is loaded. Logs go to stderr.
+import { createInterface } from "node:readline";
 import { TonClient, WalletContractV5R1, WalletContractV4, internal, beginCell, SendMode, Address } from "@ton/ton";
 import { mnemonicToPrivateKey } from "@ton/crypto";
 
+function validateMessages(messages) {
+  if (!Array.isArray(messages) || messages.length === 0) throw new Error("messages must be a non-empty array");
+  for (const m of messages) {
+    if (!m.to) throw new Error("Missing message.to");
+    if (!m.amount) throw new Error("Missing message.amount");
+  }
+  return messages;
+}
+
 function parseArgs() {
   const args = process.argv.slice(2);
   const out = {};
@@ -14,15 +34,18 @@ function parseArgs() {
     if (key === "--to") out.to = val;
     if (key === "--amount") out.amount = val;
     if (key === "--comment") out.comment = val;
+    if (key === "--messages") out.messages = val;
+  }
+  // Batch mode: all transfers go out in one external message with a single seqno
+  if (out.messages) {
+    return { messages: validateMessages(JSON.parse(out.messages)) };
   }
   if (!out.to) throw new Error("Missing --to");
   if (!out.amount) throw new Error("Missing --amount");
-  return out;
+  return { messages: [{ to: out.to, amount: out.amount, comment: out.comment }] };
 }
 
-async function main() {
-  const { to, amount, comment } = parseArgs();
-
+async function openWallet() {
   const seed = process.env.TON_WALLET_SEED;
   if (!seed) throw new Error("TON_WALLET_SEED is not set");
 
@@ -46,44 +69,81 @@ async function main() {
     wallet = WalletContractV4.create({ workchain: 0, publicKey });
   }
 
+  const address = wallet.address.toString({ urlSafe: true, bounceable: true });
   const envAddress = process.env.TON_WALLET_ADDRESS;
-  if (envAddress) {
-    const calcAddr = wallet.address.toString({ urlSafe: true, bounceable: true });
-    if (calcAddr !== envAddress) {
-      console.error(`⚠️ Warning: Derived address ${calcAddr} differs from TON_WALLET_ADDRESS ${envAddress}`);
-    }
+  if (envAddress && address !== envAddress) {
+    console.error(`⚠️ Warning: Derived address ${address} differs from TON_WALLET_ADDRESS ${envAddress}`);
   }
 
-  const opened = client.open(wallet);
-  const seqno = await opened.getSeqno();
+  return { wallet, opened: client.open(wallet), secretKey, address };
+}
 
-  const body = comment
-    ? beginCell().storeUint(0, 32).storeStringTail(comment).endCell()
-    : undefined;
+async function sendTransfer({ wallet, opened, secretKey }, messages, seqno) {
+  if (seqno === undefined || seqno === null) seqno = await opened.getSeqno();
 
   // Явно создаём и отправляем трансфер, чтобы получить хеш
   const transfer = wallet.createTransfer({
     seqno,
     secretKey,
     sendMode: SendMode.PAY_GAS_SEPARATELY,
-    messages: [
+    messages: messages.map(({ to, amount, comment }) =>
       internal({
         to: Address.parse(to),
         value: BigInt(amount),
         bounce: true,
-        body,
-      }),
-    ],
+        body: comment ? beginCell().storeUint(0, 32).storeStringTail(comment).endCell() : undefined,
+      })
+    ),
   });
 
   await opened.send(transfer);
-  const txHash = transfer.hash().toString("hex");
+  return { seqno, txHash: transfer.hash().toString("hex"), messages: messages.length };
+}
 
-  console.log(JSON.stringify({ ok: true, seqno, txHash }));
+async function main() {
+  const { messages } = parseArgs();
+  const ctx = await openWallet();
+  console.log(JSON.stringify({ ok: true, ...(await sendTransfer(ctx, messages)) }));
+}
+
+async function daemon() {
+  const ctx = await openWallet();
+  const reply = (obj) => process.stdout.write(JSON.stringify(obj) + "\n");
+  // Sends run one after another so that each one reads the seqno left by the previous one
+  let sendQueue = Promise.resolve();
+
+  const rl = createInterface({ input: process.stdin });
+  rl.on("line", (line) => {
+    if (!line.trim()) return;
+    let req;
+    try {
+      req = JSON.parse(line);
+    } catch (err) {
+      reply({ id: null, ok: false, error: `Bad request: ${err.message}` });
+      return;
+    }
+    const { id, op } = req;
+    if (op === "ping") {
+      reply({ id, ok: true, address: ctx.address });
+    } else if (op === "send") {
+      sendQueue = sendQueue.then(async () => {
+        try {
+          reply({ id, ok: true, ...(await sendTransfer(ctx, validateMessages(req.messages), req.seqno)) });
+        } catch (err) {
+          reply({ id, ok: false, error: err.message || String(err) });
+        }
+      });
+    } else {
+      reply({ id, ok: false, error: `Unknown op: ${op}` });
+    }
+  });
+  // Parent closed stdin: finish the queued sends and exit
+  rl.on("close", () => sendQueue.then(() => process.exit(0)));
+
+  reply({ ready: true, address: ctx.address });
 }
 
-main().catch((err) => {
+(process.argv.includes("--daemon") ? daemon : main)().catch((err) => {
   console.error(JSON.stringify({ ok: false, error: err.message || String(err) }));
   process.exit(1);
 });
-
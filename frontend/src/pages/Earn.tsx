@@ -10,6 +10,33 @@ import './Earn.css'
 
 const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
 
+// Лента заданий отдается страницами: первая - при открытии, следующие - по кнопке "Показать еще"
+const TASKS_PAGE_LIMIT = 20
+// Максимальный размер страницы на бэкенде (FEED_MAX_PAGE_SIZE)
+const TASKS_MAX_PAGE_LIMIT = 100
+
+interface FeedFilter {
+  taskType: string | null
+  order: 'desc' | 'asc'
+}
+
+// Одна страница ленты; курсор следующей - в заголовке X-Next-Cursor (нет заголовка - страниц больше нет)
+async function fetchTasksPage(telegramId: number, filter: FeedFilter, limit: number, cursor?: string | null) {
+  const response = await axios.get(`${API_URL}/api/tasks/`, {
+    params: {
+      telegram_id: telegramId,
+      task_type: filter.taskType || undefined,
+      order: filter.order,
+      limit,
+      cursor: cursor || undefined
+    }
+  })
+  return {
+    tasks: (response.data || []) as any[],
+    nextCursor: (response.headers['x-next-cursor'] as string | undefined) || null
+  }
+}
+
 function getChannelLink(channelId: string | undefined): string | null {
   if (!channelId) return null
   
@@ -81,7 +108,8 @@ export default function Earn() {
   const { showError, showSuccess } = useToast()
   const navigate = useNavigate()
   const [tasks, setTasks] = useState<Task[]>([])
-  const [allTasks, setAllTasks] = useState<Task[]>([])
+  const [nextCursor, setNextCursor] = useState<string | null>(null)
+  const [loadingMore, setLoadingMore] = useState(false)
   const [loading, setLoading] = useState(true)
   const [sortOrder, setSortOrder] = useState<'desc' | 'asc'>('desc')
   const [selectedTaskType, setSelectedTaskType] = useState<'subscription' | 'comment' | 'view' | null>(null)
@@ -111,7 +139,7 @@ export default function Earn() {
   }, [user, sortOrder, selectedTaskType])
 
   useEffect(() => {
-    if (!user || updateCounter === 0) return
+    if (!user || updateCounter === 0 || loadingMore) return
     loadTasks()
   }, [updateCounter, user])
 
@@ -133,28 +161,14 @@ export default function Earn() {
   async function loadTasks() {
     if (!user) return
     
+    // Фильтр по типу и сортировка по цене - на бэкенде, иначе страницы не сходятся.
+    // Обновление перезапрашивает столько заданий, сколько уже показано
+    const filter: FeedFilter = { taskType: selectedTaskType, order: sortOrder }
+    const limit = Math.min(Math.max(tasks.length, TASKS_PAGE_LIMIT), TASKS_MAX_PAGE_LIMIT)
     try {
-      const response = await axios.get(`${API_URL}/api/tasks/`, {
-        params: { telegram_id: user.telegram_id }
-      })
-      
-      setAllTasks(response.data || [])
-      
-      // Фильтрация по типу задания
-      let filteredTasks = [...(response.data || [])]
-      if (selectedTaskType) {
-        filteredTasks = filteredTasks.filter(task => task.task_type === selectedTaskType)
-      }
-      
-      // Сортировка только по цене
-      let sortedTasks = [...filteredTasks]
-      sortedTasks.sort((a, b) => {
-        const priceA = parseFloat(a.price_per_slot_fiat || '0')
-        const priceB = parseFloat(b.price_per_slot_fiat || '0')
-        return sortOrder === 'desc' ? priceB - priceA : priceA - priceB
-      })
-      
-      setTasks(sortedTasks)
+      const page = await fetchTasksPage(user.telegram_id, filter, limit)
+      setTasks(page.tasks)
+      setNextCursor(page.nextCursor)
     } catch (error: any) {
       console.error('Error loading tasks:', error)
       // Если пользователь не найден, попробуем создать его
@@ -166,37 +180,38 @@ export default function Earn() {
             first_name: user.first_name
           })
           // Повторно загружаем задания
-          const retryResponse = await axios.get(`${API_URL}/api/tasks/`, {
-            params: { telegram_id: user.telegram_id }
-          })
-          setAllTasks(retryResponse.data || [])
-          
-          // Применяем фильтрацию и сортировку
-          let filteredTasks = [...(retryResponse.data || [])]
-          if (selectedTaskType) {
-            filteredTasks = filteredTasks.filter(task => task.task_type === selectedTaskType)
-          }
-          
-          let sortedTasks = [...filteredTasks]
-          sortedTasks.sort((a, b) => {
-            const priceA = parseFloat(a.price_per_slot_fiat || '0')
-            const priceB = parseFloat(b.price_per_slot_fiat || '0')
-            return sortOrder === 'desc' ? priceB - priceA : priceA - priceB
-          })
-          
-          setTasks(sortedTasks)
+          const page = await fetchTasksPage(user.telegram_id, filter, TASKS_PAGE_LIMIT)
+          setTasks(page.tasks)
+          setNextCursor(page.nextCursor)
         } catch (createError) {
           console.error('Error creating user:', createError)
           setTasks([])
+          setNextCursor(null)
         }
       } else {
         setTasks([])
+        setNextCursor(null)
       }
     } finally {
       setLoading(false)
     }
   }
 
+  async function loadMoreTasks() {
+    if (!user || !nextCursor || loadingMore) return
+    setLoadingMore(true)
+    try {
+      const page = await fetchTasksPage(user.telegram_id, { taskType: selectedTaskType, order: sortOrder }, TASKS_PAGE_LIMIT, nextCursor)
+      setTasks(prev => [...prev, ...page.tasks.filter(task => !prev.some(loaded => loaded.id === task.id))])
+      setNextCursor(page.nextCursor)
+    } catch (error: any) {
+      console.error('Error loading more tasks:', error)
+      showError('Ошибка при загрузке заданий')
+    } finally {
+      setLoadingMore(false)
+    }
+  }
+
   function currencySymbol(currency?: string) {
     switch (currency) {
       case 'USD': return '$'
@@ -384,6 +399,11 @@ export default function Earn() {
             />
           ))
         )}
+        {nextCursor && (
+          <button className="load-more-btn" onClick={loadMoreTasks} disabled={loadingMore}>
+            {loadingMore ? 'Загрузка…' : 'Показать еще'}
+          </button>
+        )}
       </div>
 
       {/* Модальное окно с деталями задания */}